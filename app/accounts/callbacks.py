@@ -0,0 +1,235 @@
+from redis import Redis
+from redis.exceptions import ResponseError
+from pydantic import BaseModel
+from sqlalchemy.orm import Session
+from typing import Callable, Dict, List, Tuple
+
+from app.db.session import SessionLocal
+from app.core.config import settings, redis
+from app.core.celery_app import celery
+from app.core.logger import logger
+from app.accounts.constants import MpesaCallbackTypes
+from app.accounts.daos.mpesa import mpesa_callback_dao
+from app.accounts.serializers.mpesa import (
+    MpesaPaymentResultSerializer,
+    MpesaDirectPaymentSerializer,
+    WithdrawalResultSerializer,
+)
+from app.accounts.utils import (
+    process_mpesa_stk,
+    process_mpesa_paybill_payment,
+    process_b2c_payment_result,
+)
+
+
+def process_stkpush_callback(db: Session, payload: str) -> None:
+    mpesa_response_in = MpesaPaymentResultSerializer.parse_raw(payload)
+    process_mpesa_stk(db, mpesa_response_in.Body.stkCallback)
+
+
+def process_paybill_callback(db: Session, payload: str) -> None:
+    process_mpesa_paybill_payment(db, MpesaDirectPaymentSerializer.parse_raw(payload))
+
+
+def process_b2c_result_callback(db: Session, payload: str) -> None:
+    withdrawal_response_in = WithdrawalResultSerializer.parse_raw(payload)
+    process_b2c_payment_result(db, withdrawal_response_in.Result)
+
+
+class MpesaCallbackStream:
+    """
+    A durable queue of M-Pesa callbacks.
+
+    Routes append callbacks to a Redis Stream and return at once. The callback
+    worker reads them through a consumer group in batches and processes each one
+    in its own database session before acknowledging it. A callback that failed,
+    or whose worker died, is claimed again once it has been pending for
+    MPESA_CALLBACK_RETRY_AFTER_SECONDS. After MPESA_CALLBACK_MAX_DELIVERIES
+    it is moved to a dead letter stream.
+
+    M-Pesa retries a callback it thinks was not received. A retry is dropped
+    before it is queued if its id is in Redis, and skipped before it is processed
+    if its id is in the MpesaCallbacks table, which is the source of truth.
+    The id is only recorded in the table once the callback is processed.
+    """
+
+    stream_key = "mpesa_callbacks"
+    dead_letter_key = "mpesa_callbacks:dead"
+    group_name = "mpesa-callback-workers"
+    task_name = "app.accounts.tasks.process_mpesa_callbacks_task"
+
+    processors: Dict[str, Callable[[Session, str], None]] = {
+        MpesaCallbackTypes.STKPUSH.value: process_stkpush_callback,
+        MpesaCallbackTypes.PAYBILL.value: process_paybill_callback,
+        MpesaCallbackTypes.B2C_RESULT.value: process_b2c_result_callback,
+    }
+
+    callback_ids: Dict[str, Callable[[BaseModel], str]] = {
+        MpesaCallbackTypes.STKPUSH.value: lambda callback_in: (
+            callback_in.Body.stkCallback.CheckoutRequestID
+        ),
+        MpesaCallbackTypes.PAYBILL.value: lambda callback_in: callback_in.TransID,
+        MpesaCallbackTypes.B2C_RESULT.value: lambda callback_in: (
+            callback_in.Result.ConversationID
+        ),
+    }
+
+    def __init__(self, redis_client: Redis = redis) -> None:
+        self.redis = redis_client
+
+    def get_idempotency_key(
+        self, callback_type: MpesaCallbackTypes, callback_in: BaseModel
+    ) -> str:
+        callback_id = self.callback_ids[callback_type.value](callback_in)
+        return f"{callback_type.value}:{callback_id}"
+
+    def dedupe_key(self, idempotency_key: str) -> str:
+        return f"mpesa_callback:{idempotency_key}"
+
+    def add(
+        self, callback_type: MpesaCallbackTypes, callback_in: BaseModel
+    ) -> str | None:
+        """Append a callback to the stream and wake the callback worker.
+        Returns None if the callback was already queued"""
+        idempotency_key = self.get_idempotency_key(callback_type, callback_in)
+        dedupe_key = self.dedupe_key(idempotency_key)
+
+        is_new = self.redis.set(
+            dedupe_key, 1, nx=True, ex=settings.MPESA_CALLBACK_DEDUPE_SECONDS
+        )
+        if not is_new:
+            logger.info(f"Dropping duplicate callback {idempotency_key}")
+            return None
+
+        try:
+            entry_id = self.redis.xadd(
+                self.stream_key,
+                {
+                    "type": callback_type.value,
+                    "idempotency_key": idempotency_key,
+                    "payload": callback_in.json(),
+                },
+            )
+        except Exception:
+            # The callback was not queued, so a retry of it must not be dropped
+            self.redis.delete(dedupe_key)
+            raise
+
+        self.schedule()
+        return entry_id
+
+    def schedule(self) -> None:
+        """Wake the callback worker. Callbacks whose worker is never woken
+        are processed by the periodic callback run"""
+        try:
+            celery.send_task(self.task_name, queue=settings.CELERY_CALLBACK_QUEUE)
+        except Exception as e:
+            logger.error(f"Exception {e} while scheduling the callback worker")
+
+    def create_group(self) -> None:
+        try:
+            self.redis.xgroup_create(
+                self.stream_key, self.group_name, id="0", mkstream=True
+            )
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):  # The group already exists
+                raise
+
+    def read(self, *, consumer: str, count: int) -> List[Tuple[str, Dict]]:
+        """Claim callbacks that are due for a retry, then read new callbacks"""
+        self.create_group()
+
+        claimed = self.redis.xautoclaim(
+            self.stream_key,
+            self.group_name,
+            consumer,
+            min_idle_time=settings.MPESA_CALLBACK_RETRY_AFTER_SECONDS * 1000,
+            count=count,
+        )[1]
+        # Entries deleted while they were pending are claimed without fields
+        entries = [(entry_id, fields) for entry_id, fields in claimed if fields]
+
+        if len(entries) < count:
+            for _, new_entries in self.redis.xreadgroup(
+                self.group_name,
+                consumer,
+                {self.stream_key: ">"},
+                count=count - len(entries),
+            ):
+                entries += new_entries
+
+        return entries
+
+    def get_deliveries(self, entry_id: str) -> int:
+        pending = self.redis.xpending_range(
+            self.stream_key, self.group_name, min=entry_id, max=entry_id, count=1
+        )
+        return pending[0]["times_delivered"] if pending else 0
+
+    def acknowledge(self, entry_ids: List[str]) -> None:
+        """Acknowledge processed callbacks and delete them so the stream stays small"""
+        pipeline = self.redis.pipeline()
+        pipeline.xack(self.stream_key, self.group_name, *entry_ids)
+        pipeline.xdel(self.stream_key, *entry_ids)
+        pipeline.execute()
+
+    def process(self, db: Session, fields: Dict) -> None:
+        """Process a callback unless it was processed before.
+        The processors commit as they go, so the callback is only recorded
+        after its processor returns. A callback whose processing failed part
+        way is processed again on its next delivery."""
+        idempotency_key = fields.get("idempotency_key")
+        if idempotency_key and mpesa_callback_dao.get(
+            db, idempotency_key=idempotency_key
+        ):
+            logger.info(f"Skipping callback {idempotency_key} processed before")
+            return
+
+        self.processors[fields["type"]](db, fields["payload"])
+
+        if idempotency_key:
+            mpesa_callback_dao.record(
+                db, callback_type=fields["type"], idempotency_key=idempotency_key
+            )
+            db.commit()
+
+    def process_pending(self, *, consumer: str, batch_size: int | None = None) -> int:
+        """Process a batch of callbacks. Returns the number of callbacks read"""
+        entries = self.read(
+            consumer=consumer,
+            count=batch_size or settings.MPESA_CALLBACK_BATCH_SIZE,
+        )
+        done_entry_ids = []
+
+        for entry_id, fields in entries:
+            try:
+                with SessionLocal() as db:
+                    self.process(db, fields)
+                done_entry_ids.append(entry_id)
+
+            except Exception as e:
+                logger.exception(f"Exception {e} while processing callback {entry_id}")
+
+                if (
+                    self.get_deliveries(entry_id)
+                    >= settings.MPESA_CALLBACK_MAX_DELIVERIES
+                ):
+                    logger.error(
+                        f"Moving callback {entry_id} to the dead letter stream"
+                    )
+                    self.redis.xadd(
+                        self.dead_letter_key,
+                        {**fields, "entry_id": entry_id, "error": str(e)},
+                    )
+                    if fields.get("idempotency_key"):
+                        # Let M-Pesa's next retry of the callback be queued again
+                        self.redis.delete(self.dedupe_key(fields["idempotency_key"]))
+                    done_entry_ids.append(entry_id)
+
+        if done_entry_ids:
+            self.acknowledge(done_entry_ids)
+
+        return len(entries)
+
+
+mpesa_callback_stream = MpesaCallbackStream()
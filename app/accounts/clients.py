@@ -0,0 +1,79 @@
+import os
+import httpx
+
+from app.core.config import settings
+
+
+class MpesaClient:
+    """
+    HTTP client for the M-Pesa Daraja API.
+
+    Connections to Safaricom are pooled and kept alive between calls,
+    so a payment does not pay for a new TCP and TLS handshake,
+    and every call gives up after the connect and read timeouts.
+    The sync client is used by background tasks and workers,
+    and the async client by routes.
+    """
+
+    def __init__(self) -> None:
+        self.timeout = httpx.Timeout(
+            settings.MPESA_READ_TIMEOUT_SECONDS,
+            connect=settings.MPESA_CONNECT_TIMEOUT_SECONDS,
+        )
+        self.limits = httpx.Limits(
+            max_connections=settings.MPESA_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.MPESA_MAX_CONNECTIONS,
+            keepalive_expiry=settings.MPESA_KEEPALIVE_SECONDS,
+        )
+
+        self.pid: int | None = None
+        self.sync_client: httpx.Client | None = None
+        self.async_client: httpx.AsyncClient | None = None
+
+    def reset_after_fork(self) -> None:
+        """A forked worker opens its own connections instead of sharing its parent's"""
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.sync_client = None
+            self.async_client = None
+
+    @property
+    def client(self) -> httpx.Client:
+        self.reset_after_fork()
+        if self.sync_client is None:
+            self.sync_client = httpx.Client(timeout=self.timeout, limits=self.limits)
+        return self.sync_client
+
+    @property
+    def aclient(self) -> httpx.AsyncClient:
+        self.reset_after_fork()
+        if self.async_client is None:
+            self.async_client = httpx.AsyncClient(
+                timeout=self.timeout, limits=self.limits
+            )
+        return self.async_client
+
+    def get(self, url: str, **kwargs) -> httpx.Response:
+        return self.client.get(url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> httpx.Response:
+        return self.client.post(url, **kwargs)
+
+    async def get_async(self, url: str, **kwargs) -> httpx.Response:
+        return await self.aclient.get(url, **kwargs)
+
+    async def post_async(self, url: str, **kwargs) -> httpx.Response:
+        return await self.aclient.post(url, **kwargs)
+
+    async def close(self) -> None:
+        """Close the pooled connections, e.g. when the app shuts down"""
+        if self.sync_client is not None:
+            self.sync_client.close()
+        if self.async_client is not None:
+            await self.async_client.aclose()
+
+        self.sync_client = None
+        self.async_client = None
+
+
+mpesa_client = MpesaClient()
@@ -113,6 +113,17 @@ class TransactionServices(str, Enum):
     SESSION = "SESSION"
 
 
+class MpesaCallbackTypes(str, Enum):
+    STKPUSH = "STKPUSH"
+    PAYBILL = "PAYBILL"
+    B2C_RESULT = "B2C_RESULT"
+
+
+class LedgerExportFormats(str, Enum):
+    CSV = "csv"
+    NDJSON = "ndjson"
+
+
 MPESA_WHITE_LISTED_IPS = [
     "196.201.214.200",
     "196.201.214.206",
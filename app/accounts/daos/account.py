@@ -1,13 +1,23 @@
 from sqlalchemy.orm import Session
+from sqlalchemy import Row, String, bindparam, event, func, insert, select, tuple_
+from sqlalchemy.dialects.postgresql import ARRAY, insert as postgresql_insert
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Tuple
 
 # from fastapi import BackgroundTasks
 
 from app.db.dao import CRUDDao
+from app.db.base_class import generate_uuid
+from app.core.config import settings, redis
 from app.core.logger import logger
-from app.accounts.models import Transactions
+from app.core.helpers import generate_transaction_code
+from app.accounts.models import Transactions, WalletBalance
 from app.accounts.serializers.account import (
     TransactionCreateSerializer,
     TransactionUpdateSerializer,
+    WalletBalanceCreateSerializer,
+    WalletBalanceUpdateSerializer,
 )
 from app.accounts.constants import TransactionCashFlow, TransactionServices
 from app.accounts.constants import (
@@ -21,24 +31,247 @@ from app.notifications.serializers.notifications import CreateNotificationSerial
 from app.notifications.constants import NotificationChannels, NotificationTypes
 
 
+# Cache a balance unless the cached balance was saved by a later transaction.
+# Appends to an account are serialized, so the time a balance is saved orders them.
+CACHE_BALANCE_SCRIPT = """
+local cached_at = redis.call('HGET', KEYS[1], 'saved_at')
+if cached_at and tonumber(cached_at) > tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'balance', ARGV[1], 'saved_at', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+
+class WalletBalanceDao(
+    CRUDDao[WalletBalance, WalletBalanceCreateSerializer, WalletBalanceUpdateSerializer]
+):
+    """
+    The balance of each account, kept in the WalletBalance table and cached in Redis.
+
+    Balances saved in a database transaction are written to the cache once it
+    commits. A balance missing from the cache is read from the table and cached,
+    and a periodic check repairs cached balances that drifted from the table.
+    """
+
+    cache_key_prefix = "wallet_balance"
+    uncommitted_balances_key = "uncommitted_wallet_balances"
+    cache_balance_script = redis.register_script(CACHE_BALANCE_SCRIPT)
+
+    def cache_key(self, account: str) -> str:
+        return f"{self.cache_key_prefix}:{account}"
+
+    def get_balance(self, db: Session, *, account: str) -> float:
+        """Get the balance of an account, which is 0 if it has no transactions"""
+        balance = db.execute(
+            select(WalletBalance.balance).where(WalletBalance.account == account)
+        ).scalar_one_or_none()
+
+        return balance if balance is not None else 0.00
+
+    def get_cached_balance(self, db: Session, *, account: str) -> float:
+        """Get the balance of an account from the cache, or from the table on a miss"""
+        cached_balance = redis.hget(self.cache_key(account), "balance")
+        if cached_balance is not None:
+            return float(cached_balance)
+
+        saved_balances = self.get_saved_balances(db, accounts=[account])
+        balance, saved_at = saved_balances.get(account, (0.0, datetime.min))
+        self.cache_balances({account: (balance, saved_at)})
+
+        return balance
+
+    def get_balances(self, db: Session, *, accounts: List[str]) -> Dict[str, float]:
+        """Get the balance of several accounts in one query"""
+        balances = db.execute(
+            select(WalletBalance.account, WalletBalance.balance).where(
+                WalletBalance.account.in_(accounts)
+            )
+        ).all()
+
+        return {account: float(balance) for account, balance in balances}
+
+    def get_saved_balances(
+        self, db: Session, *, accounts: List[str]
+    ) -> Dict[str, Tuple[float, datetime]]:
+        """Get the balance of several accounts with the time each was saved"""
+        saved_balances = db.execute(
+            select(
+                WalletBalance.account,
+                WalletBalance.balance,
+                func.coalesce(WalletBalance.updated_at, WalletBalance.created_at),
+            ).where(WalletBalance.account.in_(accounts))
+        ).all()
+
+        return {
+            account: (float(balance), saved_at)
+            for account, balance, saved_at in saved_balances
+        }
+
+    def save_balances(self, db: Session, balances: Dict[str, float]) -> None:
+        """Insert or replace the balance of each account.
+        The caller is responsible for committing. The balances are cached once committed.
+        """
+        if not balances:
+            return
+
+        now = datetime.now()
+        stmt = postgresql_insert(WalletBalance.__table__).values(
+            [
+                {
+                    "id": generate_uuid(),
+                    "created_at": now,
+                    "account": account,
+                    "balance": balance,
+                }
+                for account, balance in balances.items()
+            ]
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["account"],
+            set_={"balance": stmt.excluded.balance, "updated_at": now},
+        )
+        db.execute(stmt)
+
+        uncommitted_balances = db.info.setdefault(self.uncommitted_balances_key, {})
+        for account, balance in balances.items():
+            uncommitted_balances[account] = (float(balance), now)
+
+    @contextmanager
+    def savepoint(self, db: Session) -> Iterator[None]:
+        """A savepoint whose saved balances are not cached if it is rolled back"""
+        uncommitted_balances = dict(db.info.get(self.uncommitted_balances_key, {}))
+        try:
+            with db.begin_nested():
+                yield
+        except Exception:
+            db.info[self.uncommitted_balances_key] = uncommitted_balances
+            raise
+
+    def cache_balances(self, balances: Dict[str, Tuple[float, datetime]]) -> None:
+        """Cache the (balance, saved_at) of each account"""
+        pipeline = redis.pipeline()
+        for account, (balance, saved_at) in balances.items():
+            self.cache_balance_script(
+                keys=[self.cache_key(account)],
+                args=[
+                    balance,
+                    saved_at.timestamp() if saved_at != datetime.min else 0,
+                    settings.WALLET_BALANCE_CACHE_SECONDS,
+                ],
+                client=pipeline,
+            )
+        pipeline.execute()
+
+    def on_post_delete(self, db: Session, db_obj: WalletBalance) -> None:
+        redis.delete(self.cache_key(db_obj.account))
+
+    def verify_cached_balances(self, db: Session) -> int:
+        """Compare every cached balance with the table and repair those that differ.
+        Returns the number of balances repaired."""
+        repaired = 0
+        cache_keys = list(redis.scan_iter(match=f"{self.cache_key_prefix}:*"))
+        prefix_length = len(self.cache_key_prefix) + 1
+
+        for start in range(
+            0, len(cache_keys), settings.WALLET_BALANCE_CHECK_BATCH_SIZE
+        ):
+            end = start + settings.WALLET_BALANCE_CHECK_BATCH_SIZE
+            batch_keys = cache_keys[start:end]
+
+            pipeline = redis.pipeline()
+            for cache_key in batch_keys:
+                pipeline.hget(cache_key, "balance")
+            cached_balances = pipeline.execute()
+
+            accounts = [cache_key[prefix_length:] for cache_key in batch_keys]
+            saved_balances = self.get_saved_balances(db, accounts=accounts)
+
+            drifted_balances = {}
+            for account, cached_balance in zip(accounts, cached_balances):
+                if cached_balance is None:  # Expired while checking
+                    continue
+
+                balance, saved_at = saved_balances.get(account, (0.0, datetime.min))
+                if float(cached_balance) != balance:
+                    logger.error(
+                        f"Cached balance {cached_balance} of {account} "
+                        f"does not match the saved balance {balance}"
+                    )
+                    drifted_balances[account] = (balance, saved_at)
+
+            # A balance saved after the check started is not replaced
+            self.cache_balances(drifted_balances)
+            repaired += len(drifted_balances)
+
+        return repaired
+
+
+wallet_balance_dao = WalletBalanceDao(WalletBalance)
+
+
+@event.listens_for(Session, "after_commit")
+def cache_committed_balances(db: Session) -> None:
+    """Write the balances saved in a committed database transaction to the cache"""
+    balances = db.info.pop(WalletBalanceDao.uncommitted_balances_key, None)
+    if not balances:
+        return
+
+    try:
+        wallet_balance_dao.cache_balances(balances)
+    except Exception as e:
+        # The cached balances expire or are repaired by the periodic check
+        logger.error(f"Exception {e} while caching wallet balances")
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_uncommitted_balances(db: Session) -> None:
+    db.info.pop(WalletBalanceDao.uncommitted_balances_key, None)
+
+
 class TransactionDao(
     CRUDDao[Transactions, TransactionCreateSerializer, TransactionUpdateSerializer]
 ):
+    # Columns of the ledger export. The keyset columns must be included
+    ledger_columns = [
+        "account",
+        "created_at",
+        "id",
+        "transaction_id",
+        "external_transaction_id",
+        "cash_flow",
+        "type",
+        "service",
+        "status",
+        "amount",
+        "charge",
+        "initial_balance",
+        "final_balance",
+        "description",
+    ]
+
     def on_pre_create(
         self, db: Session, id: str, values: dict, orig_values: dict
     ) -> None:
-        """Calculate total charge before creating transaction instance"""
+        """Calculate total charge before creating transaction instance.
+        The account's balance is updated in the same database transaction.
+        Appends to the same account are serialized by a lock held until commit,
+        so concurrent writers never read the same previous balance."""
         logger.info("Creating a transaction instance...")
-        latest_transactions = self.search(
-            db, {"order_by": ["-created_at"], "account": values["account"]}
+        self.lock_accounts(db, accounts=[values["account"]])
+        initial_final_balance = float(
+            wallet_balance_dao.get_balance(db, account=values["account"])
         )
 
-        initial_final_balance = 0.0
-        charge = 0.0
+        self.set_balance_values(values, initial_final_balance)
+        wallet_balance_dao.save_balances(
+            db, {values["account"]: values["final_balance"]}
+        )
 
-        if latest_transactions:
-            latest_transaction = latest_transactions[0]
-            initial_final_balance = float(latest_transaction.final_balance)
+    def set_balance_values(self, values: dict, initial_final_balance: float) -> None:
+        """Set the charge and the balances of a transaction given the previous balance"""
+        charge = 0.0
 
         if values["cash_flow"] == TransactionCashFlow.INWARD.value:
             charge = values["amount"] - values["fee"] - values["tax"]
@@ -109,17 +342,141 @@ class TransactionDao(
                 ),
             )
 
-    def get_user_balance(self, db: Session, *, account: str) -> float:
-        latest_transactions = self.search(
-            db, {"order_by": ["-created_at"], "account": account}
+    def lock_accounts(self, db: Session, *, accounts: List[str]) -> None:
+        """Hold an advisory lock on each account until the caller commits.
+        An advisory lock also covers accounts that do not have a WalletBalance row yet.
+        Accounts are locked in sorted order, in one statement, so that concurrent
+        callers can not deadlock.
+        """
+        if not accounts:
+            return
+
+        account = func.unnest(
+            bindparam("accounts", sorted(accounts), type_=ARRAY(String))
+        ).column_valued("account")
+        db.execute(
+            select(func.pg_advisory_xact_lock(func.hashtext(account))).order_by(account)
         )
-        current_balance = 0.00
 
-        if latest_transactions:
-            latest_transaction = latest_transactions[0]
-            current_balance = latest_transaction.final_balance
+    def create_many(
+        self, db: Session, *, objs_in: List[TransactionCreateSerializer]
+    ) -> None:
+        """Insert several transactions with one multi-row insert.
+        The caller is responsible for committing and for sending notifications."""
+        logger.info(f"Creating {len(objs_in)} transaction instances...")
+        if not objs_in:
+            return
+
+        accounts = list({obj_in.account for obj_in in objs_in})
+        self.lock_accounts(db, accounts=accounts)
+
+        balances = wallet_balance_dao.get_balances(db, accounts=accounts)
+        model_columns = self.model.get_model_columns()
+        used_codes = set()
+
+        def unique_code(code: str) -> str:
+            """Codes are time based so they can repeat when generated in a tight loop"""
+            while code in used_codes:
+                code = generate_transaction_code()
+            used_codes.add(code)
+            return code
+
+        # Transactions of the same account are chained by created_at,
+        # so give each row a distinct and increasing timestamp
+        created_at = datetime.now()
+        rows = []
+
+        for index, obj_in in enumerate(objs_in):
+            values = {
+                key: value
+                for key, value in obj_in.dict(exclude_none=True).items()
+                if key in model_columns
+            }
+            self.set_balance_values(values, balances.get(values["account"], 0.0))
+            balances[values["account"]] = values["final_balance"]
+
+            values["id"] = generate_uuid()
+            values["created_at"] = created_at + timedelta(microseconds=index)
+            values["transaction_id"] = unique_code(generate_transaction_code())
+            values["external_transaction_id"] = unique_code(
+                values["external_transaction_id"]
+            )
+            rows.append(values)
+
+        db.execute(insert(self.model.__table__), rows)
+        wallet_balance_dao.save_balances(
+            db, {account: balances[account] for account in accounts}
+        )
+
+    def get_user_balance(
+        self, db: Session, *, account: str, cached: bool = True
+    ) -> float:
+        """Get the balance of an account. Pass cached=False where the balance
+        must be read from the database, e.g. before a withdrawal"""
+        if cached:
+            return wallet_balance_dao.get_cached_balance(db, account=account)
+
+        return wallet_balance_dao.get_balance(db, account=account)
+
+    def get_statement(
+        self,
+        db: Session,
+        *,
+        account: str,
+        limit: int,
+        after: Tuple[datetime, str] | None = None,
+    ) -> List[Transactions]:
+        """Get a page of an account's transactions, newest first.
+        A page starts after the (created_at, id) of the last row of the previous
+        page, so every page is one range scan of the keyset index."""
+        query = select(Transactions).where(Transactions.account == account)
+        if after is not None:
+            query = query.where(
+                tuple_(Transactions.created_at, Transactions.id) < after
+            )
+
+        return db.scalars(
+            query.order_by(
+                Transactions.created_at.desc(), Transactions.id.desc()
+            ).limit(limit)
+        ).all()
+
+    def stream_ledger(
+        self,
+        db: Session,
+        *,
+        account: str | None = None,
+        batch_size: int | None = None,
+    ) -> Iterator[Row]:
+        """Yield the ledger_columns of every transaction in (account, created_at, id) order.
+        Pages are read by keyset through a server-side cursor,
+        so only one page of the ledger is held in memory at a time."""
+        batch_size = batch_size or settings.LEDGER_EXPORT_BATCH_SIZE
+        keyset = (Transactions.account, Transactions.created_at, Transactions.id)
+        after = None
+
+        while True:
+            query = select(
+                *[getattr(Transactions, column) for column in self.ledger_columns]
+            )
+            if account is not None:
+                query = query.where(Transactions.account == account)
+            if after is not None:
+                query = query.where(tuple_(*keyset) > after)
+
+            total_rows = 0
+            rows = db.execute(
+                query.order_by(*keyset)
+                .limit(batch_size)
+                .execution_options(yield_per=batch_size)
+            )
+            for row in rows:
+                total_rows += 1
+                after = (row.account, row.created_at, row.id)
+                yield row
 
-        return current_balance
+            if total_rows < batch_size:
+                return
 
 
 transaction_dao = TransactionDao(Transactions)
@@ -1,14 +1,19 @@
 from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from datetime import datetime
 
 from app.core.config import settings
 from app.db.dao import CRUDDao, ChangedObjState
-from app.accounts.models import MpesaPayments, Withdrawals
+from app.commons.utils import generate_uuid
+from app.accounts.models import MpesaPayments, Withdrawals, MpesaCallbacks
 from app.accounts.daos.account import transaction_dao
 from app.accounts.serializers.mpesa import (
     MpesaPaymentCreateSerializer,
     MpesaPaymentUpdateSerializer,
     WithdrawalCreateSerializer,
     WithdrawalUpdateSerializer,
+    MpesaCallbackCreateSerializer,
+    MpesaCallbackUpdateSerializer,
 )
 from app.accounts.serializers.account import TransactionCreateSerializer
 from app.accounts.constants import (
@@ -60,7 +65,10 @@ class WithdrawalDao(
     def on_post_update(
         self, db: Session, db_obj: Withdrawals, changed: ChangedObjState
     ) -> None:
+        self.create_withdrawal_transaction(db, db_obj)
 
+    def create_withdrawal_transaction(self, db: Session, db_obj: Withdrawals) -> None:
+        """Record a successful withdrawal in the ledger"""
         if (
             db_obj.result_code == 0  # If Mpesa transacation is successful
             and db_obj.transaction_id is not None  # Must have a valid M-Pesa Reference
@@ -88,3 +96,29 @@ class WithdrawalDao(
 
 
 withdrawal_dao = WithdrawalDao(Withdrawals)
+
+
+class MpesaCallbackDao(
+    CRUDDao[
+        MpesaCallbacks, MpesaCallbackCreateSerializer, MpesaCallbackUpdateSerializer
+    ]
+):
+    def record(self, db: Session, *, callback_type: str, idempotency_key: str) -> bool:
+        """Record a processed callback. Returns False if it was already recorded,
+        e.g. by a duplicate processed at the same time. The caller is responsible
+        for committing."""
+        stmt = (
+            postgresql_insert(MpesaCallbacks.__table__)
+            .values(
+                id=generate_uuid(),
+                created_at=datetime.now(),
+                callback_type=callback_type,
+                idempotency_key=idempotency_key,
+            )
+            .on_conflict_do_nothing(index_elements=["idempotency_key"])
+            .returning(MpesaCallbacks.id)
+        )
+        return db.execute(stmt).first() is not None
+
+
+mpesa_callback_dao = MpesaCallbackDao(MpesaCallbacks)
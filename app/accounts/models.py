@@ -3,12 +3,18 @@ from app.accounts.constants import TransactionStatuses
 from app.core.helpers import generate_transaction_code
 from app.core.config import settings
 
-from sqlalchemy import String, Numeric, text, Text, JSON, Integer, Float, Boolean
+from sqlalchemy import String, Numeric, text, Text, JSON, Integer, Float, Boolean, Index
 from sqlalchemy.orm import mapped_column
 from sqlalchemy import DateTime
 
 
 class Transactions(Base):
+    # Wallet statements and the ledger export page through an account's
+    # transactions in (created_at, id) order
+    __table_args__ = (
+        Index("ix_transactions_account_created_at_id", "account", "created_at", "id"),
+    )
+
     transaction_id = mapped_column(
         String, nullable=False, unique=True, default=generate_transaction_code
     )
@@ -51,6 +57,17 @@ class Transactions(Base):
     external_response = mapped_column(JSON, nullable=True)
 
 
+class WalletBalance(Base):
+    """The current balance of each account.
+    Updated in the same database transaction as every Transactions insert,
+    so a balance is read with one lookup instead of the account's history"""
+
+    account = mapped_column(String, nullable=False, unique=True)
+    balance = mapped_column(
+        Numeric, nullable=False, server_default=text("0.0"), default=0
+    )
+
+
 class MpesaPayments(Base):
     """
     Records for Payment done through Mpesa.
@@ -225,3 +242,12 @@ class Withdrawals(Base):
     )
     is_mpesa_registered_customer = mapped_column(Boolean, nullable=True)
     external_response = mapped_column(JSON, nullable=True)
+
+
+class MpesaCallbacks(Base):
+    """Callbacks that M-Pesa delivered and were processed.
+    M-Pesa retries a callback with the same id, so the unique idempotency_key
+    makes sure a retried callback is only processed once."""
+
+    callback_type = mapped_column(String, nullable=False)
+    idempotency_key = mapped_column(String, nullable=False, unique=True)
@@ -0,0 +1,251 @@
+"""
+Reconcile the ledger.
+
+Every check is one set-based query over the whole ledger, run in a single
+read-only snapshot, so transactions created while it runs are never reported
+as drift. Only the rows that fail a check are returned to Python.
+"""
+from typing import Dict, List
+
+from sqlalchemy import Numeric, and_, case, cast, func, or_, select, text
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.core.logger import logger
+from app.accounts.constants import (
+    TransactionCashFlow,
+    TransactionTypes,
+    TransactionServices,
+)
+from app.accounts.models import (
+    Transactions,
+    WalletBalance,
+    MpesaPayments,
+    Withdrawals,
+)
+
+
+def money(column) -> Numeric:
+    """Round a monetary column so that float and numeric columns compare equal"""
+    return func.round(
+        cast(func.coalesce(column, 0), Numeric), settings.MONETARY_DECIMAL_PLACES
+    )
+
+
+class LedgerReconciliation:
+    """Validate the balances chained through the ledger and its M-Pesa records"""
+
+    def get_drifted_accounts(self, db: Session) -> List[Dict]:
+        """
+        Accounts with a transaction that does not follow from the one before it.
+
+        A transaction drifts if its initial_balance is not the previous
+        final_balance of the account, if its charge does not add up from
+        amount, fee and tax, or if its final_balance is not its initial_balance
+        moved by its charge.
+        """
+        is_inward = Transactions.cash_flow == TransactionCashFlow.INWARD.value
+        ledger = select(
+            Transactions.account,
+            Transactions.created_at,
+            money(Transactions.initial_balance).label("initial_balance"),
+            money(Transactions.final_balance).label("final_balance"),
+            money(Transactions.charge).label("charge"),
+            money(
+                func.coalesce(
+                    func.lag(Transactions.final_balance).over(
+                        partition_by=Transactions.account,
+                        order_by=(Transactions.created_at, Transactions.id),
+                    ),
+                    0,
+                )
+            ).label("previous_final_balance"),
+            case(
+                (
+                    is_inward,
+                    money(Transactions.amount)
+                    - money(Transactions.fee)
+                    - money(Transactions.tax),
+                ),
+                else_=money(Transactions.amount)
+                + money(Transactions.fee)
+                + money(Transactions.tax),
+            ).label("expected_charge"),
+            case((is_inward, 1), else_=-1).label("direction"),
+        ).subquery()
+
+        drifted = or_(
+            ledger.c.initial_balance != ledger.c.previous_final_balance,
+            ledger.c.charge != ledger.c.expected_charge,
+            ledger.c.final_balance
+            != ledger.c.initial_balance + ledger.c.direction * ledger.c.charge,
+        )
+        rows = db.execute(
+            select(
+                ledger.c.account,
+                func.count().label("drifted_transactions"),
+                func.min(ledger.c.created_at).label("first_drifted_at"),
+            )
+            .where(drifted)
+            .group_by(ledger.c.account)
+            .order_by(ledger.c.account)
+        ).all()
+
+        return [dict(row._mapping) for row in rows]
+
+    def get_balance_mismatches(self, db: Session) -> List[Dict]:
+        """Accounts whose WalletBalance is not the final_balance of their latest transaction"""
+        latest_balances = (
+            select(
+                Transactions.account,
+                money(Transactions.final_balance).label("ledger_balance"),
+            )
+            .order_by(
+                Transactions.account,
+                Transactions.created_at.desc(),
+                Transactions.id.desc(),
+            )
+            .distinct(Transactions.account)
+            .subquery()
+        )
+        ledger_balance = func.coalesce(latest_balances.c.ledger_balance, 0)
+        wallet_balance = money(WalletBalance.balance)
+
+        rows = db.execute(
+            select(
+                func.coalesce(latest_balances.c.account, WalletBalance.account).label(
+                    "account"
+                ),
+                ledger_balance.label("ledger_balance"),
+                wallet_balance.label("wallet_balance"),
+            )
+            .select_from(latest_balances)
+            .join(
+                WalletBalance,
+                WalletBalance.account == latest_balances.c.account,
+                full=True,
+            )
+            .where(ledger_balance != wallet_balance)
+            .order_by("account")
+        ).all()
+
+        return [dict(row._mapping) for row in rows]
+
+    def get_unmatched_mpesa_payments(self, db: Session) -> List[Dict]:
+        """Successful STKPush payments without a matching deposit in the ledger"""
+        rows = db.execute(
+            select(
+                MpesaPayments.id,
+                MpesaPayments.phone_number,
+                MpesaPayments.receipt_number,
+                money(MpesaPayments.amount).label("amount"),
+                Transactions.id.label("transaction_id"),
+            )
+            .outerjoin(
+                Transactions,
+                Transactions.external_transaction_id == MpesaPayments.receipt_number,
+            )
+            .where(
+                MpesaPayments.result_code == 0,
+                MpesaPayments.receipt_number.is_not(None),
+            )
+            .where(
+                or_(
+                    Transactions.id.is_(None),
+                    Transactions.account != MpesaPayments.phone_number,
+                    Transactions.type != TransactionTypes.DEPOSIT.value,
+                    money(Transactions.amount) != money(MpesaPayments.amount),
+                )
+            )
+            .order_by(MpesaPayments.created_at)
+        ).all()
+
+        return [dict(row._mapping) for row in rows]
+
+    def get_unmatched_withdrawals(self, db: Session) -> List[Dict]:
+        """Successful B2C payments without a matching withdrawal in the ledger"""
+        rows = db.execute(
+            select(
+                Withdrawals.id,
+                Withdrawals.phone_number,
+                Withdrawals.transaction_id.label("receipt_number"),
+                money(Withdrawals.transaction_amount).label("amount"),
+                Transactions.id.label("transaction_id"),
+            )
+            .outerjoin(
+                Transactions,
+                Transactions.external_transaction_id == Withdrawals.transaction_id,
+            )
+            .where(
+                Withdrawals.result_code == 0,
+                Withdrawals.transaction_id.is_not(None),
+                Withdrawals.transaction_amount.is_not(None),
+            )
+            .where(
+                or_(
+                    Transactions.id.is_(None),
+                    Transactions.account != Withdrawals.phone_number,
+                    Transactions.type != TransactionTypes.WITHDRAWAL.value,
+                    money(Transactions.amount) != money(Withdrawals.transaction_amount),
+                )
+            )
+            .order_by(Withdrawals.created_at)
+        ).all()
+
+        return [dict(row._mapping) for row in rows]
+
+    def get_unmatched_withdrawal_transactions(self, db: Session) -> List[Dict]:
+        """M-Pesa withdrawals in the ledger without a successful B2C payment"""
+        rows = db.execute(
+            select(
+                Transactions.id,
+                Transactions.account,
+                Transactions.external_transaction_id,
+                money(Transactions.amount).label("amount"),
+            )
+            .outerjoin(
+                Withdrawals,
+                and_(
+                    Withdrawals.transaction_id == Transactions.external_transaction_id,
+                    Withdrawals.result_code == 0,
+                ),
+            )
+            .where(
+                Transactions.type == TransactionTypes.WITHDRAWAL.value,
+                Transactions.service == TransactionServices.MPESA.value,
+                Withdrawals.id.is_(None),
+            )
+            .order_by(Transactions.created_at)
+        ).all()
+
+        return [dict(row._mapping) for row in rows]
+
+    def run(self, db: Session) -> Dict[str, List[Dict]]:
+        """Run every check against one snapshot of the database"""
+        db.execute(text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY"))
+        try:
+            # The checks aggregate the whole ledger, which takes longer than the
+            # statement timeout of the engine
+            timeout_ms = int(settings.LEDGER_RECONCILIATION_TIMEOUT_SECONDS * 1000)
+            db.execute(text(f"SET LOCAL statement_timeout = {timeout_ms}"))
+
+            report = {
+                "drifted_accounts": self.get_drifted_accounts(db),
+                "balance_mismatches": self.get_balance_mismatches(db),
+                "unmatched_mpesa_payments": self.get_unmatched_mpesa_payments(db),
+                "unmatched_withdrawals": self.get_unmatched_withdrawals(db),
+                "unmatched_withdrawal_transactions": (
+                    self.get_unmatched_withdrawal_transactions(db)
+                ),
+            }
+        finally:
+            db.rollback()
+
+        for check, rows in report.items():
+            for row in rows:
+                logger.error(f"Ledger reconciliation {check}: {row}")
+
+        return report
+
+
+ledger_reconciliation = LedgerReconciliation()
@@ -1,32 +1,57 @@
-from fastapi import Request, APIRouter, Depends, HTTPException, status, BackgroundTasks
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import (
+    Request,
+    APIRouter,
+    Depends,
+    HTTPException,
+    Query,
+    status,
+    BackgroundTasks,
+)
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from sqlalchemy.orm import Session
+from typing import Iterator
 import phonenumbers
+import json
+import csv
+import io
 
 from app.users.models import User
 from app.errors.custom import ErrorCodes
-from app.accounts.serializers.account import DepositSerializer, WithdrawSerializer
+from app.accounts.serializers.account import (
+    DepositSerializer,
+    WithdrawSerializer,
+    TransactionStatementSerializer,
+    WalletStatementSerializer,
+)
 from app.accounts.utils import (
-    trigger_mpesa_stkpush_payment,
-    process_mpesa_stk,
-    process_mpesa_paybill_payment,
+    trigger_mpesa_stkpush_payment_async,
     process_b2c_payment,
-    process_b2c_payment_result,
 )
+from app.accounts.callbacks import mpesa_callback_stream
 from app.accounts.daos.account import transaction_dao
 from app.accounts.serializers.mpesa import (
     MpesaPaymentResultSerializer,
     MpesaDirectPaymentSerializer,
     WithdrawalResultSerializer,
 )
-from app.accounts.constants import MPESA_WHITE_LISTED_IPS
+from app.accounts.constants import (
+    MPESA_WHITE_LISTED_IPS,
+    LedgerExportFormats,
+    MpesaCallbackTypes,
+)
 
-from app.core.helpers import md5_hash, get_mpesa_client_ip_address
+from app.core.helpers import (
+    md5_hash,
+    get_mpesa_client_ip_address,
+    encode_keyset_cursor,
+    decode_keyset_cursor,
+)
 from app.core.raw_logger import logger
 from app.core.logger import LoggingRoute
 from app.core.ratelimiter import limiter
 from app.core.config import templates, settings, redis
-from app.core.deps import get_current_active_user, get_db
+from app.core.deps import get_current_active_user, get_current_active_superuser, get_db
+from app.db.session import SessionLocal
 
 router = APIRouter(route_class=LoggingRoute)
 template_prefix = "accounts/templates/"
@@ -40,11 +65,9 @@ async def get_wallet(
 ):
     """Get wallet page"""
     wallet_balance = transaction_dao.get_user_balance(db, account=user.phone)
-    transaction_history = transaction_dao.search(
-        db, {"order_by": ["-created_at"], "account": user.phone}
-    )[
-        :7
-    ]  # Show only 7 transactions due to design limitations
+    transaction_history = transaction_dao.get_statement(
+        db, account=user.phone, limit=7
+    )  # Show only 7 transactions due to design limitations
 
     return templates.TemplateResponse(
         f"{template_prefix}wallet.html",
@@ -57,6 +80,89 @@ async def get_wallet(
     )
 
 
+@router.get("/wallet/statement/", response_model=WalletStatementSerializer)
+async def get_wallet_statement(
+    user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db),
+    cursor: str | None = None,
+    limit: int = Query(
+        default=settings.WALLET_STATEMENT_PAGE_SIZE,
+        ge=1,
+        le=settings.WALLET_STATEMENT_MAX_PAGE_SIZE,
+    ),
+):
+    """Get the user's transactions, newest first.
+    Pass the next_cursor of a page to get the page after it."""
+    after = decode_keyset_cursor(cursor) if cursor else None
+    transactions = transaction_dao.get_statement(
+        db, account=user.phone, limit=limit, after=after
+    )
+
+    next_cursor = None
+    if len(transactions) == limit:
+        next_cursor = encode_keyset_cursor(
+            transactions[-1].created_at, transactions[-1].id
+        )
+
+    return WalletStatementSerializer(
+        transactions=[
+            TransactionStatementSerializer.from_orm(transaction)
+            for transaction in transactions
+        ],
+        next_cursor=next_cursor,
+    )
+
+
+def stream_ledger_export(
+    export_format: LedgerExportFormats, account: str | None
+) -> Iterator[str]:
+    """Stream the ledger one line at a time from its own database session,
+    since the request's session is closed before the response is streamed."""
+    columns = transaction_dao.ledger_columns
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def write_csv_line(values: list) -> str:
+        writer.writerow(values)
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+        return line
+
+    if export_format == LedgerExportFormats.CSV:
+        yield write_csv_line(columns)
+
+    with SessionLocal() as db:
+        for row in transaction_dao.stream_ledger(db, account=account):
+            if export_format == LedgerExportFormats.CSV:
+                yield write_csv_line(list(row))
+            else:
+                yield json.dumps(dict(row._mapping), default=str) + "\n"
+
+
+@router.get("/transactions/export/")
+async def get_transactions_export(
+    _: User = Depends(get_current_active_superuser),
+    export_format: LedgerExportFormats = Query(
+        default=LedgerExportFormats.CSV, alias="format"
+    ),
+    account: str | None = None,
+):
+    """Export the ledger, or one account's transactions, as CSV or NDJSON"""
+    media_type = {
+        LedgerExportFormats.CSV: "text/csv",
+        LedgerExportFormats.NDJSON: "application/x-ndjson",
+    }[export_format]
+
+    return StreamingResponse(
+        stream_ledger_export(export_format, account),
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f"attachment; filename=transactions.{export_format.value}"
+        },
+    )
+
+
 @router.get("/deposit/", response_class=HTMLResponse)
 async def get_deposit(
     request: Request,
@@ -87,7 +193,9 @@ async def post_deposit(
 ):
     """Post deposit amount page: User makes this post to receive an STKPush on their device"""
     background_tasks.add_task(
-        trigger_mpesa_stkpush_payment, amount=deposit.amount, phone_number=user.phone
+        trigger_mpesa_stkpush_payment_async,
+        amount=deposit.amount,
+        phone_number=user.phone,
     )
 
     # data = trigger_mpesa_stkpush_payment(amount=deposit.amount, phone_number=user.phone)
@@ -143,7 +251,9 @@ async def post_withdraw(
     withdraw: WithdrawSerializer = Depends(),
 ):
     """Request withdrawal amount"""
-    user_balance = transaction_dao.get_user_balance(db, account=user.phone)
+    user_balance = transaction_dao.get_user_balance(
+        db, account=user.phone, cached=False
+    )
     total_withdraw_charge = settings.MPESA_B2C_CHARGE + withdraw.amount
 
     if user_balance < total_withdraw_charge:
@@ -192,8 +302,6 @@ async def post_callback(
     request: Request,
     *,
     mpesa_response_in: MpesaPaymentResultSerializer,
-    background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db),
 ):
     """CallBack URL is used to receive responses for STKPush from M-Pesa"""
     logger.info(f"Received STKPush callback request from {request.headers}")
@@ -204,15 +312,13 @@ async def post_callback(
     if client_host not in MPESA_WHITE_LISTED_IPS:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
 
-    background_tasks.add_task(process_mpesa_stk, db, mpesa_response_in.Body.stkCallback)
+    mpesa_callback_stream.add(MpesaCallbackTypes.STKPUSH, mpesa_response_in)
 
 
 @router.post("/payments/confirmation/")
 async def post_confirmation(
     request: Request,
     paybill_response_in: MpesaDirectPaymentSerializer,
-    background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db),
 ):
     """Confirmation URL is used to receive responses for direct paybill payments from M-Pesa"""
     logger.info(f"Received Paybill payment confirmation request from {request.headers}")
@@ -223,15 +329,13 @@ async def post_confirmation(
     if client_host not in MPESA_WHITE_LISTED_IPS:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
 
-    background_tasks.add_task(process_mpesa_paybill_payment, db, paybill_response_in)
+    mpesa_callback_stream.add(MpesaCallbackTypes.PAYBILL, paybill_response_in)
 
 
 @router.post("/payments/result/")
 async def post_withdrawal_result(
     request: Request,
     withdrawal_response_in: WithdrawalResultSerializer,
-    background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db),
 ):
     """Callback URL to receive response after posting withdrawal request to M-Pesa"""
     logger.info(f"Received withdrawal confirmation request from {request.headers}")
@@ -241,9 +345,7 @@ async def post_withdrawal_result(
     if client_host not in MPESA_WHITE_LISTED_IPS:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
 
-    background_tasks.add_task(
-        process_b2c_payment_result, db, withdrawal_response_in.Result
-    )
+    mpesa_callback_stream.add(MpesaCallbackTypes.B2C_RESULT, withdrawal_response_in)
 
 
 @router.post("/payments/timeout/")
@@ -10,6 +10,8 @@ from app.accounts.constants import TransactionStatuses
 from fastapi import Form
 from pydantic.dataclasses import dataclass
 from pydantic import BaseModel, Json
+from typing import List
+from datetime import datetime
 
 
 @dataclass
@@ -47,3 +49,38 @@ class TransactionCreateSerializer(TransactionBaseSerializer):
 
 class TransactionUpdateSerializer(TransactionBaseSerializer):
     pass
+
+
+class WalletBalanceBaseSerializer(BaseModel):
+    account: str
+    balance: float = 0.0
+
+
+class WalletBalanceCreateSerializer(WalletBalanceBaseSerializer):
+    pass
+
+
+class WalletBalanceUpdateSerializer(WalletBalanceBaseSerializer):
+    pass
+
+
+class TransactionStatementSerializer(BaseModel):
+    id: str
+    created_at: datetime
+    transaction_id: str
+    cash_flow: str
+    type: str
+    service: str
+    status: str
+    amount: float | None
+    charge: float | None
+    final_balance: float
+    description: str
+
+    class Config:
+        orm_mode = True
+
+
+class WalletStatementSerializer(BaseModel):
+    transactions: List[TransactionStatementSerializer]
+    next_cursor: str | None = None
@@ -114,3 +114,16 @@ class WithdrawalResultBodySerializer(BaseModel):
 
 class WithdrawalResultSerializer(BaseModel):
     Result: WithdrawalResultBodySerializer
+
+
+class MpesaCallbackBaseSerializer(BaseModel):
+    callback_type: str
+    idempotency_key: str
+
+
+class MpesaCallbackCreateSerializer(MpesaCallbackBaseSerializer):
+    pass
+
+
+class MpesaCallbackUpdateSerializer(MpesaCallbackBaseSerializer):
+    pass
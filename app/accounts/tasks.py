@@ -0,0 +1,70 @@
+import os
+import socket
+from typing import Dict
+
+from app.core.celery_app import celery
+from app.core.logger import logger
+from app.db.session import SessionLocal
+from app.accounts.daos.account import wallet_balance_dao
+from app.accounts.reconciliation import ledger_reconciliation
+from app.accounts.utils import renew_mpesa_access_token
+from app.accounts.callbacks import mpesa_callback_stream
+from app.core.config import settings
+
+
+@celery.task(name=__name__ + ".verify_wallet_balance_cache_task", max_retries=0)
+def verify_wallet_balance_cache_task() -> int:
+    """Periodically repair cached wallet balances that drifted from the database"""
+    logger.info("Initiating verify wallet balance cache celery task")
+
+    with SessionLocal() as db:
+        repaired = wallet_balance_dao.verify_cached_balances(db)
+
+    logger.info(f"Repaired {repaired} cached wallet balances")
+    return repaired
+
+
+@celery.task(name=__name__ + ".reconcile_ledger_task", max_retries=0)
+def reconcile_ledger_task() -> Dict[str, int]:
+    """Nightly check that the ledger chains correctly and matches M-Pesa records"""
+    logger.info("Initiating reconcile ledger celery task")
+
+    with SessionLocal() as db:
+        report = ledger_reconciliation.run(db)
+
+    totals = {check: len(rows) for check, rows in report.items()}
+    logger.info(f"Reconciled the ledger: {totals}")
+    return totals
+
+
+@celery.task(name=__name__ + ".renew_mpesa_access_tokens_task", max_retries=0)
+def renew_mpesa_access_tokens_task() -> Dict[str, bool]:
+    """Renew the M-Pesa tokens before they expire so that payments never wait for one"""
+    logger.info("Initiating renew M-Pesa access tokens celery task")
+
+    return {
+        "mpesa_access_token": renew_mpesa_access_token(),
+        "mpesa_b2c_access_token": renew_mpesa_access_token(
+            MPESA_CONSUMER_KEY=settings.MPESA_B2C_CONSUMER_KEY,
+            MPESA_SECRET=settings.MPESA_B2C_SECRET,
+            IS_B2C=True,
+        ),
+    }
+
+
+@celery.task(name=__name__ + ".process_mpesa_callbacks_task", max_retries=0)
+def process_mpesa_callbacks_task() -> int:
+    """Process queued M-Pesa callbacks until a batch comes back short.
+    Routes wake this task, and it also runs periodically to retry failed callbacks."""
+    logger.info("Initiating process M-Pesa callbacks celery task")
+    consumer = f"{socket.gethostname()}:{os.getpid()}"
+
+    total_processed = 0
+    while True:
+        processed = mpesa_callback_stream.process_pending(consumer=consumer)
+        total_processed += processed
+        if processed < settings.MPESA_CALLBACK_BATCH_SIZE:
+            break
+
+    logger.info(f"Processed {total_processed} M-Pesa callbacks")
+    return total_processed
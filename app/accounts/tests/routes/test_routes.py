@@ -1,9 +1,14 @@
+import json
 from fastapi.testclient import TestClient
 from pytest_mock import MockerFixture
 from sqlalchemy.orm import Session
 from typing import Callable
 
+from app.main import app
 from app.accounts.daos.mpesa import mpesa_payment_dao
+from app.accounts.callbacks import mpesa_callback_stream
+from app.accounts.daos.account import transaction_dao
+from app.accounts.serializers.account import TransactionCreateSerializer
 from app.accounts.constants import MPESA_WHITE_LISTED_IPS
 from app.accounts.serializers.mpesa import MpesaPaymentCreateSerializer
 from app.accounts.tests.test_data import (
@@ -11,18 +16,37 @@ from app.accounts.tests.test_data import (
     mock_stk_push_result,
     sample_paybill_deposit_response,
     sample_successful_b2c_result,
+    sample_positive_transaction_instance_info,
 )
 
 from app.errors.custom import ErrorCodes
 from app.core.config import settings, redis
 from app.core.helpers import md5_hash
+from app.core.deps import get_current_active_superuser
+
+
+def create_deposits(db: Session, account: str, total: int) -> None:
+    transaction_dao.create_many(
+        db,
+        objs_in=[
+            TransactionCreateSerializer(
+                **{
+                    **sample_positive_transaction_instance_info,
+                    "account": account,
+                    "external_transaction_id": f"{account}-{index}",
+                }
+            )
+            for index in range(total)
+        ],
+    )
+    db.commit()
 
 
 def test_post_deposit_creates_model_instance(
     db: Session, client: TestClient, mocker: MockerFixture
 ) -> None:
     mocker.patch(
-        "app.accounts.utils.initiate_mpesa_stkpush_payment",
+        "app.accounts.utils.initiate_mpesa_stkpush_payment_async",
         return_value=mock_stk_push_response,
     )
 
@@ -148,16 +172,22 @@ def test_post_withdraw_succeeds_in_calling_process_b2c_payment(
 
 
 def test_post_withdrawal_result_successfully_calls_process_b2c_payment_result_func(
-    client: TestClient, mocker: MockerFixture
+    client: TestClient,
+    mocker: MockerFixture,
+    flush_redis: Callable,
+    delete_mpesa_callback_model_instances: Callable,
 ) -> None:
     mock_client = mocker.patch("fastapi.Request.client")
     mock_client.host = MPESA_WHITE_LISTED_IPS[0]
+    mock_schedule = mocker.patch.object(mpesa_callback_stream, "schedule")
 
     mock_process_b2c_payment_result = mocker.patch(
-        "app.accounts.routes.account.process_b2c_payment_result", return_value=None
+        "app.accounts.callbacks.process_b2c_payment_result", return_value=None
     )
     client.post("/accounts/payments/result/", json=sample_successful_b2c_result)
+    mpesa_callback_stream.process_pending(consumer="test")
 
+    assert mock_schedule.call_count == 1
     assert mock_process_b2c_payment_result.call_count == 1
 
 
@@ -169,3 +199,71 @@ def test_post_withdrawal_result_successfully_fails_with_http_exception(
     )
 
     assert "Forbidden" in response.context["server_errors"]
+
+
+def test_get_wallet_statement_pages_through_transactions(
+    db: Session, client: TestClient, delete_transcation_model_instances: Callable
+) -> None:
+    """Assert that following next_cursor returns every transaction once, newest first"""
+    create_deposits(db, settings.SUPERUSER_PHONE, 5)
+    create_deposits(db, "+254700000001", 2)
+
+    transaction_ids, cursor = [], None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        response = client.get("/accounts/wallet/statement/", params=params).json()
+        transaction_ids += [
+            transaction["id"] for transaction in response["transactions"]
+        ]
+        cursor = response["next_cursor"]
+        if cursor is None:
+            break
+
+    transactions = transaction_dao.search(
+        db, {"order_by": ["-created_at"], "account": settings.SUPERUSER_PHONE}
+    )
+    assert transaction_ids == [transaction.id for transaction in transactions]
+
+
+def test_get_wallet_statement_rejects_invalid_cursor(client: TestClient) -> None:
+    response = client.get("/accounts/wallet/statement/", params={"cursor": "invalid"})
+
+    assert (
+        ErrorCodes.INVALID_PAGINATION_CURSOR.value in response.context["server_errors"]
+    )
+
+
+def test_get_transactions_export_streams_every_transaction(
+    db: Session,
+    client: TestClient,
+    mocker: MockerFixture,
+    delete_transcation_model_instances: Callable,
+) -> None:
+    """Assert that the export spans several keyset pages in ledger order"""
+    mocker.patch.object(settings, "LEDGER_EXPORT_BATCH_SIZE", 2)
+    create_deposits(db, settings.SUPERUSER_PHONE, 3)
+    create_deposits(db, "+254700000001", 2)
+    app.dependency_overrides[get_current_active_superuser] = lambda: None
+
+    csv_response = client.get("/accounts/transactions/export/")
+    ndjson_response = client.get(
+        "/accounts/transactions/export/",
+        params={"format": "ndjson", "account": "+254700000001"},
+    )
+    app.dependency_overrides.pop(get_current_active_superuser)
+
+    transactions = transaction_dao.search(
+        db, {"order_by": ["account", "created_at", "id"]}
+    )
+    csv_lines = csv_response.text.splitlines()
+    assert csv_lines[0].split(",") == transaction_dao.ledger_columns
+    assert [line.split(",")[2] for line in csv_lines[1:]] == [
+        transaction.id for transaction in transactions
+    ]
+
+    rows = [json.loads(line) for line in ndjson_response.text.splitlines()]
+    assert [row["id"] for row in rows] == [
+        transaction.id
+        for transaction in transactions
+        if transaction.account == "+254700000001"
+    ]
@@ -0,0 +1,248 @@
+import pytest
+from typing import Callable
+from unittest.mock import DEFAULT
+from sqlalchemy.orm import Session
+from pytest_mock import MockerFixture
+
+from app.core.config import redis, settings
+from app.accounts.callbacks import mpesa_callback_stream
+from app.accounts.constants import MpesaCallbackTypes
+from app.accounts.daos.mpesa import (
+    mpesa_payment_dao,
+    withdrawal_dao,
+    mpesa_callback_dao,
+)
+from app.accounts.daos.account import transaction_dao
+from app.accounts.serializers.mpesa import (
+    MpesaPaymentCreateSerializer,
+    MpesaPaymentResultSerializer,
+    MpesaDirectPaymentSerializer,
+    WithdrawalCreateSerializer,
+    WithdrawalResultSerializer,
+)
+from app.accounts.tests.test_data import (
+    mock_stk_push_response,
+    mock_stk_push_result,
+    mpesa_reference_no,
+    sample_paybill_deposit_response,
+    sample_b2c_response,
+    sample_successful_b2c_result,
+)
+
+
+def test_mpesa_callback_stream_processes_queued_callbacks(
+    db: Session,
+    flush_redis: Callable,
+    mocker: MockerFixture,
+    delete_previous_mpesa_payment_transactions: Callable,
+    delete_transcation_model_instances: Callable,
+    delete_mpesa_callback_model_instances: Callable,
+) -> None:
+    """Test a queued STKPush callback creates its transaction and leaves the stream"""
+    mocker.patch.object(mpesa_callback_stream, "schedule")
+    data = mock_stk_push_response
+    mpesa_payment_dao.create(
+        db,
+        MpesaPaymentCreateSerializer(
+            phone_number=settings.SUPERUSER_PHONE,
+            merchant_request_id=data["MerchantRequestID"],
+            checkout_request_id=data["CheckoutRequestID"],
+            response_code=data["ResponseCode"],
+            response_description=data["ResponseDescription"],
+            customer_message=data["CustomerMessage"],
+        ),
+    )
+
+    mpesa_callback_stream.add(
+        MpesaCallbackTypes.STKPUSH, MpesaPaymentResultSerializer(**mock_stk_push_result)
+    )
+    processed = mpesa_callback_stream.process_pending(consumer="test")
+
+    assert processed == 1
+    assert transaction_dao.get(db, external_transaction_id=mpesa_reference_no)
+    assert redis.xlen(mpesa_callback_stream.stream_key) == 0
+
+
+def test_mpesa_callback_stream_retries_failed_callbacks(
+    db: Session,
+    flush_redis: Callable,
+    mocker: MockerFixture,
+    delete_mpesa_callback_model_instances: Callable,
+) -> None:
+    """Test a failing callback stays pending and is dead lettered after its last delivery"""
+    mocker.patch.object(mpesa_callback_stream, "schedule")
+    mocker.patch.object(settings, "MPESA_CALLBACK_RETRY_AFTER_SECONDS", 0)
+    mocker.patch.object(settings, "MPESA_CALLBACK_MAX_DELIVERIES", 2)
+    mock_process_paybill_payment = mocker.patch(
+        "app.accounts.callbacks.process_mpesa_paybill_payment",
+        side_effect=Exception("Database is unavailable"),
+    )
+
+    mpesa_callback_stream.add(
+        MpesaCallbackTypes.PAYBILL,
+        MpesaDirectPaymentSerializer(**sample_paybill_deposit_response),
+    )
+    mpesa_callback_stream.process_pending(consumer="test")
+
+    assert redis.xlen(mpesa_callback_stream.stream_key) == 1
+    assert redis.xlen(mpesa_callback_stream.dead_letter_key) == 0
+    assert mpesa_callback_dao.get_all(db) == []  # A failed callback is not recorded
+
+    mpesa_callback_stream.process_pending(consumer="test")
+
+    assert mock_process_paybill_payment.call_count == 2
+    assert redis.xlen(mpesa_callback_stream.stream_key) == 0
+    assert redis.xlen(mpesa_callback_stream.dead_letter_key) == 1
+    assert mpesa_callback_stream.add(  # M-Pesa's next retry is queued again
+        MpesaCallbackTypes.PAYBILL,
+        MpesaDirectPaymentSerializer(**sample_paybill_deposit_response),
+    )
+
+
+def test_mpesa_callback_stream_drops_duplicate_callbacks(
+    flush_redis: Callable, mocker: MockerFixture
+) -> None:
+    """Test a retried callback is not queued a second time"""
+    mock_schedule = mocker.patch.object(mpesa_callback_stream, "schedule")
+    callback_in = MpesaDirectPaymentSerializer(**sample_paybill_deposit_response)
+
+    assert mpesa_callback_stream.add(MpesaCallbackTypes.PAYBILL, callback_in)
+    assert mpesa_callback_stream.add(MpesaCallbackTypes.PAYBILL, callback_in) is None
+
+    assert mock_schedule.call_count == 1
+    assert redis.xlen(mpesa_callback_stream.stream_key) == 1
+
+
+def test_mpesa_callback_stream_skips_processed_callbacks(
+    db: Session,
+    flush_redis: Callable,
+    mocker: MockerFixture,
+    delete_mpesa_callback_model_instances: Callable,
+) -> None:
+    """Test a retried callback that Redis forgot is skipped by its database record"""
+    mocker.patch.object(mpesa_callback_stream, "schedule")
+    mock_process_paybill_payment = mocker.patch(
+        "app.accounts.callbacks.process_mpesa_paybill_payment"
+    )
+    callback_in = MpesaDirectPaymentSerializer(**sample_paybill_deposit_response)
+
+    mpesa_callback_stream.add(MpesaCallbackTypes.PAYBILL, callback_in)
+    mpesa_callback_stream.process_pending(consumer="test")
+
+    redis.delete(
+        f"mpesa_callback:{MpesaCallbackTypes.PAYBILL.value}:{callback_in.TransID}"
+    )
+    mpesa_callback_stream.add(MpesaCallbackTypes.PAYBILL, callback_in)
+    mpesa_callback_stream.process_pending(consumer="test")
+
+    assert mock_process_paybill_payment.call_count == 1
+    assert redis.xlen(mpesa_callback_stream.stream_key) == 0
+    assert mpesa_callback_dao.get(
+        db, idempotency_key=f"{MpesaCallbackTypes.PAYBILL.value}:{callback_in.TransID}"
+    )
+
+
+def test_mpesa_callback_stream_does_not_drop_callbacks_that_were_not_queued(
+    flush_redis: Callable, mocker: MockerFixture
+) -> None:
+    mocker.patch.object(mpesa_callback_stream, "schedule")
+    callback_in = MpesaDirectPaymentSerializer(**sample_paybill_deposit_response)
+    mocker.patch.object(
+        redis, "xadd", side_effect=[Exception("Redis is unavailable"), DEFAULT]
+    )
+
+    with pytest.raises(Exception):
+        mpesa_callback_stream.add(MpesaCallbackTypes.PAYBILL, callback_in)
+
+    assert mpesa_callback_stream.add(MpesaCallbackTypes.PAYBILL, callback_in)
+
+
+def test_mpesa_callback_stream_retries_stkpush_callback_whose_transaction_failed(
+    db: Session,
+    flush_redis: Callable,
+    mocker: MockerFixture,
+    delete_previous_mpesa_payment_transactions: Callable,
+    delete_transcation_model_instances: Callable,
+    delete_mpesa_callback_model_instances: Callable,
+) -> None:
+    """Test a callback is processed again if its ledger transaction failed"""
+    mocker.patch.object(mpesa_callback_stream, "schedule")
+    mocker.patch.object(settings, "MPESA_CALLBACK_RETRY_AFTER_SECONDS", 0)
+    mocker.patch.object(
+        transaction_dao,
+        "create",
+        wraps=transaction_dao.create,
+        side_effect=[Exception("Database is unavailable"), DEFAULT],
+    )
+    data = mock_stk_push_response
+    mpesa_payment_dao.create(
+        db,
+        MpesaPaymentCreateSerializer(
+            phone_number=settings.SUPERUSER_PHONE,
+            merchant_request_id=data["MerchantRequestID"],
+            checkout_request_id=data["CheckoutRequestID"],
+            response_code=data["ResponseCode"],
+            response_description=data["ResponseDescription"],
+            customer_message=data["CustomerMessage"],
+        ),
+    )
+
+    mpesa_callback_stream.add(
+        MpesaCallbackTypes.STKPUSH, MpesaPaymentResultSerializer(**mock_stk_push_result)
+    )
+    mpesa_callback_stream.process_pending(consumer="test")
+
+    assert transaction_dao.get(db, external_transaction_id=mpesa_reference_no) is None
+    assert mpesa_callback_dao.get_all(db) == []
+
+    mpesa_callback_stream.process_pending(consumer="test")
+
+    assert transaction_dao.get(db, external_transaction_id=mpesa_reference_no)
+    assert len(mpesa_callback_dao.get_all(db)) == 1
+    assert redis.xlen(mpesa_callback_stream.stream_key) == 0
+
+
+def test_mpesa_callback_stream_retries_b2c_result_callback_whose_transaction_failed(
+    db: Session,
+    flush_redis: Callable,
+    mocker: MockerFixture,
+    delete_withdrawal_model_instances: Callable,
+    delete_transcation_model_instances: Callable,
+    delete_mpesa_callback_model_instances: Callable,
+) -> None:
+    """Test a withdrawal saved before its ledger transaction failed is recorded on retry"""
+    mocker.patch.object(mpesa_callback_stream, "schedule")
+    mocker.patch.object(settings, "MPESA_CALLBACK_RETRY_AFTER_SECONDS", 0)
+    mocker.patch.object(
+        transaction_dao,
+        "create",
+        wraps=transaction_dao.create,
+        side_effect=[Exception("Database is unavailable"), DEFAULT],
+    )
+    withdrawal = withdrawal_dao.create(
+        db,
+        obj_in=WithdrawalCreateSerializer(
+            conversation_id=sample_b2c_response["ConversationID"],
+            originator_conversation_id=sample_b2c_response["OriginatorConversationID"],
+            response_code=sample_b2c_response["ResponseCode"],
+            response_description=sample_b2c_response["ResponseDescription"],
+        ),
+    )
+    transaction_id = sample_successful_b2c_result["Result"]["TransactionID"]
+
+    mpesa_callback_stream.add(
+        MpesaCallbackTypes.B2C_RESULT,
+        WithdrawalResultSerializer(**sample_successful_b2c_result),
+    )
+    mpesa_callback_stream.process_pending(consumer="test")
+
+    assert transaction_dao.get(db, external_transaction_id=transaction_id) is None
+
+    mpesa_callback_stream.process_pending(consumer="test")
+
+    assert transaction_dao.get(db, external_transaction_id=transaction_id)
+    assert len(mpesa_callback_dao.get_all(db)) == 1
+
+    withdrawal_dao.remove(
+        db, id=withdrawal.id
+    )  # Other tests create the same withdrawal
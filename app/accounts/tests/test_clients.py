@@ -0,0 +1,51 @@
+import asyncio
+import httpx
+from pytest_mock import MockerFixture
+
+from app.core.config import settings
+from app.accounts.clients import MpesaClient
+
+
+def mock_transport(requests: list) -> httpx.MockTransport:
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(200, json={"ResponseCode": "0"})
+
+    return httpx.MockTransport(handler)
+
+
+def test_mpesa_client_reuses_its_connection_pool() -> None:
+    mpesa_client = MpesaClient()
+
+    assert mpesa_client.client is mpesa_client.client
+    assert mpesa_client.client.timeout.connect == settings.MPESA_CONNECT_TIMEOUT_SECONDS
+    assert mpesa_client.client.timeout.read == settings.MPESA_READ_TIMEOUT_SECONDS
+
+
+def test_mpesa_client_opens_new_connections_after_fork(mocker: MockerFixture) -> None:
+    mpesa_client = MpesaClient()
+    parent_client = mpesa_client.client
+
+    mocker.patch("app.accounts.clients.os.getpid", return_value=-1)
+
+    assert mpesa_client.client is not parent_client
+
+
+def test_mpesa_client_sends_async_requests() -> None:
+    requests: list = []
+    mpesa_client = MpesaClient()
+    mpesa_client.reset_after_fork()
+    mpesa_client.async_client = httpx.AsyncClient(transport=mock_transport(requests))
+
+    async def post() -> httpx.Response:
+        response = await mpesa_client.post_async(
+            settings.MPESA_STKPUSH_URL, json={"Amount": 1}
+        )
+        await mpesa_client.close()
+        return response
+
+    response = asyncio.run(post())
+
+    assert response.json() == {"ResponseCode": "0"}
+    assert str(requests[0].url) == settings.MPESA_STKPUSH_URL
+    assert mpesa_client.async_client is None
@@ -2,6 +2,7 @@ from sqlalchemy.orm import Session
 from pytest_mock import MockerFixture
 import json
 from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
 
 from app.accounts.tests.test_data import (
     sample_positive_transaction_instance_info,
@@ -16,9 +17,11 @@ from app.accounts.serializers.mpesa import (
     WithdrawalCreateSerializer,
 )
 from app.accounts.utils import process_mpesa_stk
-from app.accounts.daos.account import transaction_dao
+from app.accounts.daos.account import transaction_dao, wallet_balance_dao
 from app.accounts.daos.mpesa import mpesa_payment_dao, withdrawal_dao
-from app.core.config import settings
+from app.core.config import settings, redis
+from app.db.session import SessionLocal
+from app.core.helpers import generate_transaction_code
 
 
 def test_create_positive_transaction_instance_succesfully(
@@ -101,6 +104,111 @@ def test_transaction_dao_shows_correct_user_balance(
     assert float(user_balance) == 9.55
 
 
+def test_wallet_balance_follows_every_transaction(
+    db: Session, mocker: MockerFixture, delete_transcation_model_instances: Callable
+) -> None:
+    """Test the wallet balance matches the latest transaction of the account"""
+    mocker.patch(  # Mock send_notification so that we don't have to wait for it
+        "app.accounts.daos.account.notifications_dao.send_notification",
+        return_value=None,
+    )
+    account = sample_positive_transaction_instance_info["account"]
+    positive_transactions_in = [
+        TransactionCreateSerializer(
+            **{
+                **sample_positive_transaction_instance_info,
+                "external_transaction_id": generate_transaction_code(),
+                "amount": 20,
+            }
+        )
+        for _ in range(2)
+    ]
+    negative_transaction_in = TransactionCreateSerializer(
+        **{**sample_negative_transaction_instance_info, "account": account, "amount": 5}
+    )
+
+    transaction_dao.create(db, obj_in=positive_transactions_in[0])
+    transaction_dao.create_many(
+        db, objs_in=[negative_transaction_in, positive_transactions_in[1]]
+    )
+    db.commit()
+
+    latest_transaction = transaction_dao.search(
+        db, {"order_by": ["-created_at"], "account": account}
+    )[0]
+    wallet_balance = wallet_balance_dao.get_not_none(db, account=account)
+
+    assert float(wallet_balance.balance) == float(latest_transaction.final_balance)
+    assert float(transaction_dao.get_user_balance(db, account=account)) == (
+        40 - 5 - settings.MPESA_B2C_CHARGE
+    )
+
+
+def test_concurrent_transactions_do_not_read_the_same_balance(
+    db: Session, mocker: MockerFixture, delete_transcation_model_instances: Callable
+) -> None:
+    """Test concurrent appends to an account chain every balance to the previous one"""
+    mocker.patch(  # Mock send_notification so that we don't have to wait for it
+        "app.accounts.daos.account.notifications_dao.send_notification",
+        return_value=None,
+    )
+    account = sample_positive_transaction_instance_info["account"]
+
+    def create_transaction() -> None:
+        with SessionLocal() as thread_db:
+            transaction_dao.create(
+                thread_db,
+                obj_in=TransactionCreateSerializer(
+                    **{
+                        **sample_positive_transaction_instance_info,
+                        "external_transaction_id": generate_transaction_code(),
+                        "amount": 1,
+                    }
+                ),
+            )
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        for _ in range(10):
+            executor.submit(create_transaction)
+
+    transactions = transaction_dao.search(
+        db, {"order_by": ["created_at"], "account": account}
+    )
+    final_balances = [float(transaction.final_balance) for transaction in transactions]
+
+    assert sorted(final_balances) == [float(i) for i in range(1, 11)]
+    assert float(transaction_dao.get_user_balance(db, account=account)) == 10.0
+
+
+def test_wallet_balance_is_cached_once_committed(
+    db: Session, mocker: MockerFixture, delete_transcation_model_instances: Callable
+) -> None:
+    """Test balances are written to the cache on commit and not on rollback"""
+    mocker.patch(  # Mock send_notification so that we don't have to wait for it
+        "app.accounts.daos.account.notifications_dao.send_notification",
+        return_value=None,
+    )
+    account = sample_positive_transaction_instance_info["account"]
+    cache_key = wallet_balance_dao.cache_key(account)
+
+    transaction_dao.create(
+        db,
+        obj_in=TransactionCreateSerializer(
+            **{**sample_positive_transaction_instance_info, "amount": 7}
+        ),
+    )
+    assert float(redis.hget(cache_key, "balance")) == 7.0
+
+    wallet_balance_dao.save_balances(db, {account: 100.0})
+    db.rollback()
+    assert float(redis.hget(cache_key, "balance")) == 7.0
+
+    # A miss is read from the database and cached
+    redis.delete(cache_key)
+    assert transaction_dao.get_user_balance(db, account=account) == 7.0
+    assert float(redis.hget(cache_key, "balance")) == 7.0
+
+
 def test_mpesa_payment_is_created_successfully(
     db: Session,
     delete_transcation_model_instances: Callable,
@@ -0,0 +1,157 @@
+from typing import Callable, List
+from sqlalchemy import insert, text, update
+from sqlalchemy.orm import Session
+from pytest_mock import MockerFixture
+
+from app.core.config import settings
+from app.accounts.reconciliation import ledger_reconciliation
+from app.accounts.models import Transactions, WalletBalance, MpesaPayments, Withdrawals
+from app.accounts.daos.account import transaction_dao
+from app.accounts.serializers.account import TransactionCreateSerializer
+from app.accounts.tests.test_data import sample_positive_transaction_instance_info
+
+
+account = settings.SUPERUSER_PHONE
+
+
+def create_transactions(db: Session, transactions: List[dict]) -> None:
+    transaction_dao.create_many(
+        db,
+        objs_in=[
+            TransactionCreateSerializer(
+                **{**sample_positive_transaction_instance_info, **transaction}
+            )
+            for transaction in transactions
+        ],
+    )
+    db.commit()
+
+
+def create_matched_ledger(db: Session) -> None:
+    """A deposit and a withdrawal with their M-Pesa records"""
+    create_transactions(
+        db,
+        [
+            {"external_transaction_id": "RECEIPT1", "amount": 100.0},
+            {"external_transaction_id": "RECEIPT2", "amount": 30.0},
+            {
+                "external_transaction_id": "B2C1",
+                "amount": 50.0,
+                "fee": settings.MPESA_B2C_CHARGE,
+                "cash_flow": "OUTWARD",
+                "type": "WITHDRAWAL",
+            },
+        ],
+    )
+    db.execute(
+        insert(MpesaPayments.__table__),
+        [
+            {
+                "phone_number": account,
+                "result_code": 0,
+                "receipt_number": "RECEIPT1",
+                "amount": 100.0,
+            }
+        ],
+    )
+    db.execute(
+        insert(Withdrawals.__table__),
+        [
+            {
+                "phone_number": account,
+                "result_code": 0,
+                "transaction_id": "B2C1",
+                "transaction_amount": 50.0,
+            }
+        ],
+    )
+    db.commit()
+
+
+def test_ledger_reconciliation_passes_on_matched_ledger(
+    db: Session,
+    delete_transcation_model_instances: Callable,
+    delete_previous_mpesa_payment_transactions: Callable,
+    delete_withdrawal_model_instances: Callable,
+) -> None:
+    create_matched_ledger(db)
+
+    report = ledger_reconciliation.run(db)
+
+    assert all(rows == [] for rows in report.values())
+
+
+def test_ledger_reconciliation_reports_drifted_accounts(
+    db: Session,
+    delete_transcation_model_instances: Callable,
+    delete_previous_mpesa_payment_transactions: Callable,
+    delete_withdrawal_model_instances: Callable,
+) -> None:
+    """Assert that a broken balance chain and a stale wallet balance are reported"""
+    create_matched_ledger(db)
+    db.execute(
+        update(Transactions)
+        .where(Transactions.external_transaction_id == "RECEIPT2")
+        .values(initial_balance=90)
+    )
+    db.execute(
+        update(WalletBalance).where(WalletBalance.account == account).values(balance=1)
+    )
+    db.commit()
+
+    report = ledger_reconciliation.run(db)
+
+    assert [row["account"] for row in report["drifted_accounts"]] == [account]
+    assert report["drifted_accounts"][0]["drifted_transactions"] == 1
+    assert report["balance_mismatches"][0]["account"] == account
+    assert report["balance_mismatches"][0]["wallet_balance"] == 1
+
+
+def test_ledger_reconciliation_reports_unmatched_mpesa_records(
+    db: Session,
+    delete_transcation_model_instances: Callable,
+    delete_previous_mpesa_payment_transactions: Callable,
+    delete_withdrawal_model_instances: Callable,
+) -> None:
+    create_matched_ledger(db)
+    db.execute(
+        insert(MpesaPayments.__table__),
+        [{"phone_number": account, "result_code": 0, "receipt_number": "MISSING"}],
+    )
+    db.execute(
+        update(Withdrawals)
+        .where(Withdrawals.transaction_id == "B2C1")
+        .values(transaction_amount=60.0)
+    )
+    db.commit()
+
+    report = ledger_reconciliation.run(db)
+
+    assert [row["receipt_number"] for row in report["unmatched_mpesa_payments"]] == [
+        "MISSING"
+    ]
+    assert [row["receipt_number"] for row in report["unmatched_withdrawals"]] == [
+        "B2C1"
+    ]
+    assert report["unmatched_withdrawal_transactions"] == []
+
+
+def test_ledger_reconciliation_raises_the_statement_timeout_for_its_checks(
+    db: Session, mocker: MockerFixture
+) -> None:
+    statement_timeouts = []
+
+    def get_drifted_accounts(db: Session) -> list:
+        statement_timeouts.append(db.execute(text("SHOW statement_timeout")).scalar())
+        return []
+
+    mocker.patch.object(
+        ledger_reconciliation, "get_drifted_accounts", side_effect=get_drifted_accounts
+    )
+
+    ledger_reconciliation.run(db)
+
+    assert statement_timeouts == [
+        f"{settings.LEDGER_RECONCILIATION_TIMEOUT_SECONDS // 60}min"
+    ]
+    assert db.execute(text("SHOW statement_timeout")).scalar() == "10s"
@@ -0,0 +1,32 @@
+from typing import Callable
+from sqlalchemy.orm import Session
+from pytest_mock import MockerFixture
+
+from app.core.config import redis
+from app.accounts.tasks import verify_wallet_balance_cache_task
+from app.accounts.daos.account import transaction_dao, wallet_balance_dao
+from app.accounts.serializers.account import TransactionCreateSerializer
+from app.accounts.tests.test_data import sample_positive_transaction_instance_info
+
+
+def test_verify_wallet_balance_cache_task_repairs_drifted_balances(
+    db: Session, mocker: MockerFixture, delete_transcation_model_instances: Callable
+) -> None:
+    """Test the task replaces cached balances that differ from the database"""
+    mocker.patch(  # Mock send_notification so that we don't have to wait for it
+        "app.accounts.daos.account.notifications_dao.send_notification",
+        return_value=None,
+    )
+    account = sample_positive_transaction_instance_info["account"]
+    transaction_dao.create(
+        db,
+        obj_in=TransactionCreateSerializer(**sample_positive_transaction_instance_info),
+    )
+    redis.hset(wallet_balance_dao.cache_key(account), "balance", 1000)
+
+    repaired = verify_wallet_balance_cache_task()
+
+    assert repaired == 1
+    assert transaction_dao.get_user_balance(db, account=account) == float(
+        sample_positive_transaction_instance_info["amount"]
+    )
@@ -1,16 +1,30 @@
+import asyncio
 import unittest
 from unittest.mock import MagicMock, patch
 from sqlalchemy.orm import Session
 from typing import Callable
+from pytest_mock import MockerFixture
+from pathlib import Path
+import shutil
+import threading
+import time
 import pytest
 
 from app.accounts.utils import (
     get_mpesa_access_token,
+    get_mpesa_access_token_async,
     initiate_mpesa_stkpush_payment,
     trigger_mpesa_stkpush_payment,
+    trigger_mpesa_stkpush_payment_async,
     initiate_b2c_payment,
     process_b2c_payment,
     process_b2c_payment_result,
+    get_initiator_security_credential,
+    renew_mpesa_access_token,
+    MpesaAccessTokenCache,
+    load_mpesa_public_key,
+    get_mpesa_certificate,
+    MPESA_CERTIFICATE_PATH,
 )
 from app.core.config import redis, settings
 from app.core.helpers import md5_hash
@@ -41,6 +55,7 @@ from app.accounts.serializers.mpesa import (
 )
 from app.accounts.daos.mpesa import mpesa_payment_dao
 from app.accounts.daos.account import transaction_dao
+from app.accounts.clients import mpesa_client
 from app.accounts.utils import process_mpesa_stk, process_mpesa_paybill_payment
 from app.exceptions.custom import STKPushFailed
 
@@ -56,31 +71,31 @@ class TestMpesaSTKPush(unittest.TestCase):
     def tearDown(cls):
         redis.flushall()  # Flush all values from redis
 
-    @patch("app.accounts.utils.requests")
-    def test_get_mpesa_access_token(self, mock_requests) -> None:
+    @patch("app.accounts.utils.mpesa_client")
+    def test_get_mpesa_access_token(self, mock_mpesa_client) -> None:
         expected_access_token = "fake_access_token"
         self.mock_response.json.return_value = {
             "access_token": expected_access_token,
             "expires_in": "3599",
         }
-        mock_requests.get.return_value = self.mock_response
+        mock_mpesa_client.get.return_value = self.mock_response
 
         access_token = get_mpesa_access_token()
         assert access_token == expected_access_token
 
-    @patch("app.accounts.utils.requests")
-    def test_get_mpesa_access_token_is_set_in_redis(self, mock_requests) -> None:
+    @patch("app.accounts.utils.mpesa_client")
+    def test_get_mpesa_access_token_is_set_in_redis(self, mock_mpesa_client) -> None:
         expected_access_token = "fake_access_token"
         self.mock_response.json.return_value = {
             "access_token": expected_access_token,
             "expires_in": "3599",
         }
-        mock_requests.get.return_value = self.mock_response
+        mock_mpesa_client.get.return_value = self.mock_response
 
         get_mpesa_access_token()  # Call first time
         get_mpesa_access_token()  # Second call
 
-        assert mock_requests.get.call_count == 1
+        assert mock_mpesa_client.get.call_count == 1
 
     @patch("app.accounts.utils.get_mpesa_access_token")
     def test_initiate_mpesa_stkpush_payment_returns_successful_response(
@@ -88,7 +103,7 @@ class TestMpesaSTKPush(unittest.TestCase):
     ) -> None:
         mock_get_mpesa_access_token.return_value = "fake_access_token"
 
-        with patch("app.accounts.utils.requests") as mock_requests:
+        with patch("app.accounts.utils.mpesa_client") as mock_mpesa_client:
             self.mock_response.json.return_value = {
                 "MerchantRequestID": "29115-34620561-1",
                 "CheckoutRequestID": "ws_CO_191220191020363925",
@@ -96,7 +111,7 @@ class TestMpesaSTKPush(unittest.TestCase):
                 "ResponseDescription": "Success. Request accepted for processing",
                 "CustomerMessage": "Success. Request accepted for processing",
             }
-            mock_requests.post.return_value = self.mock_response
+            mock_mpesa_client.post.return_value = self.mock_response
 
             response = initiate_mpesa_stkpush_payment(
                 phone_number=settings.SUPERUSER_PHONE,
@@ -113,14 +128,14 @@ class TestMpesaSTKPush(unittest.TestCase):
             assert response == self.mock_response.json()
 
     @patch("app.accounts.utils.get_mpesa_access_token")
-    @patch("app.accounts.utils.requests")
+    @patch("app.accounts.utils.mpesa_client")
     def test_initiate_mpesa_stkpush_payment_raises_exception(
-        self, mock_get_mpesa_access_token, mock_requests
+        self, mock_get_mpesa_access_token, mock_mpesa_client
     ) -> None:
         mock_get_mpesa_access_token.return_value = "fake_access_token"
 
         with self.assertRaises(Exception):
-            mock_requests.side_effect = STKPushFailed
+            mock_mpesa_client.side_effect = STKPushFailed
 
             initiate_mpesa_stkpush_payment(
                 phone_number=settings.SUPERUSER_PHONE,
@@ -243,9 +258,9 @@ class TestMpesaB2CPayment(unittest.TestCase):
     ):
         mock_get_mpesa_access_token.return_value = "random_token"
 
-        with patch("app.accounts.utils.requests") as mock_requests:
+        with patch("app.accounts.utils.mpesa_client") as mock_mpesa_client:
             self.mock_response.json.return_value = sample_b2c_response
-            mock_requests.post.return_value = self.mock_response
+            mock_mpesa_client.post.return_value = self.mock_response
 
             response = initiate_b2c_payment(
                 amount=1,
@@ -260,10 +275,10 @@ class TestMpesaB2CPayment(unittest.TestCase):
     ):
         mock_get_mpesa_access_token.return_value = "random_token"
 
-        with patch("app.accounts.utils.requests") as mock_requests:
+        with patch("app.accounts.utils.mpesa_client") as mock_mpesa_client:
             sample_b2c_response["ResponseCode"] = "1"
             self.mock_response.json.return_value = sample_b2c_response
-            mock_requests.post.return_value = self.mock_response
+            mock_mpesa_client.post.return_value = self.mock_response
 
             response = initiate_b2c_payment(
                 amount=1,
@@ -357,3 +372,155 @@ def test_process_b2c_payment_result_update_withdrawal_instance(
         assert db_obj.phone_number == settings.SUPERUSER_PHONE
         assert db_obj.transaction_amount == 10.0
         assert db_obj.transaction_id == withdrawal_result_in.TransactionID
+
+
+def test_get_initiator_security_credential_is_cached(
+    flush_redis: Callable, mocker: MockerFixture
+) -> None:
+    """Test the certificate is parsed and the password encrypted only once"""
+    load_mpesa_public_key.cache_clear()
+    mock_get_mpesa_certificate = mocker.patch(
+        "app.accounts.utils.get_mpesa_certificate", wraps=get_mpesa_certificate
+    )
+
+    security_credential = get_initiator_security_credential()
+
+    assert get_initiator_security_credential() == security_credential
+    assert mock_get_mpesa_certificate.call_count == 1
+
+
+def test_get_initiator_security_credential_changes_with_password(
+    flush_redis: Callable, mocker: MockerFixture
+) -> None:
+    security_credential = get_initiator_security_credential()
+    mocker.patch.object(settings, "MPESA_B2C_PASSWORD", "new_password")
+
+    assert get_initiator_security_credential() != security_credential
+    assert len(redis.keys("mpesa_b2c_security_credential:*")) == 2
+
+
+def test_get_initiator_security_credential_changes_with_certificate(
+    flush_redis: Callable, mocker: MockerFixture, tmp_path: Path
+) -> None:
+    cert_file_path = tmp_path / "ProductionCertificate.cer"
+    shutil.copy(MPESA_CERTIFICATE_PATH, cert_file_path)
+    mocker.patch("app.accounts.utils.MPESA_CERTIFICATE_PATH", str(cert_file_path))
+
+    security_credential = get_initiator_security_credential()
+    cert_file_path.write_text(cert_file_path.read_text() + "\n")
+
+    assert get_initiator_security_credential() != security_credential
+    assert len(redis.keys("mpesa_b2c_security_credential:*")) == 2
+
+
+def mock_fetch_mpesa_access_token(mocker: MockerFixture, seconds: float = 0):
+    def fetch(*args) -> dict:
+        time.sleep(seconds)  # Simulate a slow response from M-Pesa
+        return {"access_token": "new_access_token", "expires_in": "3599"}
+
+    return mocker.patch(
+        "app.accounts.utils.fetch_mpesa_access_token", side_effect=fetch
+    )
+
+
+def test_get_mpesa_access_token_is_fetched_once_by_concurrent_requests(
+    flush_redis: Callable, mocker: MockerFixture
+) -> None:
+    mock_fetch = mock_fetch_mpesa_access_token(mocker, seconds=0.3)
+    access_tokens = []
+
+    threads = [
+        threading.Thread(target=lambda: access_tokens.append(get_mpesa_access_token()))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert mock_fetch.call_count == 1
+    assert access_tokens == ["new_access_token"] * 5
+
+
+def test_get_mpesa_access_token_uses_previous_token_during_refresh(
+    flush_redis: Callable, mocker: MockerFixture
+) -> None:
+    mock_fetch = mock_fetch_mpesa_access_token(mocker)
+    token_cache = MpesaAccessTokenCache()
+    redis.set(token_cache.previous_key, "previous_access_token")
+
+    lock = token_cache.lock()
+    lock.acquire()  # Another process is refreshing the token
+    access_token = get_mpesa_access_token()
+    lock.release()
+
+    assert access_token == "previous_access_token"
+    assert mock_fetch.call_count == 0
+
+
+def test_get_mpesa_access_token_async_fetches_and_caches_a_token(
+    flush_redis: Callable, mocker: MockerFixture
+) -> None:
+    async def fetch(*args) -> dict:
+        return {"access_token": "new_access_token", "expires_in": "3599"}
+
+    mock_fetch = mocker.patch(
+        "app.accounts.utils.fetch_mpesa_access_token_async", side_effect=fetch
+    )
+    token_cache = MpesaAccessTokenCache()
+
+    assert asyncio.run(get_mpesa_access_token_async()) == "new_access_token"
+    assert asyncio.run(get_mpesa_access_token_async()) == "new_access_token"
+    assert mock_fetch.call_count == 1
+    assert token_cache.get() == "new_access_token"
+    assert token_cache.lock().locked() is False
+
+
+def test_trigger_mpesa_stkpush_payment_async_sends_the_deposit_payload(
+    mocker: MockerFixture,
+) -> None:
+    mocker.patch(
+        "app.accounts.utils.get_mpesa_access_token_async",
+        return_value="fake_access_token",
+    )
+    mock_save_stkpush_checkout = mocker.patch(
+        "app.accounts.utils.save_stkpush_checkout"
+    )
+    mock_response = MagicMock()
+    mock_response.json.return_value = {"ResponseCode": "0"}
+    mock_post_async = mocker.patch.object(
+        mpesa_client, "post_async", return_value=mock_response
+    )
+
+    data = asyncio.run(
+        trigger_mpesa_stkpush_payment_async(
+            amount=1, phone_number=settings.SUPERUSER_PHONE
+        )
+    )
+    payload = mock_post_async.call_args.kwargs["json"]
+
+    assert data == {"ResponseCode": "0"}
+    assert payload["Amount"] == 1
+    assert payload["PhoneNumber"] == settings.SUPERUSER_PHONE.replace("+", "")
+    assert payload["BusinessShortCode"] == settings.MPESA_BUSINESS_SHORT_CODE
+    mock_save_stkpush_checkout.assert_called_once_with(data, settings.SUPERUSER_PHONE)
+
+
+def test_renew_mpesa_access_token_renews_tokens_about_to_expire(
+    flush_redis: Callable, mocker: MockerFixture
+) -> None:
+    mock_fetch = mock_fetch_mpesa_access_token(mocker)
+    token_cache = MpesaAccessTokenCache()
+    redis.set(
+        token_cache.key,
+        "fresh_access_token",
+        ex=settings.MPESA_TOKEN_RENEW_BEFORE_SECONDS + 60,
+    )
+
+    assert renew_mpesa_access_token() is False
+
+    redis.expire(token_cache.key, settings.MPESA_TOKEN_RENEW_BEFORE_SECONDS - 60)
+
+    assert renew_mpesa_access_token() is True
+    assert token_cache.get() == "new_access_token"
+    assert mock_fetch.call_count == 1
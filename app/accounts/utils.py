@@ -1,13 +1,20 @@
-import requests
 import json
+import hmac
+from time import sleep
 from base64 import b64encode
-from typing import Optional, Dict
+from hashlib import sha256
+from functools import lru_cache
+from typing import Optional, Dict, Tuple
 from datetime import datetime
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from redis.lock import Lock
+from redis.exceptions import LockError
 from app.db.session import SessionLocal
 import os
 
 from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey
 from cryptography.x509 import Certificate, load_pem_x509_certificate
 
 from app.core.raw_logger import logger
@@ -33,6 +40,7 @@ from app.accounts.serializers.mpesa import (
     WithdrawalCreateSerializer,
     WithdrawalResultBodySerializer,
 )
+from app.accounts.clients import mpesa_client
 from app.accounts.daos.mpesa import mpesa_payment_dao, withdrawal_dao
 from app.accounts.daos.account import transaction_dao
 from app.accounts.serializers.account import TransactionCreateSerializer
@@ -42,6 +50,117 @@ from app.accounts.constants import B2CMpesaCommandIDs
 from app.exceptions.custom import STKPushFailed, B2CPaymentFailed
 
 
+class MpesaAccessTokenCache:
+    """
+    An M-Pesa OAuth token shared by every process through Redis.
+
+    A token is fresh until 200 seconds before M-Pesa expires it and is kept as
+    the previous token until just before then. Only the process holding the
+    refresh lock fetches a new token. The others use the previous token,
+    or wait briefly for the fresh one when there is none.
+    """
+
+    def __init__(self, IS_B2C: bool = False) -> None:
+        self.key = "mpesa_b2c_access_token" if IS_B2C else "mpesa_access_token"
+
+    @property
+    def previous_key(self) -> str:
+        return f"{self.key}:previous"
+
+    def get(self) -> str | None:
+        return redis.get(self.key)
+
+    def get_previous(self) -> str | None:
+        return redis.get(self.previous_key)
+
+    def ttl(self) -> int:
+        """Seconds until the token is no longer fresh. Negative if there is none"""
+        return redis.ttl(self.key)
+
+    def lock(self) -> Lock:
+        # The lock may be released by a different thread than the one that took it
+        return redis.lock(
+            f"{self.key}:lock",
+            timeout=settings.MPESA_TOKEN_LOCK_SECONDS,
+            thread_local=False,
+        )
+
+    def save(self, response_data: Dict) -> str:
+        """Store a fetched token in the cache for future requests"""
+        access_token = response_data["access_token"]
+        expires_in = int(response_data["expires_in"])
+
+        pipeline = redis.pipeline()
+        # The timeout set by mpesa is `3599` so we subtract 200 to be safe
+        pipeline.set(self.key, access_token, ex=expires_in - 200)
+        pipeline.set(self.previous_key, access_token, ex=expires_in - 10)
+        pipeline.execute()
+
+        return access_token
+
+
+def release_mpesa_access_token_lock(lock: Lock) -> None:
+    try:
+        lock.release()
+    except LockError:
+        logger.warning("The M-Pesa token lock expired before the token was fetched")
+
+
+def fetch_mpesa_access_token(MPESA_CONSUMER_KEY: str, MPESA_SECRET: str) -> Dict:
+    logger.info("Fetching M-Pesa access token from API...")
+    response = mpesa_client.get(
+        settings.MPESA_TOKEN_URL, auth=(MPESA_CONSUMER_KEY, MPESA_SECRET)
+    )
+    return response.json()
+
+
+async def fetch_mpesa_access_token_async(
+    MPESA_CONSUMER_KEY: str, MPESA_SECRET: str
+) -> Dict:
+    logger.info("Fetching M-Pesa access token from API...")
+    response = await mpesa_client.get_async(
+        settings.MPESA_TOKEN_URL, auth=(MPESA_CONSUMER_KEY, MPESA_SECRET)
+    )
+    return response.json()
+
+
+def claim_mpesa_access_token(
+    token_cache: MpesaAccessTokenCache,
+) -> Tuple[Optional[str], Optional[Lock]]:
+    """
+    Return a cached token, or the refresh lock when a new token must be fetched.
+    Only one process refreshes the token on a miss. The others use the previous
+    token or wait briefly for the fresh one. The token is fetched without the
+    lock if the wait times out.
+    """
+    access_token = token_cache.get()
+    if access_token:
+        return access_token, None
+
+    lock = token_cache.lock()
+    if lock.acquire(blocking=False):
+        # The token may have been saved while the lock was being acquired
+        access_token = token_cache.get()
+        if not access_token:
+            return None, lock
+
+        release_mpesa_access_token_lock(lock)
+        return access_token, None
+
+    # Another process is refreshing the token
+    access_token = token_cache.get_previous()
+    waited = 0.0
+    while not access_token and waited < settings.MPESA_TOKEN_WAIT_SECONDS:
+        sleep(settings.MPESA_TOKEN_WAIT_INTERVAL_SECONDS)
+        waited += settings.MPESA_TOKEN_WAIT_INTERVAL_SECONDS
+        access_token = token_cache.get()
+
+    if not access_token:
+        logger.warning("Timed out waiting for the M-Pesa access token refresh")
+
+    return access_token, None
+
+
 def get_mpesa_access_token(
     MPESA_CONSUMER_KEY=settings.MPESA_CONSUMER_KEY,
     MPESA_SECRET=settings.MPESA_SECRET,
@@ -52,38 +171,73 @@ def get_mpesa_access_token(
     Requires the application secret and consumer key.
     We store the key in the server cache(Redis) for a period of 200
     seconds less than the one provided by Mpesa just to be safe.
+    Tokens are renewed in the background before they expire, so a miss is rare.
     """
     logger.info("Retrieving M-Pesa token...")
+    token_cache = MpesaAccessTokenCache(IS_B2C)
 
-    access_token = (
-        redis.get("mpesa_b2c_access_token")
-        if IS_B2C
-        else redis.get("mpesa_access_token")
-    )
+    access_token, lock = claim_mpesa_access_token(token_cache)
+    if access_token:
+        return access_token
 
-    if not access_token:
-        logger.info("Mpesa access token does not exist. Fetching from API...")
-        url = settings.MPESA_TOKEN_URL
-        auth = requests.auth.HTTPBasicAuth(MPESA_CONSUMER_KEY, MPESA_SECRET)
+    try:
+        return token_cache.save(
+            fetch_mpesa_access_token(MPESA_CONSUMER_KEY, MPESA_SECRET)
+        )
+    finally:
+        if lock is not None:
+            release_mpesa_access_token_lock(lock)
 
-        req = requests.get(url, auth=auth, verify=True)
-        res = req.json()
 
-        access_token = res["access_token"]
-        # The timeout set by mpesa is `3599` so we subtract 200 to be safe
-        timeout = int(res["expires_in"]) - 200
+async def get_mpesa_access_token_async(
+    MPESA_CONSUMER_KEY=settings.MPESA_CONSUMER_KEY,
+    MPESA_SECRET=settings.MPESA_SECRET,
+    IS_B2C: bool = False,
+) -> str:
+    """Get Mpesa Access Token without blocking the event loop"""
+    logger.info("Retrieving M-Pesa token...")
+    token_cache = MpesaAccessTokenCache(IS_B2C)
 
-        # Store the token in the cache for future requests
-        (
-            redis.set("mpesa_b2c_access_token", access_token, ex=timeout)
-            if IS_B2C
-            else redis.set("mpesa_access_token", access_token, ex=timeout)
+    access_token, lock = await run_in_threadpool(claim_mpesa_access_token, token_cache)
+    if access_token:
+        return access_token
+
+    try:
+        response_data = await fetch_mpesa_access_token_async(
+            MPESA_CONSUMER_KEY, MPESA_SECRET
         )
+        return await run_in_threadpool(token_cache.save, response_data)
+    finally:
+        if lock is not None:
+            await run_in_threadpool(release_mpesa_access_token_lock, lock)
 
-    return access_token
 
+def renew_mpesa_access_token(
+    MPESA_CONSUMER_KEY=settings.MPESA_CONSUMER_KEY,
+    MPESA_SECRET=settings.MPESA_SECRET,
+    IS_B2C: bool = False,
+) -> bool:
+    """Fetch a new token when the cached one is about to stop being fresh.
+    Returns whether the token was renewed."""
+    token_cache = MpesaAccessTokenCache(IS_B2C)
+    if token_cache.ttl() > settings.MPESA_TOKEN_RENEW_BEFORE_SECONDS:
+        return False
 
-def initiate_mpesa_stkpush_payment(
+    lock = token_cache.lock()
+    if not lock.acquire(blocking=False):
+        return False  # Another process is refreshing the token
+
+    try:
+        if token_cache.ttl() > settings.MPESA_TOKEN_RENEW_BEFORE_SECONDS:
+            return False
+
+        token_cache.save(fetch_mpesa_access_token(MPESA_CONSUMER_KEY, MPESA_SECRET))
+        return True
+    finally:
+        release_mpesa_access_token_lock(lock)
+
+
+def get_mpesa_stkpush_payload(
     phone_number: str,
     amount: int,
     business_short_code: str,
@@ -93,11 +247,8 @@ def initiate_mpesa_stkpush_payment(
     callback_url: str,
     reference: str,
     description: str,
-) -> Dict | None:
-    """Trigger STKPush"""
-    logger.info(f"Initiate M-Pesa STKPush for Ksh {amount} to {phone_number}")
-
-    access_token = get_mpesa_access_token()
+) -> Dict:
+    """Build the body of an STKPush request"""
     phone_number = str(phone_number).replace("+", "")
     timestamp = datetime.now().strftime(settings.MPESA_DATETIME_FORMAT)
 
@@ -105,81 +256,167 @@ def initiate_mpesa_stkpush_payment(
         bytes(f"{business_short_code}{passkey}{timestamp}", "utf-8")
     ).decode("utf-8")
 
-    api_url = settings.MPESA_STKPUSH_URL
-    headers = {
+    return {
+        "BusinessShortCode": business_short_code,
+        "Password": password,
+        "Timestamp": timestamp,
+        "TransactionType": transaction_type,
+        "Amount": int(amount),
+        "PartyA": phone_number,
+        "PartyB": party_b,
+        "PhoneNumber": phone_number,
+        "CallBackURL": callback_url,
+        "AccountReference": reference,
+        "TransactionDesc": description,
+    }
+
+
+def get_mpesa_headers(access_token: str) -> Dict:
+    return {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {access_token}",
     }
 
+
+def get_mpesa_stkpush_response(response_data: Dict) -> Dict | None:
+    """The STKPush response if M-Pesa accepted the request"""
+    logger.info(f"Received M-Pesa STKPush response: {response_data}")
+
+    if response_data["ResponseCode"] == "0":  # 0 means response is ok
+        return response_data
+    return None
+
+
+def initiate_mpesa_stkpush_payment(
+    phone_number: str,
+    amount: int,
+    business_short_code: str,
+    party_b: str,
+    passkey: str,
+    transaction_type: str,
+    callback_url: str,
+    reference: str,
+    description: str,
+) -> Dict | None:
+    """Trigger STKPush"""
+    logger.info(f"Initiate M-Pesa STKPush for Ksh {amount} to {phone_number}")
+    access_token = get_mpesa_access_token()
+
     try:
-        data = {
-            "BusinessShortCode": business_short_code,
-            "Password": password,
-            "Timestamp": timestamp,
-            "TransactionType": transaction_type,
-            "Amount": int(amount),
-            "PartyA": phone_number,
-            "PartyB": party_b,
-            "PhoneNumber": phone_number,
-            "CallBackURL": callback_url,
-            "AccountReference": reference,
-            "TransactionDesc": description,
-        }
-        logger.info(f"Sending M-Pesa STKPush for Ksh {amount} to {phone_number}")
-        response = requests.post(api_url, json=data, headers=headers, verify=True)
-        response_data = response.json()
-        logger.info(f"Received M-Pesa STKPush response: {response_data}")
+        data = get_mpesa_stkpush_payload(
+            phone_number=phone_number,
+            amount=amount,
+            business_short_code=business_short_code,
+            party_b=party_b,
+            passkey=passkey,
+            transaction_type=transaction_type,
+            callback_url=callback_url,
+            reference=reference,
+            description=description,
+        )
+        response = mpesa_client.post(
+            settings.MPESA_STKPUSH_URL,
+            json=data,
+            headers=get_mpesa_headers(access_token),
+        )
+        return get_mpesa_stkpush_response(response.json())
 
-        if response_data["ResponseCode"] == "0":  # 0 means response is ok
-            return response_data
+    except Exception as e:
+        logger.error(f"Initiating STKPush failed with response: {e}")
+        raise STKPushFailed
+
+
+async def initiate_mpesa_stkpush_payment_async(data: Dict) -> Dict | None:
+    """Send an STKPush payload without blocking the event loop"""
+    logger.info(
+        f"Initiate M-Pesa STKPush for Ksh {data['Amount']} to {data['PhoneNumber']}"
+    )
+    access_token = await get_mpesa_access_token_async()
+
+    try:
+        response = await mpesa_client.post_async(
+            settings.MPESA_STKPUSH_URL,
+            json=data,
+            headers=get_mpesa_headers(access_token),
+        )
+        return get_mpesa_stkpush_response(response.json())
 
     except Exception as e:
         logger.error(f"Initiating STKPush failed with response: {e}")
         raise STKPushFailed
 
 
+def get_stkpush_deposit_request(amount: int, phone_number: str) -> Dict:
+    """The STKPush request of a deposit to the business paybill"""
+    return {
+        "phone_number": phone_number,
+        "amount": int(amount),
+        "business_short_code": settings.MPESA_BUSINESS_SHORT_CODE,
+        "passkey": settings.MPESA_PASS_KEY,
+        "party_b": settings.MPESA_BUSINESS_SHORT_CODE,
+        "transaction_type": MpesaAccountTypes.PAYBILL.value,
+        "callback_url": settings.MPESA_CALLBACK_URL,
+        "description": (
+            f"Request for deposit of Ksh {amount} for account {phone_number} in Majibu."
+        ),
+        "reference": phone_number,
+    }
+
+
+def save_stkpush_checkout(data: Dict | None, phone_number: str) -> None:
+    """Save the checkout response to db for future reference"""
+    if data is None:
+        return
+
+    logger.info(
+        f"Saving the checkout response {data['MerchantRequestID']} for {phone_number}"
+    )
+    with SessionLocal() as db:
+        mpesa_payment_dao.create(
+            db,
+            obj_in=MpesaPaymentCreateSerializer(
+                phone_number=phone_number,
+                merchant_request_id=data["MerchantRequestID"],
+                checkout_request_id=data["CheckoutRequestID"],
+                response_code=data["ResponseCode"],
+                response_description=data["ResponseDescription"],
+                customer_message=data["CustomerMessage"],
+            ),
+        )
+
+
 def trigger_mpesa_stkpush_payment(amount: int, phone_number: str) -> Optional[Dict]:
     """Send Mpesa STK push."""
     logger.info(f"Trigerring M-Pesa STKPush for KES {amount} to {phone_number}")
 
-    business_short_code = settings.MPESA_BUSINESS_SHORT_CODE
-    party_b = settings.MPESA_BUSINESS_SHORT_CODE
-    amount = amount
-    account_reference = phone_number
-    transaction_description = (
-        f"Request for deposit of Ksh {amount} for account {phone_number} in Majibu."
-    )
     try:
-        passkey = settings.MPESA_PASS_KEY
         data = initiate_mpesa_stkpush_payment(
-            phone_number=phone_number,
-            amount=int(amount),
-            business_short_code=business_short_code,
-            passkey=passkey,
-            party_b=party_b,
-            transaction_type=MpesaAccountTypes.PAYBILL.value,
-            callback_url=settings.MPESA_CALLBACK_URL,
-            description=transaction_description,
-            reference=account_reference,
+            **get_stkpush_deposit_request(amount, phone_number)
         )
+        save_stkpush_checkout(data, phone_number)
 
-        # Save the checkout response to db for future reference
-        if data is not None:
-            logger.info(
-                f"Saving the checkout response {data['MerchantRequestID']} for {phone_number}"
+        return data
+
+    except STKPushFailed as e:
+        logger.error(f"Trigering STKPush failed with exception: {e}")
+        raise STKPushFailed
+
+
+async def trigger_mpesa_stkpush_payment_async(
+    amount: int, phone_number: str
+) -> Optional[Dict]:
+    """Send Mpesa STK push from a route.
+    The checkout response is saved from the threadpool since the database session is sync.
+    """
+    logger.info(f"Trigerring M-Pesa STKPush for KES {amount} to {phone_number}")
+
+    try:
+        data = await initiate_mpesa_stkpush_payment_async(
+            get_mpesa_stkpush_payload(
+                **get_stkpush_deposit_request(amount, phone_number)
             )
-            with SessionLocal() as db:
-                mpesa_payment_dao.create(
-                    db,
-                    obj_in=MpesaPaymentCreateSerializer(
-                        phone_number=phone_number,
-                        merchant_request_id=data["MerchantRequestID"],
-                        checkout_request_id=data["CheckoutRequestID"],
-                        response_code=data["ResponseCode"],
-                        response_description=data["ResponseDescription"],
-                        customer_message=data["CustomerMessage"],
-                    ),
-                )
+        )
+        await run_in_threadpool(save_stkpush_checkout, data, phone_number)
 
         return data
 
@@ -259,32 +496,77 @@ def process_mpesa_paybill_payment(
     transaction_dao.create(db, obj_in=transaction_in)
 
 
+MPESA_CERTIFICATE_PATH = os.path.join(
+    os.path.dirname(__file__), "ProductionCertificate.cer"
+)
+
+
 def get_mpesa_certificate() -> str:
     """Load the M-Pesa certification file that will be used for encryption"""
     logger.info("Retrieving M-Pesa certificate...")
 
-    file_name = "ProductionCertificate.cer"
-    current_path = os.path.dirname(__file__)
-    cert_file_path = os.path.join(current_path, file_name)
+    with open(MPESA_CERTIFICATE_PATH, "r") as cert_file:
+        return cert_file.read()
+
+
+@lru_cache(maxsize=1)
+def load_mpesa_public_key(modified_at: int, size: int) -> Tuple[RSAPublicKey, str]:
+    """Parse the certificate once per version of the file.
+    Returns its public key and the digest of the certificate."""
+    cert_str = get_mpesa_certificate()
+    cert_obj: Certificate = load_pem_x509_certificate(str.encode(cert_str))
+
+    return cert_obj.public_key(), sha256(str.encode(cert_str)).hexdigest()  # type: ignore
+
+
+def get_mpesa_public_key() -> RSAPublicKey:
+    """The public key of the current certificate. A stat of the file is enough
+    to notice a new certificate, so it is only read and parsed when it changes."""
+    cert_stat = os.stat(MPESA_CERTIFICATE_PATH)
+    public_key, _ = load_mpesa_public_key(cert_stat.st_mtime_ns, cert_stat.st_size)
+    return public_key
+
 
-    cert_file = open(cert_file_path, "r")
-    cert_str = cert_file.read()
-    cert_file.close()
+def get_security_credential_fingerprint() -> str:
+    """Identify the certificate and B2C password a credential is encrypted from.
+    The fingerprint is keyed with the SECRET_KEY so that it does not leak the password.
+    """
+    cert_stat = os.stat(MPESA_CERTIFICATE_PATH)
+    _, cert_digest = load_mpesa_public_key(cert_stat.st_mtime_ns, cert_stat.st_size)
 
-    return cert_str
+    return hmac.new(
+        bytes(settings.SECRET_KEY, "utf-8"),
+        msg=bytes(cert_digest + settings.MPESA_B2C_PASSWORD, "utf-8"),
+        digestmod=sha256,
+    ).hexdigest()
 
 
 def get_initiator_security_credential() -> str:
-    """Get cert and extract public key"""
-    cert_str = get_mpesa_certificate()
-    cert_obj: Certificate = load_pem_x509_certificate(str.encode(cert_str))
-    public_key = cert_obj.public_key()
+    """
+    Get the B2C password encrypted with the certificate's public key.
+    The credential is cached in Redis for all workers until it is rotated.
+    A new certificate or password changes the fingerprint in the cache key,
+    so a stale credential is never used.
+    """
+    cache_key = f"mpesa_b2c_security_credential:{get_security_credential_fingerprint()}"
+
+    security_credential = redis.get(cache_key)
+    if security_credential:
+        return security_credential
 
     # Encrypt key with public key and PKCS1v15 padding as recommended by safaricom
     byte_password = bytes(settings.MPESA_B2C_PASSWORD, "utf-8")
-    ciphertext = public_key.encrypt(byte_password, padding=padding.PKCS1v15())  # type: ignore
+    ciphertext = get_mpesa_public_key().encrypt(
+        byte_password, padding=padding.PKCS1v15()
+    )
+    security_credential = b64encode(ciphertext).decode("utf-8")
 
-    return b64encode(ciphertext).decode("utf-8")
+    redis.set(
+        cache_key,
+        security_credential,
+        ex=settings.MPESA_SECURITY_CREDENTIAL_ROTATION_SECONDS,
+    )
+    return security_credential
 
 
 def initiate_b2c_payment(
@@ -302,12 +584,6 @@ def initiate_b2c_payment(
         IS_B2C=True,
     )
 
-    api_url = settings.MPESA_B2C_URL
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-    }
-
     try:
         payload = {
             "InitiatorName": settings.MPESA_B2C_INITIATOR_NAME,
@@ -321,7 +597,11 @@ def initiate_b2c_payment(
             "ResultURL": settings.MPESA_B2C_RESULT_URL,
             "Occassion": occassion,
         }
-        response = requests.post(api_url, json=payload, headers=headers, verify=True)
+        response = mpesa_client.post(
+            settings.MPESA_B2C_URL,
+            json=payload,
+            headers=get_mpesa_headers(access_token),
+        )
         response_data = response.json()
 
         logger.info(f"Received B2C payment response: {response_data}")
@@ -420,6 +700,11 @@ def process_b2c_payment_result(
                 db, db_obj=withdrawal_request, obj_in=updated_withdrawal_request
             )
 
+        elif withdrawal_request.transaction_id is not None and not transaction_dao.get(
+            db, external_transaction_id=withdrawal_request.transaction_id
+        ):  # The withdrawal was updated by a result whose ledger transaction failed
+            withdrawal_dao.create_withdrawal_transaction(db, withdrawal_request)
+
     except Exception as e:
         logger.warning(
             f"Error encountered while processing B2C response: {mpesa_b2c_result.dict()}"
@@ -22,8 +22,12 @@ from app.sessions.daos.session import (
 
 from app.core.config import settings, redis
 from app.core.deps import get_current_active_user
-from app.accounts.daos.account import transaction_dao
-from app.accounts.daos.mpesa import mpesa_payment_dao, withdrawal_dao
+from app.accounts.daos.account import transaction_dao, wallet_balance_dao
+from app.accounts.daos.mpesa import (
+    mpesa_payment_dao,
+    withdrawal_dao,
+    mpesa_callback_dao,
+)
 
 from sqlalchemy.orm import Session
 from typing import Generator, Callable
@@ -104,6 +108,13 @@ def delete_withdrawal_model_instances(db: Session) -> None:
         withdrawal_dao.remove(db, id=transaction.id)
 
 
+@pytest.fixture
+def delete_mpesa_callback_model_instances(db: Session) -> None:
+    """Delete previously existing rows in MpesaCallbacks model"""
+    for mpesa_callback in mpesa_callback_dao.get_all(db):
+        mpesa_callback_dao.remove(db, id=mpesa_callback.id)
+
+
 @pytest.fixture
 def delete_transcation_model_instances(db: Session) -> None:
     # Delete previously existing rows in Transactions model
@@ -111,6 +122,9 @@ def delete_transcation_model_instances(db: Session) -> None:
     for transaction in previous_transactions:
         transaction_dao.remove(db, id=transaction.id)
 
+    for wallet_balance in wallet_balance_dao.get_all(db):
+        wallet_balance_dao.remove(db, id=wallet_balance.id)
+
 
 @pytest.fixture
 def delete_previous_mpesa_payment_transactions(db: Session) -> None:
@@ -0,0 +1,330 @@
+"""
+Benchmark the pairing engine against synthetic result pools.
+
+Run it against a scratch database, e.g. the test database:
+    ./benchmark.sh --drop-tables --sizes 1000 10000 100000 --output baseline.json
+    ./benchmark.sh --drop-tables --sizes 1000 10000 --compare baseline.json
+
+Every table is created before and dropped after each pool size,
+the same way the test suite does, so the benchmark only runs when
+--drop-tables is passed and the database is an empty test database.
+"""
+import json
+import random
+import argparse
+import tracemalloc
+
+from time import perf_counter
+from unittest import mock
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterator, List
+
+from sqlalchemy import insert, inspect, func, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
+
+from app.db.base import Base
+from app.db.base_class import generate_uuid
+from app.db.session import SessionLocal, get_engine
+from app.commons.constants import Categories
+
+from app.core.config import settings, redis
+from app.core.pool import results_pool
+from app.core.utils import PairUsers
+from app.core.metrics import count_queries
+from app.core.raw_logger import logger
+
+from app.users.models import User
+from app.quiz.models import Results
+from app.sessions.models import Sessions
+from app.sessions.daos.session import (
+    duo_session_dao,
+    pool_category_state_dao,
+    duo_session_settlement_dao,
+)
+
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000]
+INSERT_BATCH_SIZE = 5_000
+
+
+class SyntheticPool:
+    """Generate users, sessions and due results that make up a pool to be paired"""
+
+    def __init__(
+        self,
+        *,
+        players: int,
+        categories: int = len(Categories.list_()),
+        sessions_per_category: int = 10,
+        score_distribution: str = "normal",
+        score_spread: float = 3.0,
+        expiry_spread_seconds: int = 600,
+        seed: int = 0,
+    ) -> None:
+        self.players = players
+        self.categories = sorted(Categories.list_())[:categories]
+        self.sessions_per_category = sessions_per_category
+        self.score_distribution = score_distribution
+        self.score_spread = score_spread
+        self.expiry_spread_seconds = expiry_spread_seconds
+        self.random = random.Random(seed)
+
+    def get_score(self) -> float:
+        """A moderated score drawn from the chosen distribution"""
+        lowest_score = settings.MODERATED_LOWEST_SCORE
+        highest_score = settings.MODERATED_HIGHEST_SCORE
+
+        if self.score_distribution == "uniform":
+            score = self.random.uniform(lowest_score, highest_score)
+        else:
+            mean_score = (lowest_score + highest_score) / 2
+            score = self.random.gauss(mean_score, self.score_spread)
+
+        return round(
+            min(max(score, lowest_score), highest_score),
+            settings.SESSION_RESULT_DECIMAL_PLACES,
+        )
+
+    def generate(self, db: Session) -> None:
+        """Insert the pool with multi-row inserts that bypass the DAO hooks,
+        then load it into the pairing pool"""
+        now = datetime.now()
+
+        # Results are past their pairing time and old enough to be loaded
+        due_at = now - timedelta(seconds=settings.RESULT_PAIRS_AFTER_SECONDS + 60)
+        created_at = now - timedelta(
+            seconds=settings.LOAD_SESSION_INTO_QUEUE_AFTER_SECONDS + 60
+        )
+
+        sessions = [
+            {
+                "id": generate_uuid(),
+                "created_at": created_at,
+                "category": category,
+                "questions": "",
+            }
+            for category in self.categories
+            for _ in range(self.sessions_per_category)
+        ]
+        users = [
+            {"id": generate_uuid(), "created_at": created_at, "phone": f"+2547{i:08d}"}
+            for i in range(self.players)
+        ]
+        results = [
+            {
+                "id": generate_uuid(),
+                "created_at": created_at,
+                "user_id": user["id"],
+                "session_id": self.random.choice(sessions)["id"],
+                "score": self.get_score(),
+                "expires_at": due_at
+                - timedelta(seconds=self.random.uniform(0, self.expiry_spread_seconds)),
+                "is_active": True,
+            }
+            for user in users
+        ]
+
+        for table, rows in [
+            (Sessions.__table__, sessions),
+            (User.__table__, users),
+            (Results.__table__, results),
+        ]:
+            for start in range(0, len(rows), INSERT_BATCH_SIZE):
+                end = start + INSERT_BATCH_SIZE
+                db.execute(insert(table), rows[start:end])
+        db.commit()
+
+        results_pool.rebuild(db)
+
+
+class PhaseMetrics:
+    """Wall time, query count and peak memory of one phase"""
+
+    def __init__(self) -> None:
+        self.queries = 0
+        self.seconds = 0.0
+        self.peak_memory_mb = 0.0
+
+    def as_dict(self) -> Dict:
+        return {
+            "seconds": round(self.seconds, 4),
+            "queries": self.queries,
+            "peak_memory_mb": round(self.peak_memory_mb, 2),
+        }
+
+
+@contextmanager
+def measure() -> Iterator[PhaseMetrics]:
+    """Measure the code run inside the context"""
+    metrics = PhaseMetrics()
+    tracemalloc.start()
+    started_at = perf_counter()
+
+    try:
+        with count_queries() as counter:
+            yield metrics
+    finally:
+        metrics.seconds = perf_counter() - started_at
+        metrics.queries = counter.queries
+        metrics.peak_memory_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        tracemalloc.stop()
+
+
+def reset_database() -> None:
+    """Recreate every table and empty the pairing pool"""
+    Base.metadata.drop_all(bind=get_engine())
+    Base.metadata.create_all(bind=get_engine())
+    results_pool.clear()
+    redis.delete(pool_category_state_dao.redis_key)
+
+
+def assert_database_is_disposable(drop_tables: bool) -> None:
+    """Refuse to run unless the tables may be dropped, the database is named as a
+    test database and it holds no users"""
+    if not drop_tables:
+        raise SystemExit(
+            "The benchmark drops every table. Pass --drop-tables to run it."
+        )
+
+    database = make_url(settings.SQLALCHEMY_DATABASE_URI).database or ""
+    if "test" not in database.lower():
+        raise SystemExit(
+            f"The database {database!r} is not a test database. "
+            "Run the benchmark on a database whose name contains 'test'."
+        )
+
+    if not inspect(get_engine()).has_table(User.__tablename__):
+        return
+
+    with SessionLocal() as db:
+        total_users = db.execute(select(func.count()).select_from(User)).scalar()
+
+    if total_users:
+        raise SystemExit(
+            f"The database has {total_users} users. Run the benchmark on an empty database."
+        )
+
+
+def run_benchmark(pool: SyntheticPool) -> Dict[str, Dict]:
+    """Run each pairing phase against a freshly generated pool"""
+    reset_database()
+    with SessionLocal() as db:
+        pool.generate(db)
+
+    pair_users: PairUsers | None = None
+
+    def create_nodes() -> None:
+        nonlocal pair_users
+        pair_users = PairUsers()
+
+    def settle_duo_sessions() -> None:
+        """Drain the settlement queue the way the settlement worker does"""
+        total_settled = settings.DUO_SESSION_SETTLEMENT_BATCH_SIZE
+        while total_settled == settings.DUO_SESSION_SETTLEMENT_BATCH_SIZE:
+            with SessionLocal() as db:
+                total_settled, _ = duo_session_settlement_dao.settle_pending(db)
+
+    def get_closest_nodes() -> None:
+        for node in pair_users.results_queue:
+            pair_users.get_closest_nodes(node)
+
+    phases: Dict[str, Callable] = {
+        "create_nodes": create_nodes,
+        "get_closest_nodes": get_closest_nodes,
+        "set_pool_session_statistics": lambda: pair_users.set_pool_session_statistics(),
+        "match_players": lambda: pair_users.match_players(),
+        "settle_duo_sessions": settle_duo_sessions,
+    }
+
+    report = {}
+    # Do not wake the settlement worker or send SMS to the synthetic players
+    with mock.patch.object(duo_session_settlement_dao, "schedule"), mock.patch.object(
+        duo_session_dao, "send_message"
+    ):
+        for name, phase in phases.items():
+            logger.info(f"Benchmarking {name} with {pool.players} players")
+            with measure() as metrics:
+                phase()
+            report[name] = metrics.as_dict()
+
+    return report
+
+
+def print_report(reports: Dict[str, Dict], baseline: Dict | None = None) -> None:
+    """Print a table of every phase, with the change from the baseline if given"""
+    header = (
+        f"{'players':>8}  {'phase':<28}{'seconds':>10}{'queries':>9}{'peak MB':>10}"
+    )
+    print(header)
+    print("-" * len(header))
+
+    for players, report in reports.items():
+        for phase, metrics in report.items():
+            line = (
+                f"{players:>8}  {phase:<28}{metrics['seconds']:>10.4f}"
+                f"{metrics['queries']:>9}{metrics['peak_memory_mb']:>10.2f}"
+            )
+
+            baseline_metrics = (baseline or {}).get(players, {}).get(phase)
+            if baseline_metrics and baseline_metrics["seconds"]:
+                change = metrics["seconds"] / baseline_metrics["seconds"] - 1
+                line += f"  {change:+.1%} vs baseline"
+            print(line)
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--categories", type=int, default=len(Categories.list_()))
+    parser.add_argument("--sessions-per-category", type=int, default=10)
+    parser.add_argument(
+        "--score-distribution", choices=["normal", "uniform"], default="normal"
+    )
+    parser.add_argument("--score-spread", type=float, default=3.0)
+    parser.add_argument("--expiry-spread-seconds", type=int, default=600)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Save the report as JSON to this file")
+    parser.add_argument("--compare", help="Compare with a report saved by --output")
+    parser.add_argument(
+        "--drop-tables",
+        action="store_true",
+        help="Confirm that every table of the test database may be dropped",
+    )
+    args = parser.parse_args(argv)
+
+    assert_database_is_disposable(args.drop_tables)
+
+    reports = {}
+    try:
+        for size in args.sizes:
+            pool = SyntheticPool(
+                players=size,
+                categories=args.categories,
+                sessions_per_category=args.sessions_per_category,
+                score_distribution=args.score_distribution,
+                score_spread=args.score_spread,
+                expiry_spread_seconds=args.expiry_spread_seconds,
+                seed=args.seed,
+            )
+            reports[str(size)] = run_benchmark(pool)
+    finally:
+        Base.metadata.drop_all(bind=get_engine())
+        results_pool.clear()
+        redis.delete(pool_category_state_dao.redis_key)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    print_report(reports, baseline)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(reports, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,10 +12,45 @@ celery = Celery(
 
 
 scheduled_tasks = {
-    # Run a period task that pairs users, this is the heart of the system
+    # Run a period task that pairs users, this is the heart of the system.
+    # Pairing runs are scheduled when results are created, so this only
+    # picks up results whose scheduled run was lost.
     "pair_users_in_pool": {
         "task": "app.sessions.tasks.pair_users_task",
-        "schedule": crontab(minute="*/3"),
+        "schedule": crontab(minute="*/10"),
+        "options": {"queue": settings.CELERY_SCHEDULER_QUEUE},
+    },
+    # DuoSessions wake the settlement worker when created,
+    # so this only settles events whose worker was not woken.
+    "settle_duo_sessions": {
+        "task": "app.sessions.tasks.settle_duo_sessions_task",
+        "schedule": crontab(minute="*"),
+        "options": {"queue": settings.CELERY_SETTLEMENT_QUEUE},
+    },
+    # Wallet balances are written to the cache on commit,
+    # so this only repairs balances whose write to the cache failed.
+    "verify_wallet_balance_cache": {
+        "task": "app.accounts.tasks.verify_wallet_balance_cache_task",
+        "schedule": crontab(minute="*/5"),
+        "options": {"queue": settings.CELERY_SCHEDULER_QUEUE},
+    },
+    # Callbacks wake the callback worker when queued,
+    # so this only retries callbacks that failed or whose worker died.
+    "process_mpesa_callbacks": {
+        "task": "app.accounts.tasks.process_mpesa_callbacks_task",
+        "schedule": crontab(minute="*"),
+        "options": {"queue": settings.CELERY_CALLBACK_QUEUE},
+    },
+    # Tokens are renewed before they expire, so payments do not fetch them
+    "renew_mpesa_access_tokens": {
+        "task": "app.accounts.tasks.renew_mpesa_access_tokens_task",
+        "schedule": crontab(minute="*"),
+        "options": {"queue": settings.CELERY_SCHEDULER_QUEUE},
+    },
+    # Reconcile the ledger with its balances and M-Pesa records every night
+    "reconcile_ledger": {
+        "task": "app.accounts.tasks.reconcile_ledger_task",
+        "schedule": crontab(minute=0, hour=3),
         "options": {"queue": settings.CELERY_SCHEDULER_QUEUE},
     },
 }
@@ -100,6 +100,7 @@ class Settings(BaseSettings):
     MPESA_B2C_INITIATOR_NAME: str
     MPESA_B2C_QUEUE_TIMEOUT_URL: str
     MPESA_B2C_RESULT_URL: str
+    MPESA_SECURITY_CREDENTIAL_ROTATION_SECONDS: int = 24 * 60 * 60
 
     MPESA_BUSINESS_SHORT_CODE: str
     MPESA_PASS_KEY: str
@@ -117,6 +118,18 @@ class Settings(BaseSettings):
     MPESA_STKPUSH_QUERY_URL: str = (
         "https://sandbox.safaricom.co.ke/mpesa/stkpushquery/v1/query"
     )
+    MPESA_CALLBACK_BATCH_SIZE: int = 50  # Callbacks processed per batch
+    MPESA_CALLBACK_RETRY_AFTER_SECONDS: int = 60  # Retry unacknowledged callbacks after
+    MPESA_CALLBACK_MAX_DELIVERIES: int = 5  # Then move them to the dead letter stream
+    MPESA_CALLBACK_DEDUPE_SECONDS: int = 60 * 60 * 24  # Drop retried callbacks for
+    MPESA_TOKEN_RENEW_BEFORE_SECONDS: int = 5 * 60  # Renew tokens this long before
+    MPESA_TOKEN_LOCK_SECONDS: int = 60  # Longest a token refresh may hold the lock
+    MPESA_TOKEN_WAIT_SECONDS: float = 3.0  # Wait for a refresh when no token is cached
+    MPESA_TOKEN_WAIT_INTERVAL_SECONDS: float = 0.1
+    MPESA_CONNECT_TIMEOUT_SECONDS: float = 5.0
+    MPESA_READ_TIMEOUT_SECONDS: float = 30.0
+    MPESA_MAX_CONNECTIONS: int = 20  # Pooled connections to Safaricom per process
+    MPESA_KEEPALIVE_SECONDS: float = 60.0  # Idle pooled connections are closed after
 
     MONETARY_DECIMAL_PLACES: int = 2  # Decimal places to use for all monetary values
 
@@ -128,6 +141,9 @@ class Settings(BaseSettings):
 
     PAIRING_THRESHOLD = 0.9
     EWMA_MIXING_PARAMETER = 0.8
+    # The EWMA is mixed once per interval, the cadence the mixing parameter was
+    # tuned for, however often pairing runs
+    EWMA_UPDATE_INTERVAL_SECONDS: int = 180
 
     SESSION_RESULT_DECIMAL_PLACES: int = 7  # High accuracy to pevent draws
     SESSION_DURATION: int = 15  # How long the session lasts
@@ -135,6 +151,15 @@ class Settings(BaseSettings):
 
     LOAD_SESSION_INTO_QUEUE_AFTER_SECONDS: int = 180  # 3 minutes
     RESULT_PAIRS_AFTER_SECONDS: int = 1620  # 27 minutes
+    PAIRING_BATCH_SECONDS: int = 15  # Results due together are paired in one run
+    PAIRING_LEASE_SECONDS: int = 30  # Renewed by a heartbeat while the run is alive
+    PAIRING_SETTLEMENT_BATCH_SIZE: int = 500  # DuoSessions committed per transaction
+    PAIRING_CHECKPOINT_EXPIRY_SECONDS: int = 60 * 60 * 24
+    DUO_SESSION_SETTLEMENT_BATCH_SIZE: int = 200  # Settled per worker transaction
+    DUO_SESSION_SETTLEMENT_MAX_ATTEMPTS: int = 5  # Then the event is marked failed
+    # Match the due cohort in one sweep per bucket. This pairs the most players
+    # rather than each player with their nearest partner, so it is opt-in.
+    PAIRING_BATCH_MATCHING: bool = False
 
     MODERATED_LOWEST_SCORE: float = 70.0
     MODERATED_HIGHEST_SCORE: float = 85.0
@@ -145,12 +170,22 @@ class Settings(BaseSettings):
 
     WITHDRAWAL_BUFFER_PERIOD: int = 120  # Once every 2 minutes
 
+    WALLET_BALANCE_CACHE_SECONDS: int = 60 * 60
+    WALLET_BALANCE_CHECK_BATCH_SIZE: int = 500  # Cached balances compared per query
+
+    WALLET_STATEMENT_PAGE_SIZE: int = 20
+    WALLET_STATEMENT_MAX_PAGE_SIZE: int = 100
+    LEDGER_EXPORT_BATCH_SIZE: int = 1000  # Transactions read per keyset page
+    LEDGER_RECONCILIATION_TIMEOUT_SECONDS: int = 30 * 60  # Per reconciliation query
+
     # If values are not set, default to HEROKU env variables
     REDIS_URL: str = os.environ.get("REDIS_URL", "")
     CELERY_BROKER: str = os.environ.get("CELERY_BROKER", REDIS_URL)
     CELERY_RESULT_BACKEND: str = os.environ.get("CELERY_RESULT_BACKEND", REDIS_URL)
 
     CELERY_SCHEDULER_QUEUE: str = "scheduler-queue"
+    CELERY_SETTLEMENT_QUEUE: str = "settlement-queue"
+    CELERY_CALLBACK_QUEUE: str = "callback-queue"
 
     class Config:
         env_file = ".env"
@@ -23,7 +23,7 @@ from phonenumbers import (
     PhoneNumberFormat,
 )
 from pydantic import validator
-from typing import List
+from typing import List, Tuple
 from hashlib import md5, sha256
 from datetime import datetime
 import hmac
@@ -37,6 +37,25 @@ def md5_hash(value: str) -> str:
     return md5(value.encode()).hexdigest()
 
 
+def encode_keyset_cursor(created_at: datetime, id: str) -> str:
+    """Encode the position of the last row of a page as an opaque cursor"""
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{id}".encode()).decode()
+
+
+def decode_keyset_cursor(cursor: str) -> Tuple[datetime, str]:
+    """Decode a cursor into the created_at and id that the next page starts after"""
+    invalid_cursor_exception = HttpErrorException(
+        status_code=HTTPStatus.BAD_REQUEST,
+        error_code=ErrorCodes.INVALID_PAGINATION_CURSOR.name,
+        error_message=ErrorCodes.INVALID_PAGINATION_CURSOR.value,
+    )
+    try:
+        created_at, id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), id
+    except ValueError:
+        raise invalid_cursor_exception
+
+
 def generate_transaction_code():
     """Generate unique transaction codes"""
     logger.info("Generating unique transaction code")
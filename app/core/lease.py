@@ -0,0 +1,73 @@
+import threading
+from redis import Redis
+from redis.exceptions import LockError
+
+from app.core.config import settings, redis
+from app.core.raw_logger import logger
+from app.exceptions.custom import PairingLeaseLost
+
+
+class LeaseLock:
+    """
+    A Redis lock held for a short lease that a heartbeat thread keeps renewing.
+
+    If the holder crashes the heartbeat stops and the lease expires, so another
+    worker can take over without waiting for a long lock timeout.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        lease_seconds: int = settings.PAIRING_LEASE_SECONDS,
+        redis_client: Redis = redis,
+    ) -> None:
+        self.name = name
+        self.lease_seconds = lease_seconds
+
+        # The token is shared with the heartbeat thread
+        self.lock = redis_client.lock(name, timeout=lease_seconds, thread_local=False)
+        self.lost = False
+
+        self._stop_heartbeat = threading.Event()
+        self._heartbeat: threading.Thread | None = None
+
+    def acquire(
+        self, blocking: bool = True, blocking_timeout: float | None = None
+    ) -> bool:
+        """Acquire the lease and start renewing it"""
+        if not self.lock.acquire(blocking=blocking, blocking_timeout=blocking_timeout):
+            return False
+
+        self.lost = False
+        self._stop_heartbeat.clear()
+        self._heartbeat = threading.Thread(target=self._renew, daemon=True)
+        self._heartbeat.start()
+
+        return True
+
+    def _renew(self) -> None:
+        """Reset the lease to its full length a few times per lease"""
+        while not self._stop_heartbeat.wait(self.lease_seconds / 3):
+            try:
+                self.lock.reacquire()
+            except LockError:
+                logger.error(f"Lost the lease on {self.name}")
+                self.lost = True
+                return
+
+    def ensure_held(self) -> None:
+        """Raise PairingLeaseLost if another worker may have taken over"""
+        if self.lost or not self.lock.owned():
+            raise PairingLeaseLost(f"The lease on {self.name} has been lost")
+
+    def release(self) -> None:
+        """Stop renewing the lease and release it if it is still held"""
+        self._stop_heartbeat.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+
+        try:
+            self.lock.release()
+        except LockError:
+            pass  # The lease had already expired
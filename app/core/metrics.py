@@ -0,0 +1,142 @@
+import json
+import threading
+from redis import Redis
+from time import perf_counter
+from collections import Counter
+from datetime import datetime
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
+
+from sqlalchemy import event
+
+from app.db.session import get_engine
+from app.commons.utils import generate_uuid
+from app.core.config import redis
+from app.core.raw_logger import logger
+
+
+class QueryCounter:
+    """Count the SQL statements sent to the database by the thread that created it.
+    The listener is on the shared engine, so the statements of other threads are
+    skipped rather than counted."""
+
+    def __init__(self) -> None:
+        self.queries = 0
+        self.thread_id = threading.get_ident()
+
+    def __call__(self, *args) -> None:
+        if threading.get_ident() == self.thread_id:
+            self.queries += 1
+
+
+@contextmanager
+def count_queries() -> Iterator[QueryCounter]:
+    """Count the SQL statements executed by this thread inside the context"""
+    counter = QueryCounter()
+    engine = get_engine()
+
+    event.listen(engine, "before_cursor_execute", counter)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, "before_cursor_execute", counter)
+
+
+class PairingRunMetrics:
+    """
+    Timings and counters of a pairing run.
+
+    Each phase records its duration, the nodes it handled and its database round
+    trips. The run is emitted as one structured log record and saved to Redis,
+    where the latest run of each shard and running totals are kept as metrics.
+    """
+
+    key_prefix = "pairing_metrics"
+
+    def __init__(self, categories: List[str], redis_client: Redis = redis) -> None:
+        self.redis = redis_client
+        self.shard = ",".join(sorted(categories))
+
+        self.run_id = generate_uuid()
+        self.started_at = datetime.now()
+        self.phases: Dict[str, Dict] = {}
+        self.outcomes: Counter = Counter()
+
+    @property
+    def latest_key(self) -> str:
+        return f"{self.key_prefix}:latest:{self.shard}"
+
+    @property
+    def totals_key(self) -> str:
+        return f"{self.key_prefix}:totals"
+
+    @contextmanager
+    def phase(self, name: str, nodes: int | None = None) -> Iterator[Dict]:
+        """Time a phase of the run. A phase that runs several times is accumulated"""
+        phase = self.phases.setdefault(
+            name, {"seconds": 0.0, "queries": 0, "nodes": 0, "calls": 0}
+        )
+        started_at = perf_counter()
+
+        with count_queries() as counter:
+            try:
+                yield phase
+            finally:
+                phase["seconds"] += perf_counter() - started_at
+                phase["queries"] += counter.queries
+                phase["nodes"] += nodes or 0
+                phase["calls"] += 1
+
+    def count(self, outcome: str, total: int = 1) -> None:
+        """Tally an outcome, e.g. a DuoSession status"""
+        self.outcomes[outcome] += total
+
+    def summary(self) -> Dict:
+        return {
+            "run_id": self.run_id,
+            "shard": self.shard,
+            "started_at": self.started_at.isoformat(),
+            "seconds": round(
+                sum(phase["seconds"] for phase in self.phases.values()), 4
+            ),
+            "queries": sum(phase["queries"] for phase in self.phases.values()),
+            "phases": {
+                name: {**phase, "seconds": round(phase["seconds"], 4)}
+                for name, phase in self.phases.items()
+            },
+            "outcomes": dict(self.outcomes),
+        }
+
+    def emit(self) -> Dict:
+        """Log the run as one record and save it to the metrics in Redis"""
+        summary = self.summary()
+        logger.info(f"Pairing run summary: {json.dumps(summary)}")
+
+        pipeline = self.redis.pipeline()
+        pipeline.set(self.latest_key, json.dumps(summary))
+        pipeline.hincrby(self.totals_key, "runs", 1)
+        for name, phase in summary["phases"].items():
+            pipeline.hincrbyfloat(self.totals_key, f"{name}.seconds", phase["seconds"])
+            pipeline.hincrby(self.totals_key, f"{name}.queries", phase["queries"])
+            pipeline.hincrby(self.totals_key, f"{name}.nodes", phase["nodes"])
+        for outcome, total in summary["outcomes"].items():
+            pipeline.hincrby(self.totals_key, f"outcomes.{outcome}", total)
+        pipeline.execute()
+
+        return summary
+
+    @classmethod
+    def get_metrics(cls, redis_client: Redis = redis) -> Dict:
+        """The latest run of each shard and the totals of all runs"""
+        latest_keys = list(redis_client.scan_iter(match=f"{cls.key_prefix}:latest:*"))
+        latest_runs = redis_client.mget(latest_keys) if latest_keys else []
+
+        totals = {
+            key: float(value) if "." in value else int(value)
+            for key, value in redis_client.hgetall(f"{cls.key_prefix}:totals").items()
+        }
+
+        return {
+            "latest": [json.loads(run) for run in latest_runs if run is not None],
+            "totals": totals,
+        }
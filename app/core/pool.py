@@ -0,0 +1,291 @@
+from redis import Redis
+from redis.client import Pipeline
+from typing import Dict, List, Set
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta
+
+from app.core.config import settings, redis
+from app.core.raw_logger import logger
+from app.core.serializers.core import ResultNode
+
+from app.quiz.models import Results
+from app.sessions.models import Sessions
+
+
+class ResultsPool:
+    """
+    Results waiting to be paired, kept in Redis between pairing runs.
+
+    Each result is saved as a hash and added to two sorted sets:
+    - A bucket for its (category, session_id), scored by the result's score
+    - The expiry set, scored by the time the result becomes eligible for pairing
+    """
+
+    key_prefix = "pairing_pool"
+    load_batch_size = 1000
+
+    def __init__(self, redis_client: Redis = redis) -> None:
+        self.redis = redis_client
+
+        self.warm_key = f"{self.key_prefix}:warm"
+        self.expiry_key = f"{self.key_prefix}:expiry"
+        self.buckets_key = f"{self.key_prefix}:buckets"
+
+    def node_key(self, result_id: str) -> str:
+        return f"{self.key_prefix}:node:{result_id}"
+
+    def bucket_key(self, category: str, session_id: str) -> str:
+        return f"{self.key_prefix}:bucket:{category}:{session_id}"
+
+    @staticmethod
+    def eligible_at(expires_at: datetime) -> float:
+        """The time a result can be paired, as a timestamp"""
+        return (
+            expires_at + timedelta(seconds=settings.RESULT_PAIRS_AFTER_SECONDS)
+        ).timestamp()
+
+    @staticmethod
+    def result_to_node(result: Results) -> ResultNode:
+        """Convert a Results model instance to a ResultNode"""
+        return ResultNode(
+            id=result.id,
+            user_id=result.user_id,
+            category=result.category,
+            session_id=result.session_id,
+            score=float(result.score),
+            expires_at=result.expires_at,
+            is_active=result.is_active,
+        )
+
+    def add(self, node: ResultNode, *, created_at: datetime) -> None:
+        """Add a node to the pool or update its score if it already exists"""
+        logger.info(f"Adding result: {node.id} to the pairing pool")
+
+        pipeline = self.redis.pipeline()
+        self._add_to_pipeline(pipeline, node, created_at=created_at)
+        pipeline.execute()
+
+    def _add_to_pipeline(
+        self, pipeline: Pipeline, node: ResultNode, *, created_at: datetime
+    ) -> None:
+        bucket_key = self.bucket_key(node.category, node.session_id)
+
+        pipeline.hset(
+            self.node_key(node.id),
+            mapping={
+                "user_id": node.user_id,
+                "category": node.category,
+                "session_id": node.session_id,
+                "score": float(node.score),
+                "expires_at": node.expires_at.isoformat(),
+                "created_at": created_at.isoformat(),
+            },
+        )
+        pipeline.zadd(bucket_key, {node.id: float(node.score)})
+        pipeline.zadd(self.expiry_key, {node.id: self.eligible_at(node.expires_at)})
+        pipeline.sadd(self.buckets_key, bucket_key)
+
+    def remove(self, result_id: str) -> None:
+        """Remove a node from the pool. Removing a node not in the pool is a no-op"""
+        self.remove_many([result_id])
+
+    def remove_many(self, result_ids: List[str]) -> None:
+        """Remove several nodes from the pool in two round trips"""
+        if not result_ids:
+            return
+
+        # Use the saved category and session_id because the Results instance
+        # may have changed since it was added to the pool
+        pipeline = self.redis.pipeline()
+        for result_id in result_ids:
+            pipeline.hmget(self.node_key(result_id), "category", "session_id")
+        saved_nodes = pipeline.execute()
+
+        pipeline = self.redis.pipeline()
+        for result_id, (category, session_id) in zip(result_ids, saved_nodes):
+            if category is not None and session_id is not None:
+                pipeline.zrem(self.bucket_key(category, session_id), result_id)
+            pipeline.delete(self.node_key(result_id))
+
+        pipeline.zrem(self.expiry_key, *result_ids)
+        pipeline.execute()
+
+    def due_result_ids(self, now: datetime) -> Set[str]:
+        """Return ids of results that are eligible for pairing at the given time"""
+        return set(self.redis.zrangebyscore(self.expiry_key, "-inf", now.timestamp()))
+
+    def nodes(self, categories: List[str] | None = None) -> List[Dict]:
+        """Return nodes in the pool with the time their result was created.
+        Only nodes in the given categories are returned, which defaults to all nodes.
+        Each element is a dict with the keys `node` and `created_at`"""
+        bucket_keys = list(self.redis.smembers(self.buckets_key))
+        if categories is not None:
+            category_prefixes = tuple(
+                f"{self.key_prefix}:bucket:{category}:" for category in categories
+            )
+            bucket_keys = [
+                bucket_key
+                for bucket_key in bucket_keys
+                if bucket_key.startswith(category_prefixes)
+            ]
+
+        pipeline = self.redis.pipeline()
+        for bucket_key in bucket_keys:
+            pipeline.zrange(bucket_key, 0, -1)
+        buckets = pipeline.execute()
+
+        result_ids = []
+        empty_bucket_keys = []
+        for bucket_key, bucket in zip(bucket_keys, buckets):
+            if not bucket:
+                empty_bucket_keys.append(bucket_key)
+            result_ids.extend(bucket)
+
+        if empty_bucket_keys:
+            self.redis.srem(self.buckets_key, *empty_bucket_keys)
+
+        pipeline = self.redis.pipeline()
+        for result_id in result_ids:
+            pipeline.hgetall(self.node_key(result_id))
+        saved_nodes = pipeline.execute()
+
+        pool_nodes = []
+        for result_id, saved_node in zip(result_ids, saved_nodes):
+            if not saved_node:  # The node was removed while reading the pool
+                continue
+
+            node = ResultNode(
+                id=result_id,
+                user_id=saved_node["user_id"],
+                category=saved_node["category"],
+                session_id=saved_node["session_id"],
+                score=float(saved_node["score"]),
+                expires_at=datetime.fromisoformat(saved_node["expires_at"]),
+                is_active=True,
+            )
+            pool_nodes.append(
+                {
+                    "node": node,
+                    "created_at": datetime.fromisoformat(saved_node["created_at"]),
+                }
+            )
+
+        return pool_nodes
+
+    def drop_inactive(self, db: Session, pool_nodes: List[Dict]) -> List[Dict]:
+        """Remove the nodes whose results are no longer active in the database.
+        A run that stops between committing a settlement and removing its results
+        from the pool leaves them behind, so the database is the source of truth."""
+        result_ids = [pool_node["node"].id for pool_node in pool_nodes]
+        active_result_ids = set()
+        for start in range(0, len(result_ids), self.load_batch_size):
+            end = start + self.load_batch_size
+            active_result_ids.update(
+                db.execute(
+                    select(Results.id).where(
+                        Results.id.in_(result_ids[start:end]),
+                        Results.is_active.is_(True),
+                    )
+                ).scalars()
+            )
+
+        inactive_result_ids = [
+            result_id for result_id in result_ids if result_id not in active_result_ids
+        ]
+        if inactive_result_ids:
+            logger.warning(
+                f"Removing {len(inactive_result_ids)} inactive results from the pool"
+            )
+            self.remove_many(inactive_result_ids)
+
+        return [
+            pool_node
+            for pool_node in pool_nodes
+            if pool_node["node"].id in active_result_ids
+        ]
+
+    def is_warm(self) -> bool:
+        """The pool is warm once it has been loaded from the database"""
+        return bool(self.redis.exists(self.warm_key))
+
+    def clear(self) -> None:
+        """Delete every key in the pool"""
+        keys = list(self.redis.scan_iter(match=f"{self.key_prefix}:*"))
+        if keys:
+            self.redis.delete(*keys)
+
+    def rebuild(self, db: Session) -> None:
+        """Load all active results from the database into an empty pool.
+        Used on first deploy or after Redis has lost the pool."""
+        logger.info("Rebuilding the pairing pool from the database...")
+        self.clear()
+
+        # Select only the columns a node needs and stream them in batches
+        # through a server-side cursor instead of loading Results instances
+        active_results = db.execute(
+            select(
+                Results.id,
+                Results.user_id,
+                Sessions.category,
+                Results.session_id,
+                Results.score,
+                Results.expires_at,
+                Results.created_at,
+            )
+            .join(Sessions, Sessions.id == Results.session_id)
+            .where(Results.is_active.is_(True))
+            .execution_options(yield_per=self.load_batch_size)
+        )
+
+        for partition in active_results.partitions():
+            pipeline = self.redis.pipeline()
+            for row in partition:
+                node = ResultNode(
+                    id=row.id,
+                    user_id=row.user_id,
+                    category=row.category,
+                    session_id=row.session_id,
+                    score=float(row.score),
+                    expires_at=row.expires_at,
+                    is_active=True,
+                )
+                self._add_to_pipeline(pipeline, node, created_at=row.created_at)
+            pipeline.execute()
+
+        self.redis.set(self.warm_key, datetime.now().isoformat())
+
+
+results_pool = ResultsPool()
+
+
+class PairingCheckpoint:
+    """
+    Results settled by a pairing run that has not finished.
+
+    A run that crashes or loses its lease leaves its checkpoint behind so that
+    the next run can resume without settling those results again.
+    """
+
+    key_prefix = "pairing_checkpoint"
+
+    def __init__(self, name: str, redis_client: Redis = redis) -> None:
+        self.redis = redis_client
+        self.key = f"{self.key_prefix}:{name}"
+
+    def settled_result_ids(self) -> Set[str]:
+        return self.redis.smembers(self.key)
+
+    def add(self, result_ids: List[str]) -> None:
+        """Record results whose settlement has been committed"""
+        if not result_ids:
+            return
+
+        pipeline = self.redis.pipeline()
+        pipeline.sadd(self.key, *result_ids)
+        pipeline.expire(self.key, settings.PAIRING_CHECKPOINT_EXPIRY_SECONDS)
+        pipeline.execute()
+
+    def clear(self) -> None:
+        """Delete the checkpoint once the run has finished"""
+        self.redis.delete(self.key)
@@ -0,0 +1,456 @@
+"""
+Replay the pairing engine against a historical window of results.
+
+The replay is read-only: results and PoolSessionStats are read in a read-only
+transaction and the DuoSessions, transactions and messages a run would have
+created are written to a sink instead. Run it against a copy of production, e.g.
+    ./replay.sh --start 2023-07-01T00:00:00 --end 2023-07-02T00:00:00 --output replay.ndjson
+"""
+import sys
+import json
+import argparse
+
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, IO, List, Set, Tuple
+
+from sqlalchemy import select, text
+from sqlalchemy.orm import Session
+
+from app.db.session import SessionLocal
+from app.commons.constants import Categories
+
+from app.core.config import settings
+from app.core.logger import logger
+from app.core.pool import ResultsPool
+from app.core.utils import PairUsers
+from app.core.metrics import PairingRunMetrics
+from app.core.scheduler import PairingScheduler
+from app.core.serializers.core import ResultNode
+
+from app.quiz.models import Results
+from app.sessions.models import Sessions, PoolSessionStats
+from app.sessions.daos.session import pool_category_state_dao
+from app.sessions.serializers.session import DuoSessionCreateSerializer
+
+MATCHING_PER_NODE = "per_node"
+MATCHING_BATCH = "batch"
+
+
+class ReplaySink:
+    """Receives what a replayed pairing run would have saved"""
+
+    def write_replay(self, options: Dict) -> None:
+        """The window and matching mode being replayed"""
+
+    def write_statistics(self, as_of: datetime, statistics: Dict) -> None:
+        """The PoolSessionStats of a run"""
+
+    def write_settlement(
+        self,
+        as_of: datetime,
+        duo_session_in: DuoSessionCreateSerializer,
+        nodes: List[ResultNode],
+    ) -> None:
+        """A DuoSession and the results it settles"""
+
+    def write_run(self, as_of: datetime, metrics: Dict) -> None:
+        """The phase timings and outcome counts of a run"""
+
+
+class ReplayReport(ReplaySink):
+    """Keep the replay in memory and summarize it"""
+
+    def __init__(self) -> None:
+        self.options: Dict = {}
+        self.statistics: List[Dict] = []
+        self.settlements: List[Dict] = []
+        self.runs: List[Dict] = []
+
+    def write_replay(self, options: Dict) -> None:
+        self.options = options
+
+    def write_statistics(self, as_of: datetime, statistics: Dict) -> None:
+        self.statistics.append({"as_of": as_of, "statistics": statistics})
+
+    def write_settlement(
+        self,
+        as_of: datetime,
+        duo_session_in: DuoSessionCreateSerializer,
+        nodes: List[ResultNode],
+    ) -> None:
+        self.settlements.append(
+            {
+                "as_of": as_of,
+                "duo_session": duo_session_in.dict(),
+                "result_ids": [node.id for node in nodes],
+            }
+        )
+
+    def write_run(self, as_of: datetime, metrics: Dict) -> None:
+        self.runs.append({"as_of": as_of, "metrics": metrics})
+
+    def summary(self) -> Dict:
+        """Totals of the replay and the EWMA of each category after every run"""
+        statuses = Counter(
+            settlement["duo_session"]["status"] for settlement in self.settlements
+        )
+        winners = Counter(
+            settlement["duo_session"]["winner_id"]
+            for settlement in self.settlements
+            if settlement["duo_session"]["winner_id"] is not None
+        )
+
+        return {
+            "matching": self.options.get("matching"),
+            "runs": len(self.runs),
+            "seconds": round(sum(run["metrics"]["seconds"] for run in self.runs), 4),
+            "settlements": len(self.settlements),
+            "statuses": dict(statuses),
+            "winners": dict(winners),
+            "ewmas": [
+                {
+                    "as_of": run_statistics["as_of"].isoformat(),
+                    **pool_category_state_dao.get_ewmas_from_statistics(
+                        run_statistics["statistics"]
+                    ),
+                }
+                for run_statistics in self.statistics
+            ],
+        }
+
+
+class JSONLinesSink(ReplaySink):
+    """Stream the replay to a file as one JSON record per line"""
+
+    def __init__(self, output: IO[str]) -> None:
+        self.output = output
+
+    def write(self, record: Dict) -> None:
+        self.output.write(json.dumps(record, default=str) + "\n")
+
+    def write_replay(self, options: Dict) -> None:
+        self.write({"type": "replay", **options})
+
+    def write_statistics(self, as_of: datetime, statistics: Dict) -> None:
+        self.write({"type": "statistics", "as_of": as_of, "statistics": statistics})
+
+    def write_settlement(
+        self,
+        as_of: datetime,
+        duo_session_in: DuoSessionCreateSerializer,
+        nodes: List[ResultNode],
+    ) -> None:
+        self.write(
+            {
+                "type": "settlement",
+                "as_of": as_of,
+                "duo_session": duo_session_in.dict(),
+                "result_ids": [node.id for node in nodes],
+            }
+        )
+
+    def write_run(self, as_of: datetime, metrics: Dict) -> None:
+        self.write({"type": "run", "as_of": as_of, "metrics": metrics})
+
+
+class MultiSink(ReplaySink):
+    """Write the replay to several sinks"""
+
+    def __init__(self, *sinks: ReplaySink) -> None:
+        self.sinks = sinks
+
+    def write_replay(self, options: Dict) -> None:
+        for sink in self.sinks:
+            sink.write_replay(options)
+
+    def write_statistics(self, as_of: datetime, statistics: Dict) -> None:
+        for sink in self.sinks:
+            sink.write_statistics(as_of, statistics)
+
+    def write_settlement(
+        self,
+        as_of: datetime,
+        duo_session_in: DuoSessionCreateSerializer,
+        nodes: List[ResultNode],
+    ) -> None:
+        for sink in self.sinks:
+            sink.write_settlement(as_of, duo_session_in, nodes)
+
+    def write_run(self, as_of: datetime, metrics: Dict) -> None:
+        for sink in self.sinks:
+            sink.write_run(as_of, metrics)
+
+
+class ReplayRunMetrics(PairingRunMetrics):
+    """Run metrics that are returned to the replay instead of saved to Redis"""
+
+    def emit(self) -> Dict:
+        return self.summary()
+
+
+class ReplayPairUsers(PairUsers):
+    """
+    A pairing run at a point in the past.
+
+    Nodes are read from the replayed window instead of the pairing pool, the
+    EWMAs and the times they were mixed are carried over from the previous
+    replayed run and settlements are written to the sink.
+    Results are matched per node unless batch matching is asked for,
+    whatever PAIRING_BATCH_MATCHING is set to.
+    """
+
+    metrics_class = ReplayRunMetrics
+
+    def __init__(
+        self,
+        pool_nodes: List[Dict],
+        *,
+        as_of: datetime,
+        previous_ewmas: Dict[str, float],
+        ewma_updated_at: Dict[str, datetime],
+        sink: ReplaySink,
+        categories: List[str] | None = None,
+        batch_matching: bool = False,
+    ) -> None:
+        self.pool_nodes = pool_nodes
+        self.as_of = as_of
+        self.previous_ewmas = previous_ewmas
+        self.ewma_updated_at = ewma_updated_at
+        self.sink = sink
+        self.settled_result_ids: Set[str] = set()
+
+        super().__init__(categories)
+        self.batch_matching = batch_matching
+
+    def create_nodes(self) -> None:
+        """Create nodes for the results that were in the pool at the time"""
+        x_seconds_ago = self.as_of - timedelta(
+            seconds=settings.LOAD_SESSION_INTO_QUEUE_AFTER_SECONDS
+        )
+
+        with self.metrics.phase("index_build") as phase:
+            for pool_node in self.pool_nodes:
+                result_node = pool_node["node"]
+                if (
+                    pool_node["created_at"] >= x_seconds_ago
+                    or result_node.category not in self.categories
+                ):
+                    continue
+
+                self.score_index.add(result_node)
+                self.results_queue.append(result_node)
+
+            self.results_queue.sort(key=lambda node: node.expires_at)
+            phase["nodes"] += len(self.results_queue)
+
+    def get_previous_ewmas(self) -> Dict[str, float]:
+        return dict(self.previous_ewmas)
+
+    def should_update_ewma(self, category: str) -> bool:
+        updated_at = self.ewma_updated_at.get(category)
+        if updated_at is not None and self.as_of - updated_at < timedelta(
+            seconds=settings.EWMA_UPDATE_INTERVAL_SECONDS
+        ):
+            return False
+
+        self.ewma_updated_at[category] = self.as_of
+        return True
+
+    def get_due_result_ids(self) -> Set[str]:
+        as_of = self.as_of.timestamp()
+        return {
+            node.id
+            for node in self.results_queue
+            if ResultsPool.eligible_at(node.expires_at) <= as_of
+        }
+
+    def set_pool_session_statistics(self) -> None:
+        self.sink.write_statistics(self.as_of, self.calculate_pool_statistics())
+
+    def settle_duo_sessions(
+        self, settlements: List[Tuple[DuoSessionCreateSerializer, List[ResultNode]]]
+    ) -> None:
+        """Write the settlements to the sink. DuoSessions are not validated
+        against wallet balances because no transactions are created."""
+        with self.metrics.phase("duo_session_creation", nodes=len(settlements)):
+            for duo_session_in, nodes in settlements:
+                self.sink.write_settlement(self.as_of, duo_session_in, nodes)
+                self.metrics.count(duo_session_in.status)
+                self.settled_result_ids.update(node.id for node in nodes)
+
+
+class HistoricalReplay:
+    """
+    Replay every pairing run of a window of results.
+
+    Results created in the window are paired at the end of the batch window in
+    which they became eligible, the same way the PairingScheduler runs them,
+    until every result is settled. Each run starts from the EWMAs of the run
+    before it, and the first run from the last PoolSessionStats before the window.
+    """
+
+    def __init__(
+        self,
+        *,
+        start: datetime,
+        end: datetime,
+        sink: ReplaySink,
+        categories: List[str] | None = None,
+        matching: str = MATCHING_PER_NODE,
+    ) -> None:
+        self.start = start
+        self.end = end
+        self.sink = sink
+        self.categories = categories or Categories.list_()
+        self.matching = matching
+
+    def load_pool_nodes(self, db: Session) -> List[Dict]:
+        """Load every result created in the window as a node"""
+        rows = db.execute(
+            select(
+                Results.id,
+                Results.user_id,
+                Sessions.category,
+                Results.session_id,
+                Results.score,
+                Results.expires_at,
+                Results.created_at,
+            )
+            .join(Sessions, Sessions.id == Results.session_id)
+            .where(Results.created_at >= self.start, Results.created_at < self.end)
+            .where(Sessions.category.in_(self.categories))
+            .execution_options(yield_per=ResultsPool.load_batch_size)
+        )
+
+        return [
+            {
+                "node": ResultNode(
+                    id=row.id,
+                    user_id=row.user_id,
+                    category=row.category,
+                    session_id=row.session_id,
+                    score=float(row.score),
+                    expires_at=row.expires_at,
+                    is_active=True,
+                ),
+                "created_at": row.created_at,
+            }
+            for row in rows
+        ]
+
+    def load_previous_ewmas(self, db: Session) -> Dict[str, float]:
+        """The EWMAs saved by the last PoolSessionStats before the window"""
+        previous_pool_session_stats = db.execute(
+            select(PoolSessionStats)
+            .where(PoolSessionStats.created_at < self.start)
+            .order_by(PoolSessionStats.created_at.desc())
+            .limit(1)
+        ).scalar_one_or_none()
+
+        if previous_pool_session_stats is None:
+            return {}
+
+        return pool_category_state_dao.get_ewmas_from_statistics(
+            previous_pool_session_stats.statistics
+        )
+
+    def get_run_times(self, pool_nodes: List[Dict]) -> List[datetime]:
+        """The end of every batch window in which a result became eligible"""
+        window_ends = {
+            PairingScheduler.get_window_end(
+                ResultsPool.eligible_at(pool_node["node"].expires_at)
+            )
+            for pool_node in pool_nodes
+        }
+        return [
+            datetime.fromtimestamp(window_end) for window_end in sorted(window_ends)
+        ]
+
+    def run(self) -> None:
+        """Replay the window and write every run to the sink"""
+        with SessionLocal() as db:
+            # Guard against the replay writing to the database
+            db.execute(text("SET TRANSACTION READ ONLY"))
+            pool_nodes = self.load_pool_nodes(db)
+            previous_ewmas = self.load_previous_ewmas(db)
+            db.rollback()
+
+        ewma_updated_at: Dict[str, datetime] = {}
+        self.sink.write_replay(
+            {
+                "start": self.start,
+                "end": self.end,
+                "categories": self.categories,
+                "matching": self.matching,
+            }
+        )
+
+        logger.info(
+            f"Replaying {len(pool_nodes)} results from {self.start} to {self.end}"
+        )
+        for as_of in self.get_run_times(pool_nodes):
+            pair_users = ReplayPairUsers(
+                pool_nodes,
+                as_of=as_of,
+                previous_ewmas=previous_ewmas,
+                ewma_updated_at=ewma_updated_at,
+                sink=self.sink,
+                categories=self.categories,
+                batch_matching=self.matching == MATCHING_BATCH,
+            )
+            pair_users.match_players()
+
+            self.sink.write_run(as_of, pair_users.metrics.emit())
+            previous_ewmas = {
+                **previous_ewmas,
+                **pool_category_state_dao.get_ewmas_from_statistics(
+                    pair_users.statistics
+                ),
+            }
+            pool_nodes = [
+                pool_node
+                for pool_node in pool_nodes
+                if pool_node["node"].id not in pair_users.settled_result_ids
+            ]
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--start", type=datetime.fromisoformat, required=True)
+    parser.add_argument("--end", type=datetime.fromisoformat, required=True)
+    parser.add_argument("--categories", nargs="+", choices=Categories.list_())
+    parser.add_argument(
+        "--matching",
+        choices=[MATCHING_PER_NODE, MATCHING_BATCH],
+        default=MATCHING_PER_NODE,
+        help="Match each result with its closest partner or the due cohort in one sweep",
+    )
+    parser.add_argument(
+        "--output", help="Stream every record as JSON lines to this file"
+    )
+    args = parser.parse_args(argv)
+
+    report = ReplayReport()
+    output_file = open(args.output, "w") if args.output else None
+    sink = MultiSink(report, JSONLinesSink(output_file)) if output_file else report
+
+    try:
+        replay = HistoricalReplay(
+            start=args.start,
+            end=args.end,
+            sink=sink,
+            categories=args.categories,
+            matching=args.matching,
+        )
+        replay.run()
+    finally:
+        if output_file is not None:
+            output_file.close()
+
+    json.dump(report.summary(), sys.stdout, indent=2, default=str)
+    print()
+
+
+if __name__ == "__main__":
+    main()
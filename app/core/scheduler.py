@@ -0,0 +1,76 @@
+import math
+from redis import Redis
+from datetime import datetime
+
+from app.core.config import settings, redis
+from app.core.raw_logger import logger
+from app.core.celery_app import celery
+from app.core.pool import ResultsPool
+
+
+class PairingScheduler:
+    """
+    Schedule a pairing run for the moment a result becomes eligible for pairing.
+
+    Eligibility times are rounded up to the end of a PAIRING_BATCH_SECONDS window
+    and only the first result in a window enqueues a run. Results that become due
+    together are therefore paired in one micro-batch.
+    """
+
+    key_prefix = "pairing_scheduler"
+    task_name = "app.sessions.tasks.pair_users_task"
+
+    def __init__(self, redis_client: Redis = redis) -> None:
+        self.redis = redis_client
+
+    def window_key(self, window_end: int) -> str:
+        return f"{self.key_prefix}:window:{window_end}"
+
+    @staticmethod
+    def get_window_end(eligible_at: float) -> int:
+        """The end of the batch window an eligibility time falls in, as a timestamp"""
+        batch_seconds = settings.PAIRING_BATCH_SECONDS
+        return math.ceil(eligible_at / batch_seconds) * batch_seconds
+
+    def schedule(self, expires_at: datetime) -> None:
+        """Enqueue a pairing run for the batch window the result falls in,
+        unless one has already been enqueued"""
+        self.schedule_window(self.get_window_end(ResultsPool.eligible_at(expires_at)))
+
+    def schedule_next_window(self) -> None:
+        """Enqueue a pairing run for the next batch window,
+        e.g. to pair a category whose run was skipped"""
+        self.schedule_window(
+            self.get_window_end(
+                datetime.now().timestamp() + settings.PAIRING_BATCH_SECONDS
+            )
+        )
+
+    def schedule_window(self, window_end: int) -> None:
+        """Enqueue a pairing run for the end of a batch window,
+        unless one has already been enqueued"""
+        countdown = max(window_end - datetime.now().timestamp(), 0)
+
+        is_first_in_window = self.redis.set(
+            self.window_key(window_end),
+            1,
+            nx=True,
+            ex=int(countdown) + settings.PAIRING_BATCH_SECONDS,
+        )
+        if not is_first_in_window:
+            return
+
+        try:
+            logger.info(f"Scheduling a pairing run in {countdown} seconds")
+            celery.send_task(
+                self.task_name,
+                countdown=countdown,
+                queue=settings.CELERY_SCHEDULER_QUEUE,
+            )
+        except Exception as e:
+            # The periodic pairing run picks up results whose run was not scheduled
+            logger.error(f"Exception {e} while scheduling a pairing run")
+            self.redis.delete(self.window_key(window_end))
+
+
+pairing_scheduler = PairingScheduler()
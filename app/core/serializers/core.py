@@ -1,8 +1,20 @@
+import sys
 from pydantic import BaseModel
 from datetime import datetime
 
 
 class ResultNode:
+    # Nodes are created for every result in the pool, so avoid a __dict__ per node
+    __slots__ = (
+        "id",
+        "category",
+        "user_id",
+        "session_id",
+        "score",
+        "expires_at",
+        "is_active",
+    )
+
     def __init__(
         self,
         *,
@@ -14,11 +26,12 @@ class ResultNode:
         expires_at: datetime,
         is_active: bool
     ) -> None:
-        """Represent each result model instance as a node"""
+        """Represent each result model instance as a node.
+        Categories and session ids repeat across nodes so they are interned"""
         self.id = id
-        self.category = category
+        self.category = sys.intern(category)
         self.user_id = user_id
-        self.session_id = session_id
+        self.session_id = sys.intern(session_id)
         self.score = score
         self.expires_at = expires_at
         self.is_active = is_active
@@ -0,0 +1,42 @@
+import time
+import pytest
+from typing import Callable
+
+from app.core.config import redis
+from app.core.lease import LeaseLock
+from app.exceptions.custom import PairingLeaseLost
+
+
+def test_lease_lock_is_exclusive(flush_redis: Callable) -> None:
+    """Assert that a second holder can not acquire a held lease"""
+    lease = LeaseLock("test_lease", lease_seconds=5)
+    other_lease = LeaseLock("test_lease", lease_seconds=5)
+
+    assert lease.acquire(blocking_timeout=0.1) is True
+    assert other_lease.acquire(blocking_timeout=0.1) is False
+
+    lease.release()
+    assert other_lease.acquire(blocking_timeout=0.1) is True
+    other_lease.release()
+
+
+def test_lease_lock_heartbeat_renews_the_lease(flush_redis: Callable) -> None:
+    """Assert that the lease outlives its length while the holder is alive"""
+    lease = LeaseLock("test_lease", lease_seconds=1)
+    lease.acquire(blocking_timeout=0.1)
+
+    time.sleep(1.5)
+    lease.ensure_held()
+    lease.release()
+
+
+def test_lease_lock_raises_once_lost(flush_redis: Callable) -> None:
+    """Assert that the holder learns when another worker may have taken over"""
+    lease = LeaseLock("test_lease", lease_seconds=5)
+    lease.acquire(blocking_timeout=0.1)
+
+    redis.delete("test_lease")  # The lease expired while the holder was stalled
+
+    with pytest.raises(PairingLeaseLost):
+        lease.ensure_held()
+    lease.release()
@@ -0,0 +1,59 @@
+import threading
+from typing import Callable
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from app.commons.constants import Categories
+from app.db.session import SessionLocal
+from app.core.metrics import PairingRunMetrics, count_queries
+from app.sessions.constants import DuoSessionStatuses
+
+
+def test_pairing_run_metrics_accumulates_phases(db: Session) -> None:
+    """Assert phases that run several times are added up"""
+    metrics = PairingRunMetrics([Categories.BIBLE.value])
+
+    for _ in range(2):
+        with metrics.phase("deactivation", nodes=3):
+            db.execute(text("SELECT 1"))
+
+    phase = metrics.summary()["phases"]["deactivation"]
+    assert phase["calls"] == 2
+    assert phase["nodes"] == 6
+    assert phase["queries"] == 2
+
+
+def test_pairing_run_metrics_emits_latest_run_and_totals(
+    flush_redis: Callable,
+) -> None:
+    """Assert emitted runs are exposed as the latest run and added to the totals"""
+    for _ in range(2):
+        metrics = PairingRunMetrics([Categories.BIBLE.value])
+        with metrics.phase("matching", nodes=4):
+            pass
+        metrics.count(DuoSessionStatuses.PAIRED.value, 2)
+        summary = metrics.emit()
+
+    pairing_metrics = PairingRunMetrics.get_metrics()
+
+    assert pairing_metrics["latest"] == [summary]
+    assert pairing_metrics["totals"]["runs"] == 2
+    assert pairing_metrics["totals"]["matching.nodes"] == 8
+    assert pairing_metrics["totals"][f"outcomes.{DuoSessionStatuses.PAIRED.value}"] == 4
+
+
+def test_count_queries_skips_queries_of_other_threads(db: Session) -> None:
+    """Assert queries run concurrently by another thread are not counted"""
+
+    def run_queries() -> None:
+        with SessionLocal() as other_db:
+            for _ in range(3):
+                other_db.execute(text("SELECT 1"))
+
+    with count_queries() as counter:
+        db.execute(text("SELECT 1"))
+        thread = threading.Thread(target=run_queries)
+        thread.start()
+        thread.join()
+
+    assert counter.queries == 1
@@ -0,0 +1,126 @@
+from typing import Callable
+from sqlalchemy.orm import Session
+from datetime import timedelta
+
+from app.core.config import settings
+from app.core.pool import results_pool, PairingCheckpoint
+from app.core.utils import PairUsers
+from app.quiz.daos.quiz import result_dao
+
+
+def test_results_pool_contains_created_results(
+    db: Session,
+    flush_redis: Callable,
+    create_result_instances_to_be_paired: Callable,
+) -> None:
+    """Assert that results are added to the pool with their latest score"""
+    results = result_dao.get_all(db, is_active=True)
+    pool_nodes = {
+        pool_node["node"].id: pool_node["node"] for pool_node in results_pool.nodes()
+    }
+
+    assert len(pool_nodes) == len(results)
+    for result in results:
+        assert pool_nodes[result.id].score == float(result.score)
+        assert pool_nodes[result.id].session_id == result.session_id
+
+
+def test_results_pool_removes_deactivated_results(
+    db: Session,
+    flush_redis: Callable,
+    create_result_instances_to_be_paired: Callable,
+) -> None:
+    """Assert that a result leaves the pool once it is deactivated"""
+    result = result_dao.get_all(db)[0]
+    result_dao.update(db, db_obj=result, obj_in={"is_active": False})
+
+    pool_node_ids = [pool_node["node"].id for pool_node in results_pool.nodes()]
+    due_result_ids = results_pool.due_result_ids(
+        result.expires_at + timedelta(seconds=settings.RESULT_PAIRS_AFTER_SECONDS + 60)
+    )
+
+    assert result.id not in pool_node_ids
+    assert result.id not in due_result_ids
+
+
+def test_results_pool_returns_only_due_results(
+    db: Session,
+    flush_redis: Callable,
+    create_result_instances_to_be_paired: Callable,
+) -> None:
+    """Assert that results are only due once they are eligible for pairing"""
+    result = result_dao.get_all(db)[0]
+    eligible_at = result.expires_at + timedelta(
+        seconds=settings.RESULT_PAIRS_AFTER_SECONDS
+    )
+
+    assert result.id not in results_pool.due_result_ids(result.expires_at)
+    assert result.id in results_pool.due_result_ids(eligible_at)
+
+
+def test_results_pool_rebuild_loads_active_results(
+    db: Session,
+    create_result_instances_to_be_paired: Callable,
+) -> None:
+    """Assert that the pool can be rebuilt from the database"""
+    results_pool.clear()
+    assert results_pool.is_warm() is False
+
+    results_pool.rebuild(db)
+    results = result_dao.get_all(db, is_active=True)
+    pool_node_ids = {pool_node["node"].id for pool_node in results_pool.nodes()}
+
+    assert results_pool.is_warm() is True
+    assert pool_node_ids == {result.id for result in results}
+
+
+def test_results_pool_rebuild_loads_node_fields(
+    db: Session,
+    create_result_instances_to_be_paired: Callable,
+) -> None:
+    """Assert that nodes loaded on rebuild match their results"""
+    results_pool.rebuild(db)
+    pool_nodes = {pool_node["node"].id: pool_node for pool_node in results_pool.nodes()}
+
+    for result in result_dao.get_all(db, is_active=True):
+        pool_node = pool_nodes[result.id]
+        assert pool_node["node"].category == result.category
+        assert pool_node["node"].score == float(result.score)
+        assert pool_node["node"].user_id == result.user_id
+        assert pool_node["created_at"] == result.created_at
+
+
+def test_pair_users_resumes_from_checkpoint(
+    db: Session,
+    flush_redis: Callable,
+    create_result_instances_to_be_paired: Callable,
+) -> None:
+    """Assert that results settled by an unfinished run are not paired again"""
+    result = result_dao.get_all(db)[0]
+    checkpoint = PairingCheckpoint("test")
+    checkpoint.add([result.id])
+
+    pair_users = PairUsers(checkpoint=checkpoint)
+    pool_node_ids = {pool_node["node"].id for pool_node in results_pool.nodes()}
+
+    assert result.id not in pool_node_ids
+    assert result.id not in [node.id for node in pair_users.results_queue]
+
+
+def test_pair_users_drops_results_deactivated_but_left_in_the_pool(
+    db: Session,
+    flush_redis: Callable,
+    create_result_instances_to_be_paired: Callable,
+) -> None:
+    """Assert that a result deactivated by a run that stopped before removing it
+    from the pool is removed instead of being paired again"""
+    result = result_dao.get_all(db)[0]
+    result_dao.deactivate_many(db, ids=[result.id])
+    db.commit()
+
+    pair_users = PairUsers()
+    pool_node_ids = {pool_node["node"].id for pool_node in results_pool.nodes()}
+
+    assert result.id not in pool_node_ids
+    assert result.id not in [node.id for node in pair_users.results_queue]
+    assert len(pool_node_ids) == len(result_dao.get_all(db, is_active=True))
@@ -0,0 +1,94 @@
+import pytest
+from typing import Callable
+from sqlalchemy.orm import Session
+from pytest_mock import MockerFixture
+from datetime import datetime, timedelta
+
+from app.core.config import settings
+from app.core.replay import (
+    HistoricalReplay,
+    ReplayReport,
+    ReplayPairUsers,
+    MATCHING_BATCH,
+    MATCHING_PER_NODE,
+)
+
+from app.quiz.daos.quiz import result_dao
+from app.sessions.daos.session import duo_session_dao, pool_session_stats_dao
+
+
+def test_historical_replay_settles_every_result_without_writing(
+    db: Session,
+    flush_redis: Callable,
+    create_result_instances_to_be_paired: Callable,
+) -> None:
+    """Assert that a replay settles each result once and saves nothing"""
+    results = result_dao.get_all(db)
+    total_duo_sessions = len(duo_session_dao.get_all(db))
+    total_pool_session_stats = len(pool_session_stats_dao.get_all(db))
+    report = ReplayReport()
+
+    HistoricalReplay(
+        start=datetime.now() - timedelta(hours=1),
+        end=datetime.now() + timedelta(minutes=1),
+        sink=report,
+    ).run()
+
+    settled_result_ids = [
+        result_id
+        for settlement in report.settlements
+        for result_id in settlement["result_ids"]
+    ]
+
+    assert sorted(settled_result_ids) == sorted(result.id for result in results)
+    assert report.runs and len(report.statistics) == len(report.runs)
+    assert len(duo_session_dao.get_all(db)) == total_duo_sessions
+    assert len(pool_session_stats_dao.get_all(db)) == total_pool_session_stats
+    assert all(result.is_active for result in result_dao.get_all(db))
+
+
+def test_historical_replay_excludes_results_outside_the_window(
+    db: Session,
+    flush_redis: Callable,
+    create_result_instances_to_be_paired: Callable,
+) -> None:
+    """Assert that results created outside the window are not replayed"""
+    report = ReplayReport()
+
+    HistoricalReplay(
+        start=datetime.now() + timedelta(minutes=1),
+        end=datetime.now() + timedelta(hours=1),
+        sink=report,
+    ).run()
+
+    assert report.summary()["settlements"] == 0
+    assert report.runs == []
+
+
+@pytest.mark.parametrize(
+    "matching, batch_matching",
+    [(MATCHING_PER_NODE, True), (MATCHING_BATCH, False)],
+)
+def test_historical_replay_uses_its_own_matching_mode(
+    flush_redis: Callable,
+    mocker: MockerFixture,
+    create_result_instances_to_be_paired: Callable,
+    matching: str,
+    batch_matching: bool,
+) -> None:
+    """Assert that the replay matches in the mode it was given and records it"""
+    mocker.patch.object(settings, "PAIRING_BATCH_MATCHING", batch_matching)
+    spy_get_batch_settlements = mocker.spy(ReplayPairUsers, "get_batch_settlements")
+    spy_get_settlements = mocker.spy(ReplayPairUsers, "get_settlements")
+    report = ReplayReport()
+
+    HistoricalReplay(
+        start=datetime.now() - timedelta(hours=1),
+        end=datetime.now() + timedelta(minutes=1),
+        sink=report,
+        matching=matching,
+    ).run()
+
+    assert report.summary()["matching"] == matching
+    assert spy_get_batch_settlements.called is (matching == MATCHING_BATCH)
+    assert spy_get_settlements.called is (matching == MATCHING_PER_NODE)
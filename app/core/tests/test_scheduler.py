@@ -0,0 +1,50 @@
+from typing import Callable
+from pytest_mock import MockerFixture
+from datetime import datetime, timedelta
+
+from app.core.config import settings
+from app.core.scheduler import pairing_scheduler
+
+
+def test_schedule_enqueues_one_run_per_batch_window(
+    mocker: MockerFixture, flush_redis: Callable
+) -> None:
+    """Assert results that become eligible in the same window are paired by one run"""
+    mock_send_task = mocker.patch("app.core.scheduler.celery.send_task")
+    eligible_at = pairing_scheduler.get_window_end(
+        datetime.now().timestamp() + settings.PAIRING_BATCH_SECONDS
+    )
+    expires_at = datetime.fromtimestamp(eligible_at) - timedelta(
+        seconds=settings.RESULT_PAIRS_AFTER_SECONDS
+    )
+
+    pairing_scheduler.schedule(expires_at)
+    pairing_scheduler.schedule(expires_at - timedelta(seconds=1))
+    assert mock_send_task.call_count == 1
+
+    pairing_scheduler.schedule(expires_at + timedelta(seconds=1))
+    assert mock_send_task.call_count == 2
+    assert mock_send_task.call_args.kwargs["queue"] == settings.CELERY_SCHEDULER_QUEUE
+
+
+def test_get_window_end_is_never_before_eligibility() -> None:
+    """Assert a result is due by the end of its window, even within the window's first second"""
+    window_end = pairing_scheduler.get_window_end(settings.PAIRING_BATCH_SECONDS * 10)
+
+    assert pairing_scheduler.get_window_end(window_end) == window_end
+    assert pairing_scheduler.get_window_end(window_end + 0.5) > window_end + 0.5
+
+
+def test_schedule_next_window_enqueues_one_run(
+    mocker: MockerFixture, flush_redis: Callable
+) -> None:
+    """Assert skipped runs in the same window enqueue one run for the next window"""
+    mock_send_task = mocker.patch("app.core.scheduler.celery.send_task")
+    mock_datetime = mocker.patch("app.core.scheduler.datetime")
+    mock_datetime.now.return_value = datetime.now()
+
+    pairing_scheduler.schedule_next_window()
+    pairing_scheduler.schedule_next_window()
+
+    assert mock_send_task.call_count == 1
+    assert mock_send_task.call_args.kwargs["countdown"] > 0
@@ -21,7 +21,8 @@ from app.commons.utils import generate_uuid
 from app.commons.constants import Categories
 
 from app.core.config import settings
-from app.core.utils import PairUsers
+from app.core.pool import results_pool
+from app.core.utils import PairUsers, PoolSnapshot, ResultNodeIndex
 from app.core.serializers.core import (
     ResultNode,
     ClosestNodeSerializer,
@@ -43,6 +44,7 @@ from app.sessions.daos.session import (
     session_dao,
 )
 from app.sessions.serializers.session import (
+    DuoSessionCreateSerializer,
     PoolCategoryStatistics,
     PoolSessionStatsCreateSerializer,
 )
@@ -52,17 +54,21 @@ def test_create_nodes_returns_correct_ordered_score_list(
     mocker: MockerFixture,
     create_result_instances_to_be_paired: Callable,
 ) -> None:
-    """Assert that PairUsers class creates an ordered list of scores"""
+    """Assert that PairUsers class creates an ordered list of scores for each session"""
     mock_datetime = mocker.patch("app.core.utils.datetime")
     mock_datetime.now.return_value = datetime.now() + timedelta(
         minutes=settings.SESSION_DURATION
     )
 
     pair_users = PairUsers()
-    ordered_score_list = pair_users.ordered_scores_list
+    score_index = pair_users.score_index
 
-    for elem in range(1, len(ordered_score_list)):
-        assert ordered_score_list[elem - 1][0] <= ordered_score_list[elem][0]
+    for category, session_id in score_index.keys():
+        ordered_nodes = score_index.ordered_nodes(category, session_id)
+
+        for elem in range(1, len(ordered_nodes)):
+            assert ordered_nodes[elem - 1].score <= ordered_nodes[elem].score
+            assert ordered_nodes[elem].session_id == session_id
 
 
 def test_create_nodes_returns_correctly_ordered_queue(
@@ -85,15 +91,35 @@ def test_create_nodes_returns_correctly_ordered_queue(
         smallest_elem = next_smallest_elem
 
 
+def test_result_nodes_share_category_and_session_id_strings() -> None:
+    """Assert that nodes have no __dict__ and intern repeated ids"""
+    session_id = generate_uuid()
+    nodes = [
+        ResultNode(
+            is_active=True,
+            id=generate_uuid(),
+            score=70,
+            user_id=generate_uuid(),
+            expires_at=datetime.now(),
+            session_id="".join(session_id),  # A new str with the same value
+            category=Categories.BIBLE.value,
+        )
+        for _ in range(2)
+    ]
+
+    assert not hasattr(nodes[0], "__dict__")
+    assert nodes[0].session_id is nodes[1].session_id
+
+
 def test_create_nodes_returns_empty_list_and_queue(
     create_result_instances_to_be_paired: Callable,
 ) -> None:
     pair_users = PairUsers()
     results_queue = pair_users.results_queue
-    ordered_score_list = pair_users.ordered_scores_list
+    score_index = pair_users.score_index
 
     assert len(results_queue) == 0
-    assert len(ordered_score_list) == 0
+    assert len(score_index) == 0
 
 
 # Run this test as the last one after all others have run because it
@@ -171,7 +197,11 @@ def test_get_closest_nodes_returns_correct_node_siblings(mocker: MockerFixture)
 
     logger.warning(f"Testing {len(all_combinations)} combinations")
     for combination in all_combinations:
-        pair_users.ordered_scores_list = combination
+        # Only active nodes are ever kept in the index
+        pair_users.score_index = ResultNodeIndex()
+        for _, node in combination:
+            if node.is_active:
+                pair_users.score_index.add(node)
 
         closest_nodes = pair_users.get_closest_nodes(target_node)
 
@@ -190,6 +220,42 @@ def test_get_closest_nodes_returns_correct_node_siblings(mocker: MockerFixture)
             assert closest_nodes.left_node.user_id != target_node.user_id
 
 
+def test_get_closest_nodes_skips_removed_nodes(mocker: MockerFixture) -> None:
+    """Assert that nodes removed from the score index are never returned as siblings"""
+    mocker.patch("app.core.utils.PairUsers.create_nodes", return_value=None)
+    session_id = generate_uuid()
+
+    def build_node(score: float) -> ResultNode:
+        return ResultNode(
+            score=score,
+            is_active=True,
+            id=generate_uuid(),
+            user_id=generate_uuid(),
+            expires_at=datetime.now(),
+            session_id=session_id,
+            category=Categories.BIBLE.value,
+        )
+
+    target_node = build_node(76)
+    left_node, far_left_node = build_node(74), build_node(71)
+    right_node, far_right_node = build_node(78), build_node(82)
+
+    pair_users = PairUsers()
+    for node in [target_node, left_node, far_left_node, right_node, far_right_node]:
+        pair_users.score_index.add(node)
+
+    closest_nodes = pair_users.get_closest_nodes(target_node)
+    assert closest_nodes.left_node == left_node
+    assert closest_nodes.right_node == right_node
+
+    pair_users.score_index.remove(left_node)
+    pair_users.score_index.remove(right_node)
+
+    closest_nodes = pair_users.get_closest_nodes(target_node)
+    assert closest_nodes.left_node == far_left_node
+    assert closest_nodes.right_node == far_right_node
+
+
 def test_calculate_mean_pairwise_difference_returns_correct_values(
     mocker: MockerFixture,
 ) -> None:
@@ -252,6 +318,39 @@ def test_calculate_average_score_returns_none_if_category_has_no_nodes(
     assert pair_users.calculate_average_score(Categories.FOOTBALL.value) is None
 
 
+def test_pool_snapshot_groups_statistics_by_category() -> None:
+    """Assert that the snapshot computes each category's statistics separately"""
+    new_result_nodes = copy.deepcopy(four_result_nodes)
+    new_result_nodes[3].category = Categories.FOOTBALL.value
+
+    pool_snapshot = PoolSnapshot(new_result_nodes)
+
+    assert pool_snapshot.total_players(Categories.BIBLE.value) == 3
+    assert pool_snapshot.total_players(Categories.FOOTBALL.value) == 1
+    assert pool_snapshot.average_score(Categories.BIBLE.value) == 73.33333333333333
+    assert pool_snapshot.mean_pairwise_difference(Categories.FOOTBALL.value) is None
+    assert pool_snapshot.average_score(Categories.BIBLE.value + "_") is None
+
+
+def test_pool_statistics_read_from_one_snapshot_per_queue(
+    mocker: MockerFixture,
+) -> None:
+    """Assert the queue is only read again once it is replaced"""
+    mocker.patch("app.core.utils.PairUsers.create_nodes", return_value=None)
+    spy_pool_snapshot = mocker.spy(PoolSnapshot, "__init__")
+    pair_users = PairUsers()
+    pair_users.results_queue = four_result_nodes
+
+    pair_users.calculate_average_score(Categories.BIBLE.value)
+    pair_users.calculate_mean_pairwise_difference(Categories.BIBLE.value)
+    pair_users.calculate_total_players(Categories.BIBLE.value)
+    assert spy_pool_snapshot.call_count == 1
+
+    pair_users.results_queue = two_result_nodes
+    assert pair_users.calculate_mean_pairwise_difference(Categories.BIBLE.value) == 2
+    assert spy_pool_snapshot.call_count == 2
+
+
 def test_calculate_exp_weighted_moving_average_returns_mean_pairwise_diff(
     db: Session,
     mocker: MockerFixture,
@@ -305,6 +404,38 @@ def test_calculate_exp_weighted_moving_average_returns_correct_ewma(
     )
 
 
+def test_calculate_pool_statistics_mixes_the_ewma_once_per_interval(
+    db: Session,
+    mocker: MockerFixture,
+    flush_redis: Callable,
+    delete_pool_session_stats_model_instances: Callable,
+) -> None:
+    """Assert that runs after the first in an interval keep the previous EWMA"""
+    mocker.patch("app.core.utils.PairUsers.create_nodes", return_value=None)
+    stats = {
+        Categories.BIBLE.value: PoolCategoryStatistics(
+            players=3, exp_weighted_moving_average=2
+        ).dict()
+    }
+    pool_session_stats_dao.create(
+        db,
+        obj_in=PoolSessionStatsCreateSerializer(
+            total_players=3, statistics=json.dumps(stats)
+        ),
+    )
+
+    pair_users = PairUsers(categories=[Categories.BIBLE.value])
+    pair_users.results_queue = four_result_nodes
+
+    statistics = pair_users.calculate_pool_statistics()
+    assert statistics[Categories.BIBLE.value]["exp_weighted_moving_average"] == (
+        4.133333333333334
+    )
+
+    statistics = pair_users.calculate_pool_statistics()
+    assert statistics[Categories.BIBLE.value]["exp_weighted_moving_average"] == 2
+
+
 def test_set_pool_session_statistics_saves_instance_to_model(
     db: Session,
     mocker: MockerFixture,
@@ -326,6 +457,24 @@ def test_set_pool_session_statistics_saves_instance_to_model(
     assert bool(pair_users.statistics) is not False
 
 
+def test_set_pool_session_statistics_saves_once_per_ewma_interval(
+    db: Session,
+    mocker: MockerFixture,
+    flush_redis: Callable,
+    delete_pool_session_stats_model_instances: Callable,
+) -> None:
+    """Assert runs that do not mix an EWMA do not save a PoolSessionStats instance"""
+    mocker.patch("app.core.utils.PairUsers.create_nodes", return_value=None)
+
+    for _ in range(2):
+        pair_users = PairUsers(categories=[Categories.BIBLE.value])
+        pair_users.results_queue = four_result_nodes
+        pair_users.set_pool_session_statistics()
+
+    assert len(pool_session_stats_dao.get_all(db)) == 1
+    assert pair_users.statistics and not pair_users.updated_ewma_categories
+
+
 def test_get_pair_partner_returns_correct_node_when_both_have_same_score(
     mocker: MockerFixture,
 ) -> None:
@@ -670,6 +819,126 @@ def test_get_winner_returns_no_winner(
     assert winner is None
 
 
+def test_choose_pairs_pairs_the_most_players_within_pairing_range(
+    mocker: MockerFixture,
+) -> None:
+    """Assert that the sweep pairs the most players rather than the closest pair first"""
+    mocker.patch("app.core.utils.PairUsers.create_nodes", return_value=None)
+    session_id = generate_uuid()
+
+    nodes = [
+        ResultNode(
+            score=score,
+            is_active=True,
+            id=generate_uuid(),
+            user_id=generate_uuid(),
+            expires_at=datetime.now() + timedelta(seconds=i),
+            session_id=session_id,
+            category=Categories.BIBLE.value,
+        )
+        for i, score in enumerate([71.0, 72.0, 72.5, 73.5, 80.0])
+    ]
+
+    pair_users = PairUsers()
+    pair_users.statistics = {Categories.BIBLE.value: {"pairing_range": 1.2}}
+
+    # The closest pair (72.0, 72.5) would leave 71.0 and 73.5 unpaired
+    chosen_pairs = pair_users.choose_pairs(nodes, {node.id for node in nodes})
+
+    assert sorted(chosen_pairs, key=lambda pair: pair[0].score) == [
+        (nodes[0], nodes[1]),
+        (nodes[2], nodes[3]),
+    ]
+
+
+def test_get_batch_settlements_settles_every_due_node(
+    mocker: MockerFixture,
+) -> None:
+    """Assert that due nodes are paired, refunded or partially refunded and
+    that nodes that are not due are only settled when paired with a due node"""
+    mocker.patch("app.core.utils.PairUsers.create_nodes", return_value=None)
+    session_id = generate_uuid()
+
+    nodes = [
+        ResultNode(
+            score=score,
+            is_active=True,
+            id=generate_uuid(),
+            user_id=generate_uuid(),
+            expires_at=datetime.now() + timedelta(seconds=i),
+            session_id=session_id,
+            category=Categories.BIBLE.value,
+        )
+        for i, score in enumerate(
+            [settings.MODERATED_LOWEST_SCORE, 75.0, 80.0, 75.5, 84.0]
+        )
+    ]
+
+    pair_users = PairUsers()
+    pair_users.statistics = {Categories.BIBLE.value: {"pairing_range": 1}}
+    for node in nodes:
+        pair_users.score_index.add(node)
+        pair_users.results_queue.append(node)
+
+    # The last two nodes are not due yet
+    due_result_ids = {node.id for node in nodes[:3]}
+    settlements = pair_users.get_batch_settlements(due_result_ids)
+
+    statuses = [duo_session_in.status for duo_session_in, _ in settlements]
+    assert statuses == [
+        DuoSessionStatuses.PARTIALLY_REFUNDED.value,
+        DuoSessionStatuses.PAIRED.value,
+        DuoSessionStatuses.REFUNDED.value,
+    ]
+
+    paired_session, paired_nodes = settlements[1]
+    assert paired_nodes == [nodes[1], nodes[3]]
+    assert paired_session.winner_id == nodes[3].user_id
+
+    assert nodes[4].is_active is True
+    assert len(pair_users.score_index) == 1
+
+
+@pytest.mark.parametrize("batch_matching", [True, False])
+def test_match_players_refunds_results_with_an_equal_score(
+    mocker: MockerFixture, batch_matching: bool
+) -> None:
+    """Assert that neither matching mode pairs two results with the same score"""
+    mocker.patch("app.core.utils.PairUsers.create_nodes", return_value=None)
+    session_id = generate_uuid()
+
+    nodes = [
+        ResultNode(
+            score=75.0,
+            is_active=True,
+            id=generate_uuid(),
+            user_id=generate_uuid(),
+            expires_at=datetime.now() + timedelta(seconds=i),
+            session_id=session_id,
+            category=Categories.BIBLE.value,
+        )
+        for i in range(2)
+    ]
+
+    pair_users = PairUsers()
+    pair_users.statistics = {Categories.BIBLE.value: {"pairing_range": 1}}
+    for node in nodes:
+        pair_users.score_index.add(node)
+        pair_users.results_queue.append(node)
+
+    due_result_ids = {node.id for node in nodes}
+    if batch_matching:
+        settlements = pair_users.get_batch_settlements(due_result_ids)
+    else:
+        settlements = pair_users.get_settlements(due_result_ids)
+
+    assert [duo_session_in.status for duo_session_in, _ in settlements] == [
+        DuoSessionStatuses.REFUNDED.value,
+        DuoSessionStatuses.REFUNDED.value,
+    ]
+    assert all(duo_session_in.party_b is None for duo_session_in, _ in settlements)
+
+
 def test_create_duo_session_saves_model_instance(
     db: Session,
     mocker: MockerFixture,
@@ -919,3 +1188,77 @@ def test_match_players_creates_a_paired_session(
 
     assert duo_session.status == DuoSessionStatuses.PAIRED.value
     assert duo_session.party_b == party_b_result.user_id  # type: ignore
+
+
+def test_match_players_settles_all_due_results_in_one_batch(
+    db: Session,
+    mocker: MockerFixture,
+    delete_duo_session_model_instances: Callable,
+    create_result_instances_to_be_paired: Callable,
+) -> None:
+    """Assert function settles every due result and removes it from the pool"""
+    mocker.patch(  # Mock send_notification so that we don't have to wait for it
+        "app.sessions.daos.session.notifications_dao.send_notification",
+        return_value=None,
+    )
+    mock_datetime = mocker.patch("app.core.utils.datetime")
+    mock_datetime.now.return_value = datetime.now() + timedelta(
+        seconds=settings.RESULT_PAIRS_AFTER_SECONDS + 60
+    )
+
+    pair_users = PairUsers()
+    result_ids = [node.id for node in pair_users.results_queue]
+    pair_users.match_players()
+
+    db.expire_all()
+    duo_sessions = duo_session_dao.get_all(db)
+    settled_users = {duo_session.party_a for duo_session in duo_sessions} | {
+        duo_session.party_b for duo_session in duo_sessions if duo_session.party_b
+    }
+
+    pool_node_ids = {pool_node["node"].id for pool_node in results_pool.nodes()}
+
+    assert result_dao.get_all(db, is_active=True) == []
+    assert not any(result_id in pool_node_ids for result_id in result_ids)
+    assert settled_users == {
+        result.user_id for result in result_dao.get_all(db) if result.id in result_ids
+    }
+
+
+def test_settle_duo_sessions_deactivates_results_of_skipped_duo_sessions(
+    db: Session,
+    mocker: MockerFixture,
+    delete_duo_session_model_instances: Callable,
+    create_result_instances_to_be_paired: Callable,
+) -> None:
+    """Assert results of a DuoSession that fails validation leave the pool
+    instead of being paired and skipped again on every run"""
+    mock_datetime = mocker.patch("app.core.utils.datetime")
+    mock_datetime.now.return_value = datetime.now() + timedelta(
+        seconds=settings.RESULT_PAIRS_AFTER_SECONDS + 60
+    )
+    pair_users = PairUsers()
+    party_a = pair_users.results_queue[0]
+
+    pair_users.settle_duo_sessions(
+        [
+            (
+                DuoSessionCreateSerializer(
+                    party_a=party_a.user_id,
+                    party_b=party_a.user_id,  # Party A & Party B can not be the same
+                    winner_id=party_a.user_id,
+                    session_id=party_a.session_id,
+                    status=DuoSessionStatuses.PAIRED.value,
+                ),
+                [party_a],
+            )
+        ]
+    )
+
+    db.expire_all()
+    pool_node_ids = {pool_node["node"].id for pool_node in results_pool.nodes()}
+
+    assert duo_session_dao.get_all(db) == []
+    assert result_dao.get_not_none(db, id=party_a.id).is_active is False
+    assert party_a.id not in pool_node_ids
+    assert pair_users.metrics.outcomes["SKIPPED"] == 1
@@ -1,8 +1,9 @@
 import json
 import bisect
-import heapq
 import random
-from typing import List
+from operator import attrgetter
+from collections import defaultdict
+from typing import Dict, List, Set, Tuple
 from datetime import datetime, timedelta
 
 from app.db.session import SessionLocal
@@ -16,11 +17,19 @@ from app.core.serializers.core import (
     PairPartnersSerializer,
 )
 
+from app.core.pool import results_pool, PairingCheckpoint
+from app.core.lease import LeaseLock
+from app.core.metrics import PairingRunMetrics
+
 from app.quiz.daos.quiz import result_dao
-from app.quiz.serializers.quiz import ResultNodeSerializer
 
 from app.sessions.constants import DuoSessionStatuses
-from app.sessions.daos.session import pool_session_stats_dao, duo_session_dao
+from app.sessions.daos.session import (
+    duo_session_dao,
+    pool_session_stats_dao,
+    duo_session_settlement_dao,
+    pool_category_state_dao,
+)
 from app.sessions.serializers.session import (
     PoolSessionStatsCreateSerializer,
     DuoSessionCreateSerializer,
@@ -28,227 +37,303 @@ from app.sessions.serializers.session import (
 )
 
 
-class PairUsers:
+class ResultNodeIndex:
     def __init__(self) -> None:
-        """Pair users based on their score."""
+        """Keep active result nodes in score order, grouped by (category, session_id).
 
-        logger.info("Initializing PairUsers class...")
-        """The ordered_score list is used for pairing and the results queue
-        is used to prioritize the earliest result to pair"""
-        self.ordered_scores_list = []
-        self.results_queue = []
+        A node can only be paired with a node that played the same session, so each
+        lookup is confined to one bucket and is a bisect rather than a walk of the pool.
 
-        self.statistics = {}
-        self.ewma = float("inf")
+        Adding and removing a node shifts the rest of its bucket, which is O(n) in the
+        size of the bucket. A bucket only holds the results of one session and the
+        shift is a memmove of pointers, so this is cheaper than a balanced tree would
+        be at the sizes a pool reaches.
+        """
+        self._scores: Dict[Tuple[str, str], List[float]] = defaultdict(list)
+        self._nodes: Dict[Tuple[str, str], List[ResultNode]] = defaultdict(list)
 
-        self.create_nodes()
+        # The score a node was indexed with. Used to find the node on removal
+        # even if the node's score has been modified since.
+        self._indexed_scores: Dict[str, float] = {}
 
-    def create_nodes(self) -> None:
-        """Create Node instances for results that need to be paired"""
-        logger.info("Creating nodes...")
-        x_seconds_ago = datetime.now() - timedelta(
-            seconds=settings.LOAD_SESSION_INTO_QUEUE_AFTER_SECONDS
-        )
+    def __len__(self) -> int:
+        return len(self._indexed_scores)
 
-        with SessionLocal() as db:
-            available_results = result_dao.search(
-                db,
-                {
-                    "order_by": ["-created_at"],
-                    "is_active": True,
-                    "created_at__lt": x_seconds_ago,
-                },
-            )
+    def __contains__(self, node: ResultNode) -> bool:
+        return node.id in self._indexed_scores
 
-            for result in available_results:
-                logger.info(f"Create a node for result: {result.id}")
+    def keys(self) -> List[Tuple[str, str]]:
+        """Return the (category, session_id) of every bucket in the index"""
+        return list(self._nodes.keys())
 
-                result_in = ResultNodeSerializer(**result.__dict__)
-                result_node = ResultNode(**result_in.dict())
+    def ordered_nodes(self, category: str, session_id: str) -> List[ResultNode]:
+        """Return the nodes in a bucket ordered by score"""
+        return list(self._nodes.get((category, session_id), []))
 
-                # Insert the node into the sorted list based on the score
-                index = bisect.bisect_right(
-                    self.ordered_scores_list, (result_in.score,)
-                )
+    def add(self, node: ResultNode) -> None:
+        """Insert the node into its bucket based on the score"""
+        if node.id in self._indexed_scores:
+            return
 
-                self.ordered_scores_list.insert(index, (result_in.score, result_node))
-                heapq.heappush(self.results_queue, result_node)
+        key = (node.category, node.session_id)
+        score = float(node.score)
+        index = bisect.bisect_right(self._scores[key], score)
 
-    def get_closest_nodes(self, node: ResultNode) -> ClosestNodeSerializer:
-        """Find the closest nodes to a given score.
-        Note: The self.ordered_scores_list is never an empty list because the score being
-        searched for, needs to exist inside the list too
-        """
-        logger.info(f"Get closest nodes for node id: {node.id}")
-
-        def closest_node(index) -> ResultNode | None:
-            """Return Node or None if there is no node"""
-            return self.ordered_scores_list[index][1] if index else None
-
-        # Put two recursive functions inside so that we don't have to pass score as an argument again
-        def get_closest_index_to_the_right(index):
-            """Recursion to find closest node to the right"""
-            is_not_equal_to_score = (
-                self.ordered_scores_list[index][0] != score
-            )  # If elem score is not equal to node score
-            is_last_elem_in_list = index + 1 == len(
-                self.ordered_scores_list
-            )  # If last elem in list
-
-            is_same_session_id = (  # If it's the same session id
-                self.ordered_scores_list[index][1].session_id == session_id
-            )
-            is_active_node = self.ordered_scores_list[index][1].is_active is True
+        self._scores[key].insert(index, score)
+        self._nodes[key].insert(index, node)
+        self._indexed_scores[node.id] = score
 
-            """If an element matches the above criteria, return it's index"""
-            if is_not_equal_to_score and is_same_session_id and is_active_node:
-                return index
+    def remove(self, node: ResultNode) -> None:
+        """Remove the node from its bucket. Removing a node not in the index is a no-op"""
+        score = self._indexed_scores.pop(node.id, None)
+        if score is None:
+            return
 
-            """Return None, if it's the last element (... and no element matches the above)"""
-            if is_last_elem_in_list:
-                return None
+        key = (node.category, node.session_id)
+        scores, nodes = self._scores[key], self._nodes[key]
 
-            return get_closest_index_to_the_right(index + 1)
+        # Nodes with an equal score sit next to each other, so this is a short scan
+        index = bisect.bisect_left(scores, score)
+        while nodes[index].id != node.id:
+            index += 1
 
-        def get_closest_index_to_the_left(index):
-            """Recursion to find closest node to the left"""
-            is_not_equal_to_score = self.ordered_scores_list[index - 1][0] != score
-            is_first_elem_in_list = index - 1 == 0  # Node is the first element in list
+        del scores[index]
+        del nodes[index]
 
-            is_same_session_id = (
-                self.ordered_scores_list[index - 1][1].session_id == session_id
-            )
-            is_active_node = self.ordered_scores_list[index - 1][1].is_active is True
+        if not nodes:
+            del self._scores[key]
+            del self._nodes[key]
+
+    def closest_nodes(self, node: ResultNode) -> ClosestNodeSerializer:
+        """Return the nearest node with a lower score and the nearest node with a
+        higher score in the node's bucket. Nodes with an equal score are skipped."""
+        key = (node.category, node.session_id)
+        scores = self._scores.get(key)
 
-            """If an element matches the above criteria, return it's index"""
-            if is_not_equal_to_score and is_same_session_id and is_active_node:
-                return index - 1
+        if not scores:
+            return ClosestNodeSerializer()
 
-            """Return None, if it's the last element (... and no element matches the above)"""
-            if is_first_elem_in_list:
-                return None
+        nodes = self._nodes[key]
+        score = self._indexed_scores.get(node.id, float(node.score))
 
-            return get_closest_index_to_the_left(index - 1)
+        left_index = bisect.bisect_left(scores, score) - 1
+        right_index = bisect.bisect_right(scores, score)
 
-        score = node.score
-        session_id = node.session_id
+        return ClosestNodeSerializer(
+            left_node=nodes[left_index] if left_index >= 0 else None,
+            right_node=nodes[right_index] if right_index < len(nodes) else None,
+        )
 
-        # Use bisect_left & bisect_right to find the optimal insertion points
-        left_index = bisect.bisect_left(self.ordered_scores_list, (score,))
-        right_index = bisect.bisect_right(self.ordered_scores_list, (score,))
 
-        if left_index == 0:
-            """If the score index is at the beginning of the list,
-            Then the closest node is always to the right."""
-            logger.info(f"Get closest node to the right for node id: {node.id}")
+class PoolSnapshot:
+    """
+    Per-category totals of the results queue used to compute pool statistics.
 
-            closest_right_index = get_closest_index_to_the_right(left_index)
-            closest_right_node = closest_node(closest_right_index)
-            return ClosestNodeSerializer(right_node=closest_right_node)
+    The queue is read once and every statistic for every category is derived
+    from the totals collected in that single pass.
+    """
 
-        elif right_index == len(self.ordered_scores_list):
-            """If the index of the score is at the end of the list,
-            Then the closest node is always to the left."""
-            logger.info(f"Get closest node to the left for node id: {node.id}")
+    def __init__(self, nodes: List[ResultNode]) -> None:
+        self.total_nodes = len(nodes)
+        self._players: Dict[str, int] = defaultdict(int)
+        self._last_scores: Dict[str, float] = {}
+        self._score_totals: Dict[str, float] = defaultdict(float)
+        self._difference_totals: Dict[str, float] = defaultdict(float)
 
-            closest_left_index = get_closest_index_to_the_left(left_index)
-            closest_left_node = closest_node(closest_left_index)
+        for node in nodes:
+            category = node.category
 
-            return ClosestNodeSerializer(left_node=closest_left_node)
+            # Differences are between consecutive scores in queue order
+            if category in self._last_scores:
+                self._difference_totals[category] += abs(
+                    self._last_scores[category] - node.score
+                )
 
-        else:
-            """If the index of the score is somewhere in the middle,
-            then find closest nodes both to the left and right."""
-            logger.info(f"Get sibling nodes for node id: {node.id}")
+            self._players[category] += 1
+            self._last_scores[category] = node.score
+            self._score_totals[category] += node.score
 
-            closest_right_index = get_closest_index_to_the_right(right_index)
-            closest_right_node = closest_node(closest_right_index)
+    def total_players(self, category: str) -> int:
+        return self._players.get(category, 0)
 
-            closest_left_index = get_closest_index_to_the_left(left_index)
-            closest_left_node = closest_node(closest_left_index)
+    def average_score(self, category: str) -> float | None:
+        """Average score of the category or None if it has no nodes"""
+        total_players = self.total_players(category)
+        if not total_players:
+            return None
 
-            return ClosestNodeSerializer(
-                right_node=closest_right_node,
-                left_node=closest_left_node,
-            )
+        return self._score_totals[category] / total_players
 
-    def calculate_mean_pairwise_difference(self, category: str):
-        """Calculate the mean difference between consecutive scores"""
-        logger.info(
-            f"Calculate consecutive mean pairwise difference for category {category}"
+    def mean_pairwise_difference(self, category: str) -> float | None:
+        """Mean difference between consecutive scores in the category
+        or None if it has less than two nodes"""
+        total_players = self.total_players(category)
+        if total_players < 2:
+            return None
+
+        return self._difference_totals[category] / (total_players - 1)
+
+
+class PairUsers:
+    metrics_class = PairingRunMetrics
+
+    def __init__(
+        self,
+        categories: List[str] | None = None,
+        *,
+        lease: LeaseLock | None = None,
+        checkpoint: PairingCheckpoint | None = None,
+    ) -> None:
+        """Pair users based on their score.
+        Only results in the given categories are paired, which defaults to all categories.
+        A run holding a lease stops settling once the lease is lost and a run with a
+        checkpoint resumes from the results the previous run had already settled.
+        """
+
+        logger.info("Initializing PairUsers class...")
+        self.categories = categories or Categories.list_()
+        self.lease = lease
+        self.checkpoint = checkpoint
+        self.batch_matching = settings.PAIRING_BATCH_MATCHING
+
+        """The score index is used for pairing and the results queue
+        is used to prioritize the earliest result to pair"""
+        self.score_index = ResultNodeIndex()
+        self.results_queue = []
+
+        self._pool_snapshot: PoolSnapshot | None = None
+        self._pool_snapshot_queue: List[ResultNode] | None = None
+
+        self.statistics = {}
+        self.ewma = float("inf")
+        # Statistics are only saved by the run that mixes an EWMA
+        self.updated_ewma_categories: Set[str] = set()
+
+        self.metrics = self.metrics_class(self.categories)
+        self.create_nodes()
+
+    def create_nodes(self) -> None:
+        """Create Node instances for results that need to be paired.
+        Nodes are read from the pairing pool, which is only loaded from the
+        database if it has not been built yet. Nodes of results that were
+        deactivated but never left the pool are dropped."""
+        logger.info("Creating nodes...")
+        x_seconds_ago = datetime.now() - timedelta(
+            seconds=settings.LOAD_SESSION_INTO_QUEUE_AFTER_SECONDS
         )
 
-        scores = [
-            node.score for node in self.results_queue if node.category == category
-        ]
+        with self.metrics.phase("node_load") as phase:
+            if not results_pool.is_warm():
+                with SessionLocal() as db:
+                    results_pool.rebuild(db)
 
-        if len(scores) > 1:
-            differences = [
-                abs(scores[i] - scores[i + 1]) for i in range(len(scores) - 1)
-            ]
+            settled_result_ids = set()
+            if self.checkpoint is not None:
+                settled_result_ids = self.checkpoint.settled_result_ids()
 
-            mean_pair_wise_difference = sum(differences) / len(differences)
-            return mean_pair_wise_difference
+            if settled_result_ids:
+                # The previous run may have stopped before removing them from the pool
+                logger.info(f"Resuming after {len(settled_result_ids)} settled results")
+                results_pool.remove_many(list(settled_result_ids))
 
-        return None
+            pool_nodes = results_pool.nodes(categories=self.categories)
+            with SessionLocal() as db:
+                pool_nodes = results_pool.drop_inactive(db, pool_nodes)
+            phase["nodes"] += len(pool_nodes)
 
-    def calculate_average_score(self, category: str) -> float | None:
-        """Calculate average score of the pool"""
-        logger.info(f"Calculate average score for category: {category}")
+        with self.metrics.phase("index_build") as phase:
+            for pool_node in pool_nodes:
+                if pool_node["created_at"] >= x_seconds_ago:
+                    continue  # The session may still be in play
 
-        if not self.results_queue:
-            return None  # Return None for an empty list
+                if pool_node["node"].id in settled_result_ids:
+                    continue
 
-        scores = [
-            node.score for node in self.results_queue if node.category == category
-        ]
+                result_node = pool_node["node"]
+                logger.debug(f"Create a node for result: {result_node.id}")
 
-        if not scores:
-            return None  # Return None if category has no nodes
-        total_score = sum(scores)
+                self.score_index.add(result_node)
+                self.results_queue.append(result_node)
 
-        average_score = total_score / len(scores)
-        return average_score
+            # A list sorted by expiry is a valid heap. Sorting on the expiry itself
+            # compares datetimes natively instead of calling ResultNode.__lt__ per push.
+            self.results_queue.sort(key=attrgetter("expires_at"))
+            phase["nodes"] += len(self.results_queue)
 
-    def calculate_exp_weighted_moving_average(self, category: str) -> float:
-        """Calculate the exponentially moving average"""
-        logger.info(f"Calculate exponentially moving average for category: {category}")
+    def get_closest_nodes(self, node: ResultNode) -> ClosestNodeSerializer:
+        """Find the closest nodes to a given score.
+        Only active nodes with the same category and session_id as the node are considered.
+        """
+        logger.debug(f"Get closest nodes for node id: {node.id}")
+        return self.score_index.closest_nodes(node)
+
+    def get_pool_snapshot(self) -> "PoolSnapshot":
+        """Get the per-category totals of the results queue.
+        They are collected once per run and only again if the queue is replaced
+        or changes size, so every statistic reads from the same snapshot."""
+        if (
+            self._pool_snapshot is None
+            or self._pool_snapshot_queue is not self.results_queue
+            or self._pool_snapshot.total_nodes != len(self.results_queue)
+        ):
+            self._pool_snapshot = PoolSnapshot(self.results_queue)
+            self._pool_snapshot_queue = self.results_queue
+
+        return self._pool_snapshot
 
-        mean_pairwise_diff = self.calculate_mean_pairwise_difference(category) or 0
+    def calculate_mean_pairwise_difference(self, category: str):
+        """Calculate the mean difference between consecutive scores"""
+        logger.info(
+            f"Calculate consecutive mean pairwise difference for category {category}"
+        )
+        return self.get_pool_snapshot().mean_pairwise_difference(category)
+
+    def calculate_average_score(self, category: str) -> float | None:
+        """Calculate average score of the pool"""
+        logger.info(f"Calculate average score for category: {category}")
+        return self.get_pool_snapshot().average_score(category)
 
+    def get_previous_ewmas(self) -> Dict[str, float]:
+        """Get the EWMA of each category saved by the previous PoolSession"""
         with SessionLocal() as db:
-            """Search for the previous PoolSession Statistics"""
-            pool_session_stats = pool_session_stats_dao.search(
-                db, {"order_by": ["-created_at"]}
-            )
+            return pool_category_state_dao.get_ewmas(db)
+
+    def should_update_ewma(self, category: str) -> bool:
+        """Whether this run mixes the category's EWMA. Runs are scheduled for
+        every batch window, so only the first run of each interval mixes it."""
+        return pool_category_state_dao.claim_ewma_update(category)
 
-        if pool_session_stats:
-            prev_pool_session_stat = pool_session_stats[0]
-            prev_stats = prev_pool_session_stat.statistics
+    def calculate_exp_weighted_moving_average(
+        self,
+        category: str,
+        *,
+        mean_pairwise_diff: float | None = None,
+        previous_ewmas: Dict[str, float] | None = None,
+    ) -> float:
+        """Calculate the exponentially moving average.
+        The mean pairwise difference and previous EWMAs are calculated
+        if they are not passed in."""
+        logger.info(f"Calculate exponentially moving average for category: {category}")
 
-            category_stats = prev_stats.get(category, None)
-            exp_weighted_moving_avg = None
+        if mean_pairwise_diff is None:
+            mean_pairwise_diff = self.calculate_mean_pairwise_difference(category)
+        mean_pairwise_diff = mean_pairwise_diff or 0
 
-            # Assert the specificied category statistics exist
-            if category_stats is not None:
-                logger.info(
-                    f"Previous PoolSession statistics exist for category: {category}"
-                )
+        if previous_ewmas is None:
+            previous_ewmas = self.get_previous_ewmas()
 
-                exp_weighted_moving_avg = category_stats.get(
-                    "exp_weighted_moving_average", None
-                )
+        exp_weighted_moving_avg = previous_ewmas.get(category, None)
 
-            if (
-                exp_weighted_moving_avg is not None
-            ):  # Calculate EWMA if previous EWMA exists
-                logger.info(f"Calculating EWMA for category: {category}")
+        if (
+            exp_weighted_moving_avg is not None
+        ):  # Calculate EWMA if previous EWMA exists
+            logger.info(f"Calculating EWMA for category: {category}")
 
-                ewma = (settings.EWMA_MIXING_PARAMETER * mean_pairwise_diff) + (
-                    1 - settings.EWMA_MIXING_PARAMETER
-                ) * exp_weighted_moving_avg
+            ewma = (settings.EWMA_MIXING_PARAMETER * mean_pairwise_diff) + (
+                1 - settings.EWMA_MIXING_PARAMETER
+            ) * exp_weighted_moving_avg
 
-                return ewma
+            return ewma
 
         # The mean pairwise difference is the default EWMA
         ewma = mean_pairwise_diff
@@ -261,52 +346,76 @@ class PairUsers:
         if category is None:
             return len(self.results_queue)
 
-        count = sum(1 for node in self.results_queue if node.category == category)
-        return count
+        return self.get_pool_snapshot().total_players(category)
+
+    def calculate_pool_statistics(self) -> Dict:
+        """Calculate the statistics of each category paired by this instance"""
+        logger.info("Calculating PoolSession statistics...")
+
+        # Read the queue and the previous EWMAs once for all categories
+        pool_snapshot = self.get_pool_snapshot()
+        previous_ewmas = self.get_previous_ewmas()
+
+        """Loop through each category and calculate its stats"""
+        for category in self.categories:
+            cat_total_players = pool_snapshot.total_players(category)
+            cat_average_score = pool_snapshot.average_score(category)
+
+            cat_mean_pair_wise_diff = pool_snapshot.mean_pairwise_difference(category)
+            update_ewma = self.should_update_ewma(category)
+            if category in previous_ewmas and not update_ewma:
+                cat_ewma = previous_ewmas[category]
+            else:
+                cat_ewma = self.calculate_exp_weighted_moving_average(
+                    category,
+                    mean_pairwise_diff=cat_mean_pair_wise_diff,
+                    previous_ewmas=previous_ewmas,
+                )
+            if update_ewma:
+                self.updated_ewma_categories.add(category)
+            cat_pairing_range = cat_ewma * settings.PAIRING_THRESHOLD
+
+            category_stats = PoolCategoryStatistics(
+                players=cat_total_players,
+                average_score=cat_average_score,
+                pairing_range=cat_pairing_range,
+                threshold=settings.PAIRING_THRESHOLD,
+                exp_weighted_moving_average=cat_ewma,
+                mean_paiwise_difference=cat_mean_pair_wise_diff,
+            )
+            self.statistics[category] = category_stats.dict()
 
-    def set_pool_session_statistics(self) -> None:
-        """Set statistics to the PoolSession model"""
+        return self.statistics
+
+    @staticmethod
+    def save_pool_session_statistics(statistics: Dict) -> None:
+        """Save the statistics of all categories as one PoolSessionStats instance"""
         logger.info("Saving PoolSession statistics...")
+        total_players = sum(
+            category_stats["players"] or 0 for category_stats in statistics.values()
+        )
 
         with SessionLocal() as db:  # type: ignore
-            total_players = 0
-
-            """Loop through each category and save the stats to the model"""
-            for category in Categories.list_():
-                cat_total_players = self.calculate_total_players(category)
-                cat_average_score = self.calculate_average_score(category)
-
-                cat_mean_pair_wise_diff = self.calculate_mean_pairwise_difference(
-                    category
-                )
-                cat_ewma = self.calculate_exp_weighted_moving_average(category)
-                cat_pairing_range = cat_ewma * settings.PAIRING_THRESHOLD
-
-                category_stats = PoolCategoryStatistics(
-                    players=cat_total_players,
-                    average_score=cat_average_score,
-                    pairing_range=cat_pairing_range,
-                    threshold=settings.PAIRING_THRESHOLD,
-                    exp_weighted_moving_average=cat_ewma,
-                    mean_paiwise_difference=cat_mean_pair_wise_diff,
-                )
-
-                # Update these two variables
-                total_players += cat_total_players
-                self.statistics[category] = category_stats.dict()
-
             pool_session_stats_dao.create(
                 db,
                 obj_in=PoolSessionStatsCreateSerializer(
-                    total_players=total_players, statistics=json.dumps(self.statistics)
+                    total_players=total_players, statistics=json.dumps(statistics)
                 ),
             )
 
+    def set_pool_session_statistics(self) -> None:
+        """Set statistics to the PoolSession model.
+        Runs between EWMA updates save nothing, so there is one PoolSessionStats
+        per EWMA interval rather than per batch window."""
+        statistics = self.calculate_pool_statistics()
+        if self.updated_ewma_categories:
+            self.save_pool_session_statistics(statistics)
+
     def get_pair_partner(
         self, target_node: ResultNode, closest_nodes_in: ClosestNodeSerializer
     ) -> ResultNode | None:
         """Receives no nodes, one or two nodes then returns the node closest to the target score"""
-        logger.info(f"Get pair partner for node id: {target_node.id}")
+        logger.debug(f"Get pair partner for node id: {target_node.id}")
 
         right_node = closest_nodes_in.right_node
         left_node = closest_nodes_in.left_node
@@ -323,32 +432,32 @@ class PairUsers:
             score_diff = abs(target_node.score - node_score)
 
             if score_diff < closest_score_diff:
-                logger.info(f"Score difference between sibling nodes is: {score_diff}")
+                logger.debug(f"Score difference between sibling nodes is: {score_diff}")
                 closest_node = node
                 closest_score_diff = score_diff
                 same_score_nodes = [node]
 
             elif score_diff == closest_score_diff:
-                logger.info("Nodes have the same score")
+                logger.debug("Nodes have the same score")
                 same_score_nodes.append(node)
 
         """If both nodes have same score, choose a random node and return it"""
         if same_score_nodes:
-            logger.info(f"Node id: {target_node.id} has siblings with same score")
+            logger.debug(f"Node id: {target_node.id} has siblings with same score")
             closest_node = random.choice(same_score_nodes)
 
         return closest_node
 
     def get_winner(self, pair_partners: PairPartnersSerializer) -> ResultNode | None:
         """Returns the winner between two nodes or None"""
-        logger.info("Get winner between two party_a and party_b")
+        logger.debug("Get winner between two party_a and party_b")
 
         party_a = pair_partners.party_a
         party_b = pair_partners.party_b
         winner = None
 
         score_diff = abs(party_a.score - party_b.score)
-        logger.info(
+        logger.debug(
             f"Party_a id: {party_a.id} score: {party_a.score} | "
             "Party_b id: {party_b.id} score: {party_b.score}"
         )
@@ -390,29 +499,74 @@ class PairUsers:
             for node in result_nodes:
                 logger.info(f"Deactivate result_node id: {node.id}")
                 node.is_active = False
+                self.score_index.remove(node)
 
                 result_obj = result_dao.get_not_none(db, id=node.id)
                 result_dao.update(db, db_obj=result_obj, obj_in={"is_active": False})
 
-    def match_players(self):
-        """Loops through PoolSession to get players, find partners, or refund them"""
-        logger.info("Matching players...")
-
-        # Save the current PoolSesssion stats to model
-        self.set_pool_session_statistics()
+    def settle_duo_sessions(
+        self, settlements: List[Tuple[DuoSessionCreateSerializer, List[ResultNode]]]
+    ) -> None:
+        """Create the DuoSessions with their settlement events and deactivate their
+        Result instances in one database transaction. The settlement worker credits
+        the wallets and notifies the players once committed.
+        Settled results are recorded in the checkpoint as soon as they are committed."""
+        if not settlements:
+            return
+
+        logger.info(f"Settling {len(settlements)} DuoSessions...")
+        with SessionLocal() as db:
+            try:
+                with self.metrics.phase("duo_session_creation", nodes=len(settlements)):
+                    duo_sessions = duo_session_dao.create_many(
+                        db,
+                        objs_in=[duo_session_in for duo_session_in, _ in settlements],
+                    )
+
+                # Results of DuoSessions that failed validation are deactivated too,
+                # otherwise they would be paired and skipped again on every run
+                result_ids = [node.id for _, nodes in settlements for node in nodes]
+
+                with self.metrics.phase("deactivation", nodes=len(result_ids)):
+                    result_dao.deactivate_many(db, ids=result_ids)
+
+                    # Another run may have taken over these results
+                    if self.lease is not None:
+                        self.lease.ensure_held()
+                    db.commit()
+
+            except Exception:
+                db.rollback()
+                raise
+
+        for duo_session_in in duo_sessions:
+            self.metrics.count(duo_session_in.status)
+        self.metrics.count("SKIPPED", len(settlements) - len(duo_sessions))
+
+        with self.metrics.phase("settlement_side_effects", nodes=len(result_ids)):
+            if self.checkpoint is not None:
+                self.checkpoint.add(result_ids)
+            results_pool.remove_many(result_ids)
+
+            if duo_sessions:
+                duo_session_settlement_dao.schedule()
+
+    def get_due_result_ids(self) -> Set[str]:
+        """Get ids of results that are eligible for pairing now.
+        The pool keeps results ordered by this time so only due results are read."""
+        return results_pool.due_result_ids(datetime.now())
+
+    def get_settlements(
+        self, due_result_ids: Set[str]
+    ) -> List[Tuple[DuoSessionCreateSerializer, List[ResultNode]]]:
+        """Decide how each due node is settled. Nodes are deactivated in memory and
+        the DuoSession to create is returned together with the nodes it settles."""
+        settlements: List[Tuple[DuoSessionCreateSerializer, List[ResultNode]]] = []
 
         for node in self.results_queue:
             """If node is x seconds close to expiry, then it's eligible to be paired"""
-
-            # All sessions are paired or refunded before x time, say 30 mins.
-            # So the pairing process should happen x - y time, where x + y = 30 mins,
-            # That's why the x time is always slightly less.
-            time_to_expiry = node.expires_at + timedelta(
-                seconds=settings.RESULT_PAIRS_AFTER_SECONDS  # Should be around 25 minutes or so
-            )
-
-            if node.is_active is True and datetime.now() > time_to_expiry:
-                logger.info(f"Matching node id: {node.id}")
+            if node.is_active is True and node.id in due_result_ids:
+                logger.debug(f"Matching node id: {node.id}")
                 party_a = node
 
                 """party_a is removed from the results_queue by default because it's
@@ -425,7 +579,7 @@ class PairUsers:
                     """The user played a session, but did not answer at least one question.
                     So we do a partial refund. To receive a full refund, attempt to answer atleast
                     one question"""
-                    logger.info(f"Partially refund node id: {party_a.id}")
+                    logger.debug(f"Partially refund node id: {party_a.id}")
                     duo_session_status = DuoSessionStatuses.PARTIALLY_REFUNDED
                     nodes_to_deactivate = [party_a]
 
@@ -433,7 +587,7 @@ class PairUsers:
                     """
                     The user attempted atleast one question, so try to find a partner to pair with the user.
                     """
-                    logger.info(f"{party_a.id} attempted atleast one question...")
+                    logger.debug(f"{party_a.id} attempted atleast one question...")
                     closest_nodes = self.get_closest_nodes(node)
                     party_b = self.get_pair_partner(node, closest_nodes)
 
@@ -442,7 +596,7 @@ class PairUsers:
 
                     if party_b is not None:
                         """If a pairing partner was found, get the winner between party_a and party_b"""
-                        logger.info(
+                        logger.debug(
                             f"Pairing partner found for node id: {party_a.id}. "
                             "Party_b node id is: {party_b.id}"
                         )
@@ -454,13 +608,13 @@ class PairUsers:
                         """If there's no winner, then set the status as REFUNDED so that party_a is refunded
                         and party_b is returned to the pool."""
                         if winner is not None:  # A winner was found
-                            logger.info(
+                            logger.debug(
                                 f"A winner has been found. Pairing node id: {party_a.id}..."
                             )
                             duo_session_status = DuoSessionStatuses.PAIRED
                             nodes_to_deactivate = [party_a, party_b]
                         else:
-                            logger.info(
+                            logger.debug(
                                 f"No winner was found. Refunding node id: {party_a.id}..."
                             )
                             duo_session_status = DuoSessionStatuses.REFUNDED
@@ -469,13 +623,172 @@ class PairUsers:
                             """Set party_b back to None so that the value is not saved to DuoSession model"""
                             party_b = None
 
-                self.deactivate_results(nodes_to_deactivate)
-                self.create_duo_session(
-                    party_a=party_a,
-                    party_b=party_b,
-                    winner=winner,
-                    duo_session_status=duo_session_status.value,
+                """Deactivate the nodes in memory so that they are not paired again.
+                The Result instances and DuoSessions are saved once all nodes are matched."""
+                for node_to_deactivate in nodes_to_deactivate:
+                    node_to_deactivate.is_active = False
+                    self.score_index.remove(node_to_deactivate)
+
+                duo_session_in = DuoSessionCreateSerializer(
+                    party_a=party_a.user_id,
+                    party_b=party_b.user_id if party_b else None,
+                    winner_id=winner.user_id if winner else None,
+                    session_id=party_a.session_id,
+                    status=duo_session_status.value,
+                )
+                settlements.append((duo_session_in, nodes_to_deactivate))
+
+        return settlements
+
+    def choose_pairs(
+        self, nodes: List[ResultNode], due_result_ids: Set[str]
+    ) -> List[Tuple[ResultNode, ResultNode]]:
+        """Choose pairs of neighbouring nodes from nodes ordered by score.
+        Only nodes next to each other are ever paired because any other pair has a
+        larger score difference. The pairs maximize the players paired and then
+        minimize the total score difference, found in one linear sweep.
+        Nodes with an equal score are never paired, as in closest_nodes."""
+
+        def is_pairable(node: ResultNode) -> bool:
+            return (
+                node.is_active is True
+                and float(node.score) != settings.MODERATED_LOWEST_SCORE
+            )
+
+        # best[i] is (pairs, -total score difference) of the first i nodes
+        best: List[Tuple[int, float]] = [(0, 0.0)] * (len(nodes) + 1)
+        paired_with_previous = [False] * (len(nodes) + 1)
+
+        for i in range(2, len(nodes) + 1):
+            best[i] = best[i - 1]
+            left_node, right_node = nodes[i - 2], nodes[i - 1]
+
+            if not (is_pairable(left_node) and is_pairable(right_node)):
+                continue
+            if float(left_node.score) == float(right_node.score):
+                continue  # Neither player could win, so both are refunded
+            if (
+                left_node.id not in due_result_ids
+                and right_node.id not in due_result_ids
+            ):
+                continue  # Neither result is due, so they are paired in a later run
+
+            # Respect the pairing range by asking get_winner for a winner
+            party_a, party_b = sorted(
+                [left_node, right_node], key=attrgetter("expires_at")
+            )
+            if self.get_winner(
+                PairPartnersSerializer(party_a=party_a, party_b=party_b)
+            ):
+                pairs, negative_score_diff = best[i - 2]
+                with_pair = (
+                    pairs + 1,
+                    negative_score_diff - abs(left_node.score - right_node.score),
+                )
+                if with_pair > best[i]:
+                    best[i] = with_pair
+                    paired_with_previous[i] = True
+
+        chosen_pairs = []
+        i = len(nodes)
+        while i >= 2:
+            if paired_with_previous[i]:
+                chosen_pairs.append((nodes[i - 2], nodes[i - 1]))
+                i -= 2
+            else:
+                i -= 1
+
+        return chosen_pairs
+
+    def get_batch_settlements(
+        self, due_result_ids: Set[str]
+    ) -> List[Tuple[DuoSessionCreateSerializer, List[ResultNode]]]:
+        """Decide how every due node is settled at once. Each (category, session_id)
+        bucket is already ordered by score, so the due cohort is matched in one sweep
+        per bucket instead of a neighbour search per node. Nodes are deactivated in
+        memory and the settlements are returned in the order of the results queue."""
+        settlements: List[Tuple[DuoSessionCreateSerializer, List[ResultNode]]] = []
+
+        paired_nodes: Dict[str, ResultNode] = {}
+        for category, session_id in self.score_index.keys():
+            nodes = self.score_index.ordered_nodes(category, session_id)
+            for left_node, right_node in self.choose_pairs(nodes, due_result_ids):
+                party_a, party_b = sorted(
+                    [left_node, right_node], key=attrgetter("expires_at")
+                )
+                paired_nodes[party_a.id] = party_b
+                paired_nodes[party_b.id] = party_a
+
+        for node in self.results_queue:
+            if node.is_active is not True or node.id not in due_result_ids:
+                continue
+
+            party_a, party_b, winner = node, paired_nodes.get(node.id), None
+            nodes_to_deactivate = [party_a]
+
+            if float(party_a.score) == settings.MODERATED_LOWEST_SCORE:
+                duo_session_status = DuoSessionStatuses.PARTIALLY_REFUNDED
+
+            elif party_b is None:
+                duo_session_status = DuoSessionStatuses.REFUNDED
+
+            else:
+                winner = self.get_winner(
+                    PairPartnersSerializer(party_a=party_a, party_b=party_b)
                 )
+                duo_session_status = DuoSessionStatuses.PAIRED
+                nodes_to_deactivate = [party_a, party_b]
+
+            logger.debug(f"Settling node id: {party_a.id} as {duo_session_status}")
+            for node_to_deactivate in nodes_to_deactivate:
+                node_to_deactivate.is_active = False
+                self.score_index.remove(node_to_deactivate)
+
+            duo_session_in = DuoSessionCreateSerializer(
+                party_a=party_a.user_id,
+                party_b=party_b.user_id if party_b else None,
+                winner_id=winner.user_id if winner else None,
+                session_id=party_a.session_id,
+                status=duo_session_status.value,
+            )
+            settlements.append((duo_session_in, nodes_to_deactivate))
+
+        return settlements
+
+    def match_players(self, save_statistics: bool = True):
+        """Loops through PoolSession to get players, find partners, or refund them.
+        When pairing a shard of the categories, the statistics are only calculated so
+        that they can be saved together with the other shards."""
+        logger.info("Matching players...")
+
+        with self.metrics.phase("statistics", nodes=len(self.results_queue)):
+            if save_statistics:
+                # Save the current PoolSesssion stats to model
+                self.set_pool_session_statistics()
+            else:
+                self.calculate_pool_statistics()
+
+        with self.metrics.phase("matching") as phase:
+            # All sessions are paired or refunded before x time, say 30 mins.
+            # So the pairing process should happen x - y time, where x + y = 30 mins,
+            # That's why the x time is always slightly less.
+            due_result_ids = self.get_due_result_ids()
+            if self.batch_matching:
+                settlements = self.get_batch_settlements(due_result_ids)
+            else:
+                settlements = self.get_settlements(due_result_ids)
+            phase["nodes"] += len(settlements)
+
+        # Commit in batches so that a run that stops keeps the batches it settled
+        batch_size = settings.PAIRING_SETTLEMENT_BATCH_SIZE
+        for start in range(0, len(settlements), batch_size):
+            end = start + batch_size
+            self.settle_duo_sessions(settlements[start:end])
+
+        if self.checkpoint is not None:
+            self.checkpoint.clear()
+
+        self.metrics.emit()
 
 
 # Send message
@@ -7,6 +7,7 @@ class ErrorCodes(str, Enum):
     INACTIVE_ACCOUNT = "This account is currently inactive. Please contact support"
     INVALID_TOKEN = "Could not validate your token"
     INVALID_PHONENUMBER = "The phone number {} is not valid"
+    INVALID_PAGINATION_CURSOR = "The pagination cursor is not valid"
     INVALID_OTP = "The code you entered is not correct. Please try again"
     INSUFFICIENT_BALANCE = "You have insufficient balance. Please top up and try again"
     INCORRECT_USERNAME_OR_PASSWORD = "Incorrect username or password"
@@ -32,6 +32,13 @@ class ChoicesDAOFailedOnCreate(Exception):
         self.message = message
 
 
+class PairingLeaseLost(Exception):
+    """The pairing run no longer holds its lease"""
+
+    def __init__(self, message: str) -> None:
+        self.message = message
+
+
 class InvalidToken(HttpErrorException):
     def __init__(self) -> None:
         super(InvalidToken, self).__init__(
@@ -5,6 +5,7 @@ from app.auth import api as auth_api
 from app.sessions import api as sessions_api
 from app.accounts import api as accounts_api
 from app.quiz import api as quiz_api
+from app.accounts.clients import mpesa_client
 
 # Withouth this code, celery throws a few errors
 from app.core.celery_app import celery  # noqa
@@ -37,3 +38,8 @@ app.include_router(accounts_api.router)
 app.include_router(quiz_api.router)
 
 register_exception_handlers(app)
+
+
+@app.on_event("shutdown")
+async def close_http_clients() -> None:
+    await mpesa_client.close()
@@ -1,9 +1,12 @@
-from typing import Any, Dict, Union
+from typing import Any, Dict, List, Union
+from sqlalchemy import update
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
 
-from app.db.dao import CRUDDao, DaoInterface
+from app.db.dao import CRUDDao, DaoInterface, ChangedObjState
 from app.core.config import settings
+from app.core.pool import results_pool
+from app.core.scheduler import pairing_scheduler
 from app.exceptions.custom import ChoicesDAOFailedOnCreate
 from app.quiz.models import Questions, Choices, Answers, Results, UserAnswers
 from app.quiz.serializers.quiz import (
@@ -47,6 +50,43 @@ class ResultDao(CRUDDao[Results, ResultCreateSerializer, ResultUpdateSerializer]
 
         return db_obj
 
+    def on_post_create(self, db: Session, db_obj: Results) -> None:
+        """Add the result to the pairing pool and schedule its pairing"""
+        results_pool.add(
+            results_pool.result_to_node(db_obj), created_at=db_obj.created_at
+        )
+        pairing_scheduler.schedule(db_obj.expires_at)
+
+    def on_post_update(
+        self, db: Session, db_obj: Results, changed: ChangedObjState
+    ) -> None:
+        """Keep the pairing pool in sync with the result.
+        A result leaves the pool once it is deactivated."""
+        if db_obj.is_active:
+            results_pool.add(
+                results_pool.result_to_node(db_obj), created_at=db_obj.created_at
+            )
+        else:
+            results_pool.remove(db_obj.id)
+
+    def on_post_delete(self, db: Session, db_obj: Results) -> None:
+        """Remove the result from the pairing pool"""
+        results_pool.remove(db_obj.id)
+
+    def deactivate_many(self, db: Session, *, ids: List[str]) -> None:
+        """Deactivate several results with one UPDATE.
+        The caller is responsible for committing and for removing the
+        results from the pairing pool once committed."""
+        if not ids:
+            return
+
+        db.execute(
+            update(Results)
+            .where(Results.id.in_(ids))
+            .values(is_active=False)
+            .execution_options(synchronize_session=False)
+        )
+
 
 result_dao = ResultDao(Results)
 
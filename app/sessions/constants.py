@@ -11,3 +11,9 @@ class DuoSessionStatuses(str, Enum):  # Also acts as role names
     def list_(cls) -> List:
         duo_session_statuses = {type.value for type in cls}
         return list(duo_session_statuses)
+
+
+class DuoSessionSettlementStatuses(str, Enum):
+    PENDING = "PENDING"
+    SETTLED = "SETTLED"
+    FAILED = "FAILED"
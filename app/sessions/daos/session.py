@@ -1,11 +1,20 @@
+import json
 from sqlalchemy.orm import Session
+from sqlalchemy import insert, select, update, or_
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from typing import Dict, List, Tuple
+from datetime import datetime
 
 from app.db.dao import CRUDDao
-from app.core.config import settings
+from app.db.base_class import generate_uuid
+from app.core.config import settings, redis
+from app.core.logger import logger
+from app.core.celery_app import celery
 from app.core.helpers import convert_list_to_string, generate_transaction_code
 
+from app.users.models import User
 from app.users.daos.user import user_dao
-from app.accounts.daos.account import transaction_dao
+from app.accounts.daos.account import transaction_dao, wallet_balance_dao
 from app.accounts.constants import (
     TransactionTypes,
     TransactionCashFlow,
@@ -21,7 +30,7 @@ from app.accounts.constants import (
 from app.accounts.serializers.account import TransactionCreateSerializer
 
 from app.accounts.constants import SESSION_WIN_MESSAGE
-from app.exceptions.custom import DuoSessionFailedOnCreate
+from app.exceptions.custom import DuoSessionFailedOnCreate, ObjectDoesNotExist
 from app.exceptions.custom import QuestionExistsInASession, FewQuestionsInSession
 
 from app.sessions.models import (
@@ -29,6 +38,8 @@ from app.sessions.models import (
     DuoSession,
     UserSessionStats,
     PoolSessionStats,
+    PoolCategoryState,
+    DuoSessionSettlement,
 )
 from app.sessions.serializers.session import (
     SessionCreateSerializer,
@@ -39,15 +50,127 @@ from app.sessions.serializers.session import (
     UserSessionStatsUpdateSerializer,
     PoolSessionStatsCreateSerializer,
     PoolSessionStatsUpdateSerializer,
+    PoolCategoryStateCreateSerializer,
+    PoolCategoryStateUpdateSerializer,
+    DuoSessionSettlementCreateSerializer,
+    DuoSessionSettlementUpdateSerializer,
 )
 from app.sessions.filters import DuoSessionFilter
-from app.sessions.constants import DuoSessionStatuses
+from app.sessions.constants import DuoSessionStatuses, DuoSessionSettlementStatuses
 
 from app.notifications.daos.notifications import notifications_dao
 from app.notifications.constants import NotificationChannels, NotificationTypes
 from app.notifications.serializers.notifications import CreateNotificationSerializer
 
 
+class PoolCategoryStateDao(
+    CRUDDao[
+        PoolCategoryState,
+        PoolCategoryStateCreateSerializer,
+        PoolCategoryStateUpdateSerializer,
+    ]
+):
+    """The latest EWMA of each category, kept in Redis and mirrored to the
+    PoolCategoryState table. PoolSessionStats remains the full history."""
+
+    redis_key = "pool_category_state"
+
+    @staticmethod
+    def get_ewmas_from_statistics(statistics: Dict) -> Dict[str, float]:
+        """Get the EWMA of each category in a PoolSessionStats statistics dict"""
+        ewmas = {}
+        for category, category_stats in statistics.items():
+            ewma = category_stats.get("exp_weighted_moving_average", None)
+            if ewma is not None:
+                ewmas[category] = ewma
+
+        return ewmas
+
+    def get_ewmas(self, db: Session) -> Dict[str, float]:
+        """Get the latest EWMA of each category.
+        Read from Redis first, then from the table and lastly from the
+        latest PoolSessionStats instance"""
+        cached_ewmas = redis.hgetall(self.redis_key)
+        if cached_ewmas:
+            return {category: float(ewma) for category, ewma in cached_ewmas.items()}
+
+        ewmas = {
+            state.category: state.exp_weighted_moving_average
+            for state in self.get_all(db)
+            if state.exp_weighted_moving_average is not None
+        }
+
+        if not ewmas:
+            latest_pool_session_stats = (
+                db.query(PoolSessionStats)
+                .order_by(PoolSessionStats.created_at.desc())
+                .first()
+            )
+            if latest_pool_session_stats is not None:
+                ewmas = self.get_ewmas_from_statistics(
+                    latest_pool_session_stats.statistics
+                )
+                self.save_ewmas(db, ewmas)
+                db.commit()
+
+        self.cache_ewmas(ewmas)
+        return ewmas
+
+    def save_ewmas(self, db: Session, ewmas: Dict[str, float]) -> None:
+        """Insert or replace the row of each category.
+        The caller is responsible for committing."""
+        if not ewmas:
+            return
+
+        now = datetime.now()
+        stmt = postgresql_insert(PoolCategoryState.__table__).values(
+            [
+                {
+                    "id": generate_uuid(),
+                    "created_at": now,
+                    "category": category,
+                    "exp_weighted_moving_average": ewma,
+                }
+                for category, ewma in ewmas.items()
+            ]
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["category"],
+            set_={
+                "exp_weighted_moving_average": stmt.excluded.exp_weighted_moving_average,
+                "updated_at": now,
+            },
+        )
+        db.execute(stmt)
+
+    def cache_ewmas(self, ewmas: Dict[str, float]) -> None:
+        """Merge the EWMAs into the cache. Categories that are not given keep
+        their cached EWMA, like their row in the table."""
+        if ewmas:
+            redis.hset(self.redis_key, mapping=ewmas)
+
+    def claim_ewma_update(self, category: str) -> bool:
+        """Claim the EWMA update of a category for the current interval.
+        Returns False if a run has already claimed it."""
+        return bool(
+            redis.set(
+                f"{self.redis_key}:updated:{category}",
+                1,
+                nx=True,
+                ex=settings.EWMA_UPDATE_INTERVAL_SECONDS,
+            )
+        )
+
+    def clear(self, db: Session) -> None:
+        """Delete the latest EWMAs so that they are rebuilt on the next read"""
+        db.query(PoolCategoryState).delete()
+        db.commit()
+        redis.delete(self.redis_key)
+
+
+pool_category_state_dao = PoolCategoryStateDao(PoolCategoryState)
+
+
 class PoolSessionStatsDao(
     CRUDDao[
         PoolSessionStats,
@@ -58,9 +181,25 @@ class PoolSessionStatsDao(
     def on_pre_create(
         self, db: Session, id: str, values: dict, orig_values: dict
     ) -> None:
-        """Automatically assign value to the _statisitics value"""
+        """Automatically assign value to the _statisitics value.
+        The latest EWMAs are saved in the same transaction."""
         values["_statistics"] = orig_values["statistics"]
 
+        statistics = json.loads(orig_values.get("statistics") or "{}")
+        pool_category_state_dao.save_ewmas(
+            db, pool_category_state_dao.get_ewmas_from_statistics(statistics)
+        )
+
+    def on_post_create(self, db: Session, db_obj: PoolSessionStats) -> None:
+        """Cache the latest EWMAs once they are committed"""
+        pool_category_state_dao.cache_ewmas(
+            pool_category_state_dao.get_ewmas_from_statistics(db_obj.statistics)
+        )
+
+    def on_post_delete(self, db: Session, db_obj: PoolSessionStats) -> None:
+        """The latest EWMAs may have come from the deleted instance"""
+        pool_category_state_dao.clear(db)
+
 
 pool_session_stats_dao = PoolSessionStatsDao(PoolSessionStats)
 
@@ -151,44 +290,55 @@ class DuoSessionDao(
                 f"Please remove {orig_values['party_b']}"
             )
 
-    def on_post_create(
-        self,
-        db: Session,
-        db_obj: DuoSession,
-    ) -> None:
-        """Update user wallets and send notifications"""
+    def send_message(self, db: Session, *, phone: str, message: str) -> None:
+        """Send message to DuoSession players"""
+        channel = NotificationChannels.SMS.value
+        type = NotificationTypes.SESSION.value
 
-        def send_message(phone: str, message: str) -> None:
-            """Send message to DuoSession players"""
-            channel = NotificationChannels.SMS.value
-            type = NotificationTypes.SESSION.value
+        # Task: in future, ensure this task runs in the background
+        # and exceptions are handled correctly
+        try:
+            notifications_dao.send_notification(
+                db,
+                obj_in=CreateNotificationSerializer(
+                    channel=channel,
+                    phone=phone,
+                    message=message,
+                    type=type,
+                ),
+            )
+        except Exception:
+            pass
 
-            # Task: in future, ensure this task runs in the background
-            # and exceptions are handled correctly
-            try:
-                notifications_dao.send_notification(
-                    db,
-                    obj_in=CreateNotificationSerializer(
-                        channel=channel,
-                        phone=phone,
-                        message=message,
-                        type=type,
-                    ),
-                )
-            except Exception:
-                pass
+    def get_settlement(
+        self,
+        duo_session: DuoSession | DuoSessionCreateSerializer,
+        *,
+        category: str,
+        users: Dict[str, User],
+    ) -> Tuple[List[TransactionCreateSerializer], List[Tuple[str, str]]]:
+        """Get the wallet transactions and the messages that settle a DuoSession.
+        Messages are returned as (phone, message) tuples."""
+        transactions: List[TransactionCreateSerializer] = []
+        messages: List[Tuple[str, str]] = []
+
+        def get_user(user_id: str) -> User:
+            if user_id not in users:
+                raise ObjectDoesNotExist(f"User with id {user_id} could not be found")
+            return users[user_id]
 
         """Updates the winner's wallet to reflect the new amount"""
-        if db_obj.status == DuoSessionStatuses.PAIRED:
-            winner = user_dao.get_not_none(db, id=db_obj.winner_id)
-            description = SESSION_WIN_DESCRIPION.format(winner.phone, db_obj.session_id)
+        if duo_session.status == DuoSessionStatuses.PAIRED:
+            winner = get_user(duo_session.winner_id)
+            description = SESSION_WIN_DESCRIPION.format(
+                winner.phone, duo_session.session_id
+            )
 
-            amount_won = settings.SESSION_WIN_RATIO * float(db_obj.amount)
-            winner_message = SESSION_WIN_MESSAGE.format(amount_won, db_obj.category)
+            amount_won = settings.SESSION_WIN_RATIO * float(duo_session.amount)
+            winner_message = SESSION_WIN_MESSAGE.format(amount_won, category)
 
-            transaction_dao.create(
-                db,
-                obj_in=TransactionCreateSerializer(
+            transactions.append(
+                TransactionCreateSerializer(
                     account=winner.phone,
                     external_transaction_id=generate_transaction_code(),
                     cash_flow=TransactionCashFlow.INWARD.value,
@@ -197,36 +347,35 @@ class DuoSessionDao(
                     service=TransactionServices.SESSION.value,
                     description=description,
                     amount=amount_won,
-                ),
+                )
             )
 
             # Send message to the winner
-            send_message(winner.phone, winner_message)
+            messages.append((winner.phone, winner_message))
 
             # Get the opponent id
             opponent_id = (
-                db_obj.party_a if winner.id != db_obj.party_a else db_obj.party_b
+                duo_session.party_a
+                if winner.id != duo_session.party_a
+                else duo_session.party_b
             )
-            opponent = user_dao.get_not_none(db, id=opponent_id)
-            opponent_message = SESSION_LOSS_MESSAGE.format(db_obj.category)
+            opponent = get_user(opponent_id)
+            opponent_message = SESSION_LOSS_MESSAGE.format(category)
 
             # Send message to the opponent
-            send_message(opponent.phone, opponent_message)
+            messages.append((opponent.phone, opponent_message))
 
         """Update party_a's wallet to reflect the refund"""
-        if db_obj.status == DuoSessionStatuses.REFUNDED:
-            user = user_dao.get_not_none(db, id=db_obj.party_a)
+        if duo_session.status == DuoSessionStatuses.REFUNDED:
+            user = get_user(duo_session.party_a)
             description = REFUND_SESSION_DESCRIPTION.format(
-                user.phone, db_obj.session_id
-            )
-            refund_amount = settings.SESSION_REFUND_RATIO * float(db_obj.amount)
-            refund_message = SESSION_REFUND_MESSAGE.format(
-                refund_amount, db_obj.category
+                user.phone, duo_session.session_id
             )
+            refund_amount = settings.SESSION_REFUND_RATIO * float(duo_session.amount)
+            refund_message = SESSION_REFUND_MESSAGE.format(refund_amount, category)
 
-            transaction_dao.create(
-                db,
-                obj_in=TransactionCreateSerializer(
+            transactions.append(
+                TransactionCreateSerializer(
                     account=user.phone,
                     external_transaction_id=generate_transaction_code(),
                     cash_flow=TransactionCashFlow.INWARD.value,
@@ -235,29 +384,28 @@ class DuoSessionDao(
                     service=TransactionServices.SESSION.value,
                     description=description,
                     amount=refund_amount,
-                ),
+                )
             )
 
             # Send message to party_a on refund
-            send_message(user.phone, refund_message)
+            messages.append((user.phone, refund_message))
 
         """Update party_a's wallet to reflect the partial refund"""
-        if db_obj.status == DuoSessionStatuses.PARTIALLY_REFUNDED:
-            user = user_dao.get_not_none(db, id=db_obj.party_a)
+        if duo_session.status == DuoSessionStatuses.PARTIALLY_REFUNDED:
+            user = get_user(duo_session.party_a)
             description = PARTIALLY_REFUND_SESSION_DESCRIPTION.format(
-                user.phone, db_obj.session_id
+                user.phone, duo_session.session_id
             )
 
             partial_refund_amount = settings.SESSION_PARTIAL_REFUND_RATIO * float(
-                db_obj.amount
+                duo_session.amount
             )
             partial_refund_message = SESSION_PARTIAL_REFUND_MESSAGE.format(
-                partial_refund_amount, db_obj.category
+                partial_refund_amount, category
             )
 
-            transaction_dao.create(
-                db,
-                obj_in=TransactionCreateSerializer(
+            transactions.append(
+                TransactionCreateSerializer(
                     account=user.phone,
                     external_transaction_id=generate_transaction_code(),
                     cash_flow=TransactionCashFlow.INWARD.value,
@@ -266,16 +414,283 @@ class DuoSessionDao(
                     service=TransactionServices.SESSION.value,
                     description=description,
                     amount=partial_refund_amount,
-                ),
+                )
             )
 
             # Send message to party_a on partial refund
-            send_message(user.phone, partial_refund_message)
+            messages.append((user.phone, partial_refund_message))
+
+        return transactions, messages
+
+    def on_relationship(
+        self, db: Session, *, id: str, values: dict, create: bool = True, **kwargs
+    ) -> None:
+        """Record the settlement event in the same transaction as a new DuoSession.
+        An updated DuoSession already has its settlement event."""
+        if create:
+            duo_session_settlement_dao.enqueue_many(db, duo_session_ids=[id])
+
+    def on_post_create(
+        self,
+        db: Session,
+        db_obj: DuoSession,
+    ) -> None:
+        """Wallets are credited and notifications sent by the settlement worker"""
+        duo_session_settlement_dao.schedule()
+
+    def create_many(
+        self, db: Session, *, objs_in: List[DuoSessionCreateSerializer]
+    ) -> List[DuoSessionCreateSerializer]:
+        """Create several DuoSessions and their settlement events with one
+        multi-row insert each. DuoSessions that break a constraint in
+        on_pre_create are skipped.
+        The caller is responsible for committing and for scheduling the settlement
+        worker once committed."""
+        logger.info(f"Creating {len(objs_in)} DuoSession instances...")
+        if not objs_in:
+            return []
+
+        session_ids = {obj_in.session_id for obj_in in objs_in}
+        user_ids = {obj_in.party_a for obj_in in objs_in} | {
+            obj_in.party_b for obj_in in objs_in if obj_in.party_b is not None
+        }
+
+        # Constraint 1: Parties can not play a session_id twice
+        played_sessions = set()
+        previous_duo_sessions = db.execute(
+            select(DuoSession.party_a, DuoSession.party_b, DuoSession.session_id).where(
+                DuoSession.session_id.in_(session_ids),
+                or_(DuoSession.party_a.in_(user_ids), DuoSession.party_b.in_(user_ids)),
+            )
+        ).all()
+        for party_a, party_b, session_id in previous_duo_sessions:
+            played_sessions.update({(party_a, session_id), (party_b, session_id)})
+
+        valid_objs_in = []
+        for obj_in in objs_in:
+            parties = [obj_in.party_a]
+            if obj_in.party_b is not None:
+                parties.append(obj_in.party_b)
+
+            error = None
+            if any((party, obj_in.session_id) in played_sessions for party in parties):
+                error = (
+                    f"A party has played the session id: {obj_in.session_id} before."
+                )
+
+            # Constraint 2: party_a and party_b can never be the same
+            elif obj_in.party_a == obj_in.party_b:
+                error = "Party A & Party B can not be the same for a DuoSession."
+
+            # Constraint 3: party_b should not exist for PARTIAL_REFUNDS or REFUNDS.
+            elif obj_in.party_b is not None and obj_in.status in [
+                DuoSessionStatuses.PARTIALLY_REFUNDED.value,
+                DuoSessionStatuses.REFUNDED.value,
+            ]:
+                error = f"Party B should not exist for {obj_in.status}."
+
+            if error is not None:
+                logger.error(f"Skipping DuoSession for {obj_in.party_a}: {error}")
+                continue
+
+            played_sessions.update((party, obj_in.session_id) for party in parties)
+            valid_objs_in.append(obj_in)
+
+        if not valid_objs_in:
+            return []
+
+        created_at = datetime.now()
+        rows = [
+            {"id": generate_uuid(), "created_at": created_at, **obj_in.dict()}
+            for obj_in in valid_objs_in
+        ]
+
+        db.execute(insert(DuoSession.__table__), rows)
+        duo_session_settlement_dao.enqueue_many(
+            db, duo_session_ids=[row["id"] for row in rows]
+        )
+
+        return valid_objs_in
 
 
 duo_session_dao = DuoSessionDao(DuoSession)
 
 
+class DuoSessionSettlementDao(
+    CRUDDao[
+        DuoSessionSettlement,
+        DuoSessionSettlementCreateSerializer,
+        DuoSessionSettlementUpdateSerializer,
+    ]
+):
+    """
+    A durable queue of DuoSessions waiting to be settled.
+
+    Creating a DuoSession only records its settlement event. The settlement worker
+    takes pending events in batches, credits the wallets of each batch in one
+    transaction and then sends the notifications, so pairing never waits on wallet
+    writes or the SMS provider. Workers skip events locked by other workers.
+    If a batch fails, each of its events is settled in its own savepoint. An event
+    that still fails is retried by later batches until it has been attempted
+    DUO_SESSION_SETTLEMENT_MAX_ATTEMPTS times, and is then marked failed.
+    """
+
+    task_name = "app.sessions.tasks.settle_duo_sessions_task"
+
+    def enqueue_many(self, db: Session, *, duo_session_ids: List[str]) -> None:
+        """Record pending settlement events. The caller is responsible for committing"""
+        if not duo_session_ids:
+            return
+
+        created_at = datetime.now()
+        db.execute(
+            insert(DuoSessionSettlement.__table__),
+            [
+                {
+                    "id": generate_uuid(),
+                    "created_at": created_at,
+                    "duo_session_id": duo_session_id,
+                    "status": DuoSessionSettlementStatuses.PENDING.value,
+                    "attempts": 0,
+                }
+                for duo_session_id in duo_session_ids
+            ],
+        )
+
+    def schedule(self) -> None:
+        """Wake the settlement worker. Events whose worker is never woken
+        are settled by the periodic settlement run"""
+        try:
+            celery.send_task(self.task_name, queue=settings.CELERY_SETTLEMENT_QUEUE)
+        except Exception as e:
+            logger.error(f"Exception {e} while scheduling the settlement worker")
+
+    def settle_pending(
+        self, db: Session, *, batch_size: int | None = None
+    ) -> Tuple[int, List[Tuple[str, str]]]:
+        """Settle a batch of pending events in one transaction.
+        Returns the number of events taken and the (phone, message) tuples
+        to send now that the batch is committed."""
+        batch_size = batch_size or settings.DUO_SESSION_SETTLEMENT_BATCH_SIZE
+
+        pending = db.execute(
+            select(DuoSessionSettlement, DuoSession)
+            .join(DuoSession, DuoSession.id == DuoSessionSettlement.duo_session_id)
+            .where(
+                DuoSessionSettlement.status
+                == DuoSessionSettlementStatuses.PENDING.value
+            )
+            .order_by(DuoSessionSettlement.created_at)
+            .limit(batch_size)
+            .with_for_update(of=DuoSessionSettlement, skip_locked=True)
+        ).all()
+
+        if not pending:
+            db.commit()
+            return 0, []
+
+        logger.info(f"Settling {len(pending)} DuoSessions...")
+        user_ids = {
+            user_id
+            for _, duo_session in pending
+            for user_id in [
+                duo_session.party_a,
+                duo_session.party_b,
+                duo_session.winner_id,
+            ]
+            if user_id is not None
+        }
+        users = {user.id: user for user in user_dao.get_by_ids(db, ids=list(user_ids))}
+
+        settlements: Dict[str, Tuple[List[TransactionCreateSerializer], List]] = {}
+        errors: Dict[str, str] = {}
+        failed_ids = set()
+
+        for settlement, duo_session in pending:
+            try:
+                settlements[settlement.id] = duo_session_dao.get_settlement(
+                    duo_session, category=duo_session.category, users=users
+                )
+            except ObjectDoesNotExist as e:
+                # Keep the event for inspection instead of blocking the queue
+                logger.error(f"Failed to settle DuoSession {duo_session.id}: {e}")
+                errors[settlement.id] = str(e)
+                failed_ids.add(settlement.id)
+
+        try:
+            try:
+                with wallet_balance_dao.savepoint(db):
+                    transaction_dao.create_many(
+                        db,
+                        objs_in=[
+                            transaction
+                            for transactions, _ in settlements.values()
+                            for transaction in transactions
+                        ],
+                    )
+            except Exception as e:
+                # Settle each event on its own so that one event can not fail the batch
+                logger.error(f"Exception {e} while settling the batch. Retrying each")
+                for settlement_id, (transactions, _) in list(settlements.items()):
+                    try:
+                        with wallet_balance_dao.savepoint(db):
+                            transaction_dao.create_many(db, objs_in=transactions)
+                    except Exception as e:
+                        logger.error(f"Exception {e} while settling {settlement_id}")
+                        errors[settlement_id] = str(e)
+                        del settlements[settlement_id]
+
+            if settlements:
+                db.execute(
+                    update(DuoSessionSettlement)
+                    .where(DuoSessionSettlement.id.in_(list(settlements)))
+                    .values(
+                        status=DuoSessionSettlementStatuses.SETTLED.value,
+                        attempts=DuoSessionSettlement.attempts + 1,
+                        settled_at=datetime.now(),
+                    )
+                )
+            for settlement, _ in pending:
+                if settlement.id not in errors:
+                    continue
+
+                # An event that keeps failing is retried until it runs out of attempts
+                if (
+                    settlement.id in failed_ids
+                    or settlement.attempts + 1
+                    >= settings.DUO_SESSION_SETTLEMENT_MAX_ATTEMPTS
+                ):
+                    status = DuoSessionSettlementStatuses.FAILED.value
+                else:
+                    status = DuoSessionSettlementStatuses.PENDING.value
+
+                db.execute(
+                    update(DuoSessionSettlement)
+                    .where(DuoSessionSettlement.id == settlement.id)
+                    .values(
+                        status=status,
+                        attempts=DuoSessionSettlement.attempts + 1,
+                        error=errors[settlement.id],
+                    )
+                )
+            db.commit()
+
+        except Exception:
+            # The events stay pending and are retried by the next batch
+            db.rollback()
+            raise
+
+        messages = [
+            message
+            for _, duo_session_messages in settlements.values()
+            for message in duo_session_messages
+        ]
+        return len(pending), messages
+
+
+duo_session_settlement_dao = DuoSessionSettlementDao(DuoSessionSettlement)
+
+
 class SessionDao(CRUDDao[Sessions, SessionCreateSerializer, SessionUpdateSerializer]):
     def session_has_unique_questions(self, db: Session, values: dict) -> None:
         """A question should not exist twice in any session"""
@@ -3,10 +3,11 @@ from typing import List
 
 from app.db.base_class import Base
 from app.core.config import settings
+from app.sessions.constants import DuoSessionSettlementStatuses
 
 from sqlalchemy.sql import select
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy import String, Text, ForeignKey, Float, Integer
+from sqlalchemy import String, Text, ForeignKey, Float, Integer, DateTime
 from sqlalchemy.orm import mapped_column, relationship, column_property
 
 
@@ -66,6 +67,19 @@ class PoolSessionStats(Base):
     # )
 
 
+class PoolCategoryState(Base):
+    """Latest statistics of a category.
+    Each category has one row that is replaced after every PoolSession,
+    so the previous EWMA is read without scanning PoolSessionStats"""
+
+    category = mapped_column(String, nullable=False, unique=True)
+    exp_weighted_moving_average = mapped_column(
+        Float,
+        nullable=True,
+        comment="The exponential moving average of pairwise diff. of the pool",
+    )
+
+
 class Sessions(Base):
     """Session model"""
 
@@ -100,3 +114,25 @@ class DuoSession(Base):
         .correlate_except(Sessions)
         .scalar_subquery()
     )
+
+
+class DuoSessionSettlement(Base):
+    """Settlement event of a DuoSession.
+    Written in the same transaction as the DuoSession and consumed by the
+    settlement worker, which credits wallets and notifies the players"""
+
+    duo_session_id = mapped_column(
+        String,
+        ForeignKey("duosession.id", ondelete="CASCADE"),
+        nullable=False,
+        unique=True,
+    )
+    status = mapped_column(
+        String,
+        nullable=False,
+        index=True,
+        default=DuoSessionSettlementStatuses.PENDING.value,
+    )
+    attempts = mapped_column(Integer, nullable=False, default=0)
+    error = mapped_column(Text, nullable=True)
+    settled_at = mapped_column(DateTime, nullable=True)
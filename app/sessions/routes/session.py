@@ -19,10 +19,12 @@ from app.core.config import templates, settings
 from app.core.deps import (
     get_current_active_user_or_none,
     get_current_active_user,
+    get_current_active_superuser,
     get_db,
     business_is_open,
 )
 from app.core.logger import LoggingRoute
+from app.core.metrics import PairingRunMetrics
 
 
 router = APIRouter(route_class=LoggingRoute)
@@ -197,3 +199,11 @@ async def get_sessions_history(
         f"{template_prefix}history.html",
         {"request": request, "title": "History", "sessions_history": sessions_history},
     )
+
+
+@router.get("/pairing-metrics/")
+async def get_pairing_metrics(
+    _: User = Depends(get_current_active_superuser),
+):
+    """Get the latest pairing run of each shard and the totals of all runs"""
+    return PairingRunMetrics.get_metrics()
@@ -2,6 +2,7 @@ from pydantic.dataclasses import dataclass
 from pydantic import BaseModel
 from fastapi import Form
 from typing import List
+from datetime import datetime
 
 from app.core.helpers import _is_valid_category
 from app.core.config import settings
@@ -72,6 +73,34 @@ class PoolSessionStatsUpdateSerializer(PoolSessionStatsBaseSerializer):
     pass
 
 
+class PoolCategoryStateBaseSerializer(BaseModel):
+    category: str
+    exp_weighted_moving_average: float | None = None
+
+
+class PoolCategoryStateCreateSerializer(PoolCategoryStateBaseSerializer):
+    pass
+
+
+class PoolCategoryStateUpdateSerializer(PoolCategoryStateBaseSerializer):
+    pass
+
+
+class DuoSessionSettlementBaseSerializer(BaseModel):
+    duo_session_id: str
+    status: str | None = None
+    error: str | None = None
+    settled_at: datetime | None = None
+
+
+class DuoSessionSettlementCreateSerializer(DuoSessionSettlementBaseSerializer):
+    pass
+
+
+class DuoSessionSettlementUpdateSerializer(DuoSessionSettlementBaseSerializer):
+    pass
+
+
 class PoolCategoryStatistics(BaseModel):
     players: int | None = None
     threshold: float | None = None
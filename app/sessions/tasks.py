@@ -1,6 +1,18 @@
+from typing import Dict, List
+from celery import chord
+from datetime import datetime
+
 from app.core.utils import PairUsers
+from app.core.pool import results_pool, PairingCheckpoint
+from app.core.lease import LeaseLock
+from app.core.scheduler import pairing_scheduler
+from app.core.config import settings
 from app.core.celery_app import celery
 from app.core.logger import logger
+from app.commons.constants import Categories
+from app.db.session import SessionLocal
+from app.exceptions.custom import PairingLeaseLost
+from app.sessions.daos.session import duo_session_dao, duo_session_settlement_dao
 
 
 # @celery.task(name=__name__ + ".first_celery_task")
@@ -10,7 +22,114 @@ from app.core.logger import logger
 
 @celery.task(name=__name__ + ".pair_users_task", max_retries=0)
 def pair_users_task():
-    """Periodically run the task of pairing users"""
+    """Periodically run the task of pairing users.
+    A pairing never crosses a category, so each category is paired by its own task
+    and the statistics of all categories are saved once every category is paired"""
     logger.info("Initiating pair users celery task")
-    pair_users = PairUsers()
-    pair_users.match_players()
+
+    # Build the pool once so that the category tasks do not rebuild it concurrently
+    if not results_pool.is_warm():
+        with SessionLocal() as db:
+            results_pool.rebuild(db)
+
+    if not results_pool.due_result_ids(datetime.now()):
+        logger.info("No results are due for pairing")
+        return
+
+    category_tasks = [
+        pair_category_users_task.s(category).set(queue=settings.CELERY_SCHEDULER_QUEUE)
+        for category in Categories.list_()
+    ]
+    chord(category_tasks)(
+        save_pool_session_stats_task.s().set(queue=settings.CELERY_SCHEDULER_QUEUE)
+    )
+
+
+def get_statistics_to_save(pair_users: PairUsers) -> Dict:
+    """The statistics of a category run if it mixed the category's EWMA"""
+    return pair_users.statistics if pair_users.updated_ewma_categories else {}
+
+
+@celery.task(name=__name__ + ".pair_category_users_task", max_retries=0)
+def pair_category_users_task(category: str) -> Dict:
+    """Pair users in one category and return the category's statistics.
+    A run skips a category that another run holds the lease on, so that a result is
+    never settled twice, and resumes from the checkpoint of a run that did not finish.
+    A run that fails returns the statistics it has, so that the other categories'
+    statistics are still saved. Statistics are only returned by the run that mixes
+    the category's EWMA, so they are saved once per EWMA interval."""
+    logger.info(f"Initiating pair users celery task for category: {category}")
+    lease = LeaseLock(f"pair_users_task:{category}")
+
+    if not lease.acquire(blocking=False):
+        # Waiting would hold a worker that the runs of later windows need
+        logger.info(f"Category {category} is being paired. Skipping to the next run")
+        pairing_scheduler.schedule_next_window()
+        return {}
+
+    pair_users = None
+    try:
+        pair_users = PairUsers(
+            categories=[category],
+            lease=lease,
+            checkpoint=PairingCheckpoint(category),
+        )
+        pair_users.match_players(save_statistics=False)
+
+    except PairingLeaseLost as e:
+        # The run that took over resumes from the checkpoint
+        logger.error(e.message)
+        return {}
+
+    except Exception as e:
+        # Results that were not settled are paired by a later run
+        logger.exception(f"Exception {e} while pairing category: {category}")
+        return get_statistics_to_save(pair_users) if pair_users is not None else {}
+
+    finally:
+        lease.release()
+
+    return get_statistics_to_save(pair_users)
+
+
+@celery.task(name=__name__ + ".save_pool_session_stats_task", max_retries=0)
+def save_pool_session_stats_task(category_statistics: List[Dict]) -> None:
+    """Save the statistics returned by each category task as one PoolSessionStats.
+    Nothing is saved when every category task was skipped or failed."""
+    statistics = {}
+    for category_stats in category_statistics:
+        statistics.update(category_stats)
+
+    if not statistics:
+        logger.info("No category returned statistics to save")
+        return
+
+    PairUsers.save_pool_session_statistics(statistics)
+
+
+@celery.task(name=__name__ + ".settle_duo_sessions_task", max_retries=0)
+def settle_duo_sessions_task() -> None:
+    """Settle pending DuoSessions in batches until none is left.
+    Workers can drain the queue together because each takes a different batch.
+    The messages of a batch are sent by their own task once the batch is committed"""
+    logger.info("Initiating settle DuoSessions celery task")
+
+    while True:
+        with SessionLocal() as db:
+            total_settled, messages = duo_session_settlement_dao.settle_pending(db)
+
+        if messages:
+            send_settlement_messages_task.apply_async(
+                args=[messages], queue=settings.CELERY_SETTLEMENT_QUEUE
+            )
+
+        if total_settled < settings.DUO_SESSION_SETTLEMENT_BATCH_SIZE:
+            break
+
+
+@celery.task(name=__name__ + ".send_settlement_messages_task", max_retries=0)
+def send_settlement_messages_task(messages: List[List[str]]) -> None:
+    """Send the (phone, message) pairs of a settled batch"""
+    with SessionLocal() as db:
+        for phone, message in messages:
+            duo_session_dao.send_message(db, phone=phone, message=message)
@@ -13,7 +13,7 @@ from app.accounts.daos.account import transaction_dao
 from app.accounts.serializers.account import TransactionCreateSerializer
 from app.accounts.tests.test_data import sample_transaction_instance_deposit_1000
 
-from app.core.deps import business_is_open
+from app.core.deps import business_is_open, get_current_active_superuser
 from app.core.helpers import md5_hash
 from app.core.config import redis, settings
 
@@ -127,3 +127,18 @@ def test_get_landing_page_shows_correctly(
     """Test that the landing page shows correctly"""
     response = client.get("/session/")
     assert response.template.name == "sessions/templates/landing.html"
+
+
+def test_get_pairing_metrics_returns_metrics(
+    db: Session,
+    client: TestClient,
+    flush_redis: Callable,
+) -> None:
+    """Test that superusers can read the pairing metrics"""
+    app.dependency_overrides[get_current_active_superuser] = lambda: None
+
+    response = client.get("/session/pairing-metrics/")
+    app.dependency_overrides.pop(get_current_active_superuser)
+
+    assert response.status_code == 200
+    assert response.json() == {"latest": [], "totals": {}}
@@ -4,7 +4,7 @@ from typing import Callable
 import pytest
 import json
 
-from app.core.config import settings
+from app.core.config import settings, redis
 from app.commons.constants import Categories
 from app.exceptions.custom import DuoSessionFailedOnCreate
 from app.accounts.daos.account import transaction_dao
@@ -14,6 +14,8 @@ from app.sessions.daos.session import (
     duo_session_dao,
     user_session_stats_dao,
     pool_session_stats_dao,
+    pool_category_state_dao,
+    duo_session_settlement_dao,
 )
 from app.sessions.serializers.session import (
     SessionCreateSerializer,
@@ -66,6 +68,58 @@ def test_create_pool_session_stats_instance(db: Session) -> None:
     )
 
 
+def test_pool_session_stats_instance_updates_latest_ewmas(
+    db: Session, flush_redis: Callable
+) -> None:
+    """Assert the latest EWMA of each category is saved to the table and Redis"""
+    stats = {}
+    stats[Categories.BIBLE.value] = PoolCategoryStatistics(
+        players=1, exp_weighted_moving_average=3.5
+    ).dict()
+
+    pool_session_stats_dao.create(
+        db,
+        obj_in=PoolSessionStatsCreateSerializer(
+            total_players=1, statistics=json.dumps(stats)
+        ),
+    )
+
+    category_state = pool_category_state_dao.get_not_none(
+        db, category=Categories.BIBLE.value
+    )
+    assert category_state.exp_weighted_moving_average == 3.5
+    assert pool_category_state_dao.get_ewmas(db)[Categories.BIBLE.value] == 3.5
+
+    # The table is read when Redis has lost the cache
+    redis.delete(pool_category_state_dao.redis_key)
+    assert pool_category_state_dao.get_ewmas(db)[Categories.BIBLE.value] == 3.5
+
+
+def test_pool_session_stats_instance_keeps_ewmas_of_other_categories(
+    db: Session, flush_redis: Callable
+) -> None:
+    """Assert an instance without a category does not drop its cached EWMA"""
+    for category, ewma in [
+        (Categories.BIBLE.value, 3.5),
+        (Categories.FOOTBALL.value, 2.0),
+    ]:
+        stats = {
+            category: PoolCategoryStatistics(
+                players=1, exp_weighted_moving_average=ewma
+            ).dict()
+        }
+        pool_session_stats_dao.create(
+            db,
+            obj_in=PoolSessionStatsCreateSerializer(
+                total_players=1, statistics=json.dumps(stats)
+            ),
+        )
+
+    ewmas = pool_category_state_dao.get_ewmas(db)
+    assert ewmas[Categories.BIBLE.value] == 3.5
+    assert ewmas[Categories.FOOTBALL.value] == 2.0
+
+
 def test_create_user_session_stats_instance(
     db: Session,
     create_super_user_instance: Callable,
@@ -192,6 +246,34 @@ def test_create_duo_session_instance(
     assert duo_session.amount == settings.SESSION_AMOUNT
 
 
+def test_update_duo_session_instance_keeps_its_settlement_event(
+    db: Session,
+    create_session_instance: Callable,
+    create_super_user_instance: Callable,
+    delete_duo_session_model_instances: Callable,
+) -> None:
+    """Assert a DuoSession can be updated without enqueueing a second settlement"""
+    session = session_dao.get_not_none(db)
+    user = user_dao.get_not_none(db, phone=settings.SUPERUSER_PHONE)
+    duo_session = duo_session_dao.create(
+        db,
+        obj_in=DuoSessionCreateSerializer(
+            party_a=user.id,
+            status=DuoSessionStatuses.REFUNDED.value,
+            session_id=session.id,
+            amount=settings.SESSION_AMOUNT,
+        ),
+    )
+
+    duo_session = duo_session_dao.update(
+        db, db_obj=duo_session, obj_in={"amount": settings.SESSION_AMOUNT * 2}
+    )
+    settlements = duo_session_settlement_dao.get_all(db, duo_session_id=duo_session.id)
+
+    assert duo_session.amount == settings.SESSION_AMOUNT * 2
+    assert len(settlements) == 1
+
+
 def test_create_duo_session_instance_fails_if_already_exists(
     db: Session,
     mocker: MockerFixture,
@@ -354,6 +436,7 @@ def test_duo_session_creates_transaction_instance_on_paired_state(
         amount=settings.SESSION_AMOUNT,
     )
     duo_session_dao.create(db, obj_in=data_in)
+    duo_session_settlement_dao.settle_pending(db)
 
     winner_obj = transaction_dao.get_not_none(db, account=party_a.phone)
     opponent_obj = transaction_dao.get_or_none(db, account=party_b.phone)
@@ -387,6 +470,8 @@ def test_duo_session_creates_transaction_instance_on_refunded_state(
         amount=settings.SESSION_AMOUNT,
     )
     duo_session_dao.create(db, obj_in=data_in)
+    duo_session_settlement_dao.settle_pending(db)
+
     db_obj = transaction_dao.get_not_none(db, account=party_a.phone)
 
     assert float(db_obj.amount) == (
@@ -417,6 +502,8 @@ def test_duo_session_creates_transaction_instance_on_partially_refunded_state(
         amount=settings.SESSION_AMOUNT,
     )
     duo_session_dao.create(db, obj_in=data_in)
+    duo_session_settlement_dao.settle_pending(db)
+
     db_obj = transaction_dao.get_not_none(db, account=party_a.phone)
 
     assert float(db_obj.amount) == (
@@ -0,0 +1,259 @@
+from typing import Callable
+from sqlalchemy.orm import Session
+from pytest_mock import MockerFixture
+from datetime import datetime, timedelta
+
+from app.core.config import settings
+from app.core.lease import LeaseLock
+from app.commons.constants import Categories
+from app.commons.utils import generate_uuid
+from app.quiz.daos.quiz import result_dao
+from app.users.daos.user import user_dao
+from app.accounts.daos.account import transaction_dao
+from app.sessions.constants import DuoSessionStatuses, DuoSessionSettlementStatuses
+from app.sessions.daos.session import (
+    session_dao,
+    duo_session_dao,
+    pool_session_stats_dao,
+    duo_session_settlement_dao,
+)
+from app.sessions.serializers.session import (
+    PoolCategoryStatistics,
+    DuoSessionCreateSerializer,
+)
+from app.sessions.tasks import (
+    pair_category_users_task,
+    settle_duo_sessions_task,
+    save_pool_session_stats_task,
+)
+
+
+def test_pair_category_users_task_only_pairs_its_category(
+    db: Session,
+    mocker: MockerFixture,
+    flush_redis: Callable,
+    delete_duo_session_model_instances: Callable,
+    create_result_instances_to_be_paired: Callable,
+) -> None:
+    """Assert the task pairs results in its category and returns the category's stats"""
+    mocker.patch(  # Mock send_notification so that we don't have to wait for it
+        "app.sessions.daos.session.notifications_dao.send_notification",
+        return_value=None,
+    )
+    mock_datetime = mocker.patch("app.core.utils.datetime")
+    mock_datetime.now.return_value = datetime.now() + timedelta(
+        seconds=settings.RESULT_PAIRS_AFTER_SECONDS + 60
+    )
+
+    statistics = pair_category_users_task(Categories.BIBLE.value)
+
+    db.expire_all()
+    active_categories = {
+        result.category for result in result_dao.get_all(db, is_active=True)
+    }
+
+    assert list(statistics.keys()) == [Categories.BIBLE.value]
+    assert Categories.BIBLE.value not in active_categories
+
+
+def test_pair_category_users_task_returns_statistics_once_per_ewma_interval(
+    mocker: MockerFixture,
+    flush_redis: Callable,
+    delete_pool_session_stats_model_instances: Callable,
+    create_result_instances_to_be_paired: Callable,
+) -> None:
+    """Assert only the run that mixes the EWMA returns statistics to be saved"""
+    mocker.patch(  # Mock send_notification so that we don't have to wait for it
+        "app.sessions.daos.session.notifications_dao.send_notification",
+        return_value=None,
+    )
+
+    first_statistics = pair_category_users_task(Categories.BIBLE.value)
+    second_statistics = pair_category_users_task(Categories.BIBLE.value)
+
+    assert list(first_statistics.keys()) == [Categories.BIBLE.value]
+    assert second_statistics == {}
+
+
+def test_pair_category_users_task_skips_a_category_being_paired(
+    mocker: MockerFixture, flush_redis: Callable
+) -> None:
+    """Assert the task does not wait for another run's lease and schedules the next run"""
+    mock_schedule_next_window = mocker.patch(
+        "app.sessions.tasks.pairing_scheduler.schedule_next_window"
+    )
+    mock_pair_users = mocker.patch("app.sessions.tasks.PairUsers")
+    lease = LeaseLock(f"pair_users_task:{Categories.BIBLE.value}")
+    lease.acquire()
+
+    try:
+        statistics = pair_category_users_task(Categories.BIBLE.value)
+    finally:
+        lease.release()
+
+    assert statistics == {}
+    assert mock_pair_users.call_count == 0
+    assert mock_schedule_next_window.call_count == 1
+
+
+def test_pair_category_users_task_returns_statistics_of_a_failed_run(
+    mocker: MockerFixture,
+    flush_redis: Callable,
+    create_result_instances_to_be_paired: Callable,
+) -> None:
+    """Assert a failed run does not raise, so the chord still saves the statistics"""
+    mocker.patch(
+        "app.core.utils.PairUsers.get_settlements",
+        side_effect=Exception("Database is unavailable"),
+    )
+
+    statistics = pair_category_users_task(Categories.BIBLE.value)
+
+    assert list(statistics.keys()) == [Categories.BIBLE.value]
+
+
+def test_save_pool_session_stats_task_saves_all_categories(
+    db: Session,
+    delete_pool_session_stats_model_instances: Callable,
+) -> None:
+    """Assert the statistics of each category task are saved as one instance"""
+    category_statistics = [
+        {category: PoolCategoryStatistics(players=2).dict()}
+        for category in Categories.list_()
+    ]
+
+    save_pool_session_stats_task(category_statistics)
+
+    pool_session_stats = pool_session_stats_dao.get_all(db)
+
+    assert len(pool_session_stats) == 1
+    assert pool_session_stats[0].total_players == 2 * len(Categories.list_())
+    assert set(pool_session_stats[0].statistics.keys()) == set(Categories.list_())
+
+
+def test_save_pool_session_stats_task_skips_runs_without_statistics(
+    db: Session,
+    delete_pool_session_stats_model_instances: Callable,
+) -> None:
+    """Assert nothing is saved when every category task returned no statistics"""
+    save_pool_session_stats_task([{} for _ in Categories.list_()])
+
+    assert pool_session_stats_dao.get_all(db) == []
+
+
+def test_settle_duo_sessions_task_settles_pending_duo_sessions(
+    db: Session,
+    mocker: MockerFixture,
+    create_session_instance: Callable,
+    create_user_model_instances: Callable,
+    delete_duo_session_model_instances: Callable,
+    delete_transcation_model_instances: Callable,
+) -> None:
+    """Assert DuoSessions are only settled by the settlement worker"""
+    mock_send_messages = mocker.patch(
+        "app.sessions.tasks.send_settlement_messages_task.apply_async"
+    )
+    session = session_dao.get_not_none(db)
+    party_a = user_dao.get_not_none(db)
+
+    duo_session = duo_session_dao.create(
+        db,
+        obj_in=DuoSessionCreateSerializer(
+            party_a=party_a.id,
+            status=DuoSessionStatuses.REFUNDED.value,
+            session_id=session.id,
+            amount=settings.SESSION_AMOUNT,
+        ),
+    )
+    settlement = duo_session_settlement_dao.get_not_none(
+        db, duo_session_id=duo_session.id
+    )
+
+    assert settlement.status == DuoSessionSettlementStatuses.PENDING.value
+    assert transaction_dao.get_or_none(db, account=party_a.phone) is None
+
+    settle_duo_sessions_task()
+    db.refresh(settlement)
+
+    assert settlement.status == DuoSessionSettlementStatuses.SETTLED.value
+    assert transaction_dao.get_or_none(db, account=party_a.phone) is not None
+    assert mock_send_messages.call_count == 1
+
+
+def test_settle_pending_keeps_duo_sessions_that_fail_to_settle(
+    db: Session,
+    create_session_instance: Callable,
+    delete_duo_session_model_instances: Callable,
+) -> None:
+    """Assert a DuoSession of an unknown user is marked failed instead of blocking the queue"""
+    session = session_dao.get_not_none(db)
+    duo_session = duo_session_dao.create(
+        db,
+        obj_in=DuoSessionCreateSerializer(
+            party_a=generate_uuid(),
+            status=DuoSessionStatuses.REFUNDED.value,
+            session_id=session.id,
+            amount=settings.SESSION_AMOUNT,
+        ),
+    )
+
+    total_settled, messages = duo_session_settlement_dao.settle_pending(db)
+    settlement = duo_session_settlement_dao.get_not_none(
+        db, duo_session_id=duo_session.id
+    )
+
+    assert total_settled == 1
+    assert messages == []
+    assert settlement.status == DuoSessionSettlementStatuses.FAILED.value
+    assert settlement.error is not None
+
+
+def test_settle_pending_retries_a_failing_duo_session_without_blocking_others(
+    db: Session,
+    mocker: MockerFixture,
+    create_session_instance: Callable,
+    create_user_model_instances: Callable,
+    delete_duo_session_model_instances: Callable,
+    delete_transcation_model_instances: Callable,
+) -> None:
+    """Assert a DuoSession that keeps failing is marked failed after its attempts"""
+    session = session_dao.get_not_none(db)
+    party_a, party_b = user_dao.get_all(db)[:2]
+    duo_sessions = [
+        duo_session_dao.create(
+            db,
+            obj_in=DuoSessionCreateSerializer(
+                party_a=user.id,
+                status=DuoSessionStatuses.REFUNDED.value,
+                session_id=session.id,
+                amount=settings.SESSION_AMOUNT,
+            ),
+        )
+        for user in [party_a, party_b]
+    ]
+    create_many = transaction_dao.create_many
+
+    def create_many_failing_for_party_b(db, *, objs_in):
+        if any(obj_in.account == party_b.phone for obj_in in objs_in):
+            raise Exception("Failed to create transactions")
+        return create_many(db, objs_in=objs_in)
+
+    mocker.patch.object(
+        transaction_dao, "create_many", side_effect=create_many_failing_for_party_b
+    )
+
+    for _ in range(settings.DUO_SESSION_SETTLEMENT_MAX_ATTEMPTS):
+        duo_session_settlement_dao.settle_pending(db)
+
+    settlement_a, settlement_b = [
+        duo_session_settlement_dao.get_not_none(db, duo_session_id=duo_session.id)
+        for duo_session in duo_sessions
+    ]
+    db.refresh(settlement_a)
+    db.refresh(settlement_b)
+
+    assert settlement_a.status == DuoSessionSettlementStatuses.SETTLED.value
+    assert transaction_dao.get_or_none(db, account=party_a.phone) is not None
+    assert settlement_b.status == DuoSessionSettlementStatuses.FAILED.value
+    assert settlement_b.attempts == settings.DUO_SESSION_SETTLEMENT_MAX_ATTEMPTS
+    assert transaction_dao.get_or_none(db, account=party_b.phone) is None
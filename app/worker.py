@@ -4,5 +4,6 @@ celery.autodiscover_tasks(
     packages=[
         "app",
         "app.sessions",
+        "app.accounts",
     ]
 )
@@ -0,0 +1,7 @@
+#!/usr/bin/env bash
+
+# Benchmarks run against the test database because every table is dropped afterwards
+export $(grep -v '^#' .env.test | xargs)
+
+echo "Running pairing benchmark $@"
+python -m app.core.benchmark "$@"
@@ -0,0 +1,7 @@
+#!/usr/bin/env bash
+
+# Replays are read-only, so point them at a copy of the production database
+export $(grep -v '^#' .env | xargs)
+
+echo "Replaying pairing runs $@"
+python -m app.core.replay "$@"